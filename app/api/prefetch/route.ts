@@ -0,0 +1,31 @@
+import { NextRequest, NextResponse } from "next/server";
+
+const LATEX_SERVICE_URL = process.env.LATEX_SERVICE_URL!;
+const LATEX_API_SECRET = process.env.LATEX_API_SECRET!;
+
+export async function POST(request: NextRequest) {
+  const body = await request.json();
+  const { projectId } = body as { projectId?: string };
+
+  if (!projectId) {
+    return NextResponse.json(
+      { error: "Missing required field: projectId" },
+      { status: 400 }
+    );
+  }
+
+  // The service answers at once and compiles in the background
+  const formData = new FormData();
+  formData.append("project_id", projectId);
+
+  const response = await fetch(`${LATEX_SERVICE_URL}/prefetch-project`, {
+    method: "POST",
+    headers: {
+      Authorization: `Bearer ${LATEX_API_SECRET}`,
+    },
+    body: formData,
+    signal: AbortSignal.timeout(10_000),
+  });
+
+  return NextResponse.json(await response.json(), { status: response.status });
+}
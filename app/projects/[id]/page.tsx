@@ -236,6 +236,17 @@ export default function EditorPage() {
     }
   }, [project, editingName]);
 
+  // Compile in the background on open, so the first Compile is a cache hit
+  const projectId = project?._id;
+  useEffect(() => {
+    if (!projectId) return;
+    fetch("/api/prefetch", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ projectId }),
+    }).catch(() => {});
+  }, [projectId]);
+
   // Auto-open first file
   useEffect(() => {
     if (files && files.length > 0 && !activeFileId) {
@@ -432,6 +443,8 @@ export default function EditorPage() {
       });
       if (!res.ok) {
         const body = await res.json().catch(() => null);
+        // A newer compile of this project replaced this one; its result will follow
+        if (res.status === 409 && body?.error === "superseded") return;
         console.error("[compile] error body:", JSON.stringify(body));
         const logTail = body?.log ?? body?.error ?? "Unknown compilation error";
         toast.error("Compilation failed", {
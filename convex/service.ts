@@ -30,7 +30,12 @@ export const getProjectWithFiles = internalQuery({
       })
     );
 
+    // Latest edit, for ordering snapshots of the project. Deletions don't
+    // bump it, so the service also orders by when it fetched.
+    const revision = Math.max(project.updatedAt, ...files.map((f) => f.updatedAt));
+
     return {
+      revision,
       compiler: project.compiler ?? "pdflatex",
       haltOnError: project.haltOnError ?? false,
       entrypoint,
@@ -0,0 +1,217 @@
+"""Cache of bibliography and index tool outputs (.bbl, .ind, ...).
+
+A typo fix in the body changes the PDF but not the citation set, yet a fresh
+build dir makes latexmk rerun biber/bibtex and makeindex from scratch. latexmk
+is pointed at this module as a wrapper for those tools: it hashes exactly the
+inputs the tool reads (the .bcf, the \\citation lines of the .aux, the .idx,
+plus the .bib/.bst/.ist files they name) and restores the tool's outputs from
+the cache on a hit instead of running it.
+
+    python artifact_cache.py biber [options] main
+
+Like the format cache, all state lives on disk, so it survives restarts and is
+shared by concurrent compiles.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_CACHE_DIR = Path(os.environ.get("ARTIFACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-artifacts")))
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+TOOLS = ("biber", "bibtex", "makeindex")
+
+_BCF_DATASOURCE = re.compile(r"<bcf:datasource[^>]*>([^<]+)</bcf:datasource>")
+# The only .aux lines bibtex reads; labels and page refs change on every edit
+_AUX_BIB_LINE = re.compile(r"^\\(?:citation|bibdata|bibstyle)\{.*$", re.MULTILINE)
+_AUX_INPUT = re.compile(r"^\\@input\{([^}]+)\}", re.MULTILINE)
+# makeindex options that take a value
+_MAKEINDEX_VALUE_OPTIONS = {"-o", "-s", "-t", "-p"}
+
+
+def latexmk_options() -> list[str]:
+    """latexmk arguments that route bibliography and index runs through the cache."""
+    wrapper = f"{sys.executable} {Path(__file__).resolve()}"
+    return [
+        "-e", f"$biber = q{{{wrapper} biber %O %S}}",
+        "-e", f"$bibtex = q{{{wrapper} bibtex %O %S}}",
+        "-e", f"$makeindex = q{{{wrapper} makeindex %O -o %D %S}}",
+    ]
+
+
+def _tool_version(tool: str) -> bytes:
+    path = shutil.which(tool)
+    # A TeX Live update replaces the binary and may change its output
+    return str(os.stat(path).st_mtime_ns).encode() if path else b""
+
+
+def _file_part(path: Path) -> bytes:
+    # Files outside the work dir (e.g. a TeX Live .bst) are covered by the name
+    content = path.read_bytes() if path.is_file() else b""
+    return b"\0" + str(path).encode() + b"\0" + content
+
+
+def _with_suffix(source: str, suffix: str) -> Path:
+    path = Path(source)
+    return path if path.suffix == suffix else Path(source + suffix)
+
+
+def _biber_key(options: list[str], source: str) -> tuple[str, list[Path]] | None:
+    bcf = _with_suffix(source, ".bcf")
+    if not bcf.is_file():
+        return None
+    text = bcf.read_text(errors="replace")
+    digest = hashlib.sha256(b"biber\0" + _tool_version("biber") + "\0".join(options).encode())
+    digest.update(text.encode())
+    for name in _BCF_DATASOURCE.findall(text):
+        digest.update(_file_part(Path(name.strip())))
+    base = bcf.with_suffix("")
+    return digest.hexdigest(), [base.with_suffix(".bbl"), base.with_suffix(".blg")]
+
+
+def _aux_bib_lines(aux: Path, seen: set[Path]) -> list[str]:
+    if aux in seen or not aux.is_file():
+        return []
+    seen.add(aux)
+    text = aux.read_text(errors="replace")
+    lines = _AUX_BIB_LINE.findall(text)
+    for name in _AUX_INPUT.findall(text):
+        lines.extend(_aux_bib_lines(aux.parent / name, seen))
+    return lines
+
+
+def _bibtex_key(options: list[str], source: str) -> tuple[str, list[Path]] | None:
+    aux = _with_suffix(source, ".aux")
+    lines = _aux_bib_lines(aux, set())
+    if not lines:
+        return None
+    digest = hashlib.sha256(b"bibtex\0" + _tool_version("bibtex") + "\0".join(options).encode())
+    digest.update("\n".join(lines).encode())
+    for line in lines:
+        command, _, arg = line[1:].partition("{")
+        names = arg.rstrip("}").split(",")
+        if command == "bibdata":
+            for name in names:
+                digest.update(_file_part(_with_suffix(name.strip(), ".bib")))
+        elif command == "bibstyle":
+            digest.update(_file_part(_with_suffix(names[0].strip(), ".bst")))
+    base = aux.with_suffix("")
+    return digest.hexdigest(), [base.with_suffix(".bbl"), base.with_suffix(".blg")]
+
+
+def _makeindex_key(options: list[str], source: str) -> tuple[str, list[Path]] | None:
+    idx = Path(source) if Path(source).is_file() else _with_suffix(source, ".idx")
+    if not idx.is_file():
+        return None
+    values = {}
+    flags = []
+    args = iter(options)
+    for arg in args:
+        if arg in _MAKEINDEX_VALUE_OPTIONS:
+            values[arg] = next(args, "")
+        else:
+            flags.append(arg)
+    digest = hashlib.sha256(b"makeindex\0" + _tool_version("makeindex") + "\0".join(flags).encode())
+    digest.update(_file_part(idx))
+    if "-s" in values:
+        digest.update(_file_part(_with_suffix(values["-s"], ".ist")))
+    if "-p" in values:
+        digest.update(b"\0-p" + values["-p"].encode())
+    output = Path(values.get("-o") or idx.with_suffix(".ind"))
+    transcript = Path(values.get("-t") or output.with_suffix(".ilg"))
+    return digest.hexdigest(), [output, transcript]
+
+
+_KEYS = {"biber": _biber_key, "bibtex": _bibtex_key, "makeindex": _makeindex_key}
+
+
+def _restore(entry: Path, outputs: list[Path]) -> bool:
+    try:
+        for i, output in enumerate(outputs):
+            shutil.copyfile(entry / str(i), output)
+        os.utime(entry)  # LRU by mtime
+    except FileNotFoundError:
+        return False  # evicted by another compile in the meantime
+    return True
+
+
+def _store(entry: Path, outputs: list[Path]) -> None:
+    if not all(output.is_file() for output in outputs):
+        return
+    ARTIFACT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=ARTIFACT_CACHE_DIR, prefix=".tmp-"))
+    try:
+        for i, output in enumerate(outputs):
+            shutil.copyfile(output, tmp / str(i))
+        # Publish atomically; another compile may have stored the same entry
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    _evict()
+
+
+def run(tool: str, args: list[str]) -> int:
+    """Run tool with args (options, then the source), or restore its outputs
+    from the cache. Returns the exit code to report to latexmk."""
+    cmd = [tool, *args]
+    try:
+        key = _KEYS[tool](args[:-1], args[-1]) if args else None
+    except (OSError, UnicodeError) as e:
+        log.warning("Not caching %s: %s", cmd, e)
+        key = None
+    if key is None:
+        return _run_tool(cmd)
+
+    digest, outputs = key
+    entry = ARTIFACT_CACHE_DIR / digest
+    if _restore(entry, outputs):
+        print(f"artifact cache: restored {', '.join(map(str, outputs))} instead of running {tool}", flush=True)
+        return 0
+    returncode = _run_tool(cmd)
+    if returncode == 0:
+        _store(entry, outputs)
+    return returncode
+
+
+def _run_tool(cmd: list[str]) -> int:
+    try:
+        return subprocess.run(cmd).returncode
+    except OSError as e:
+        log.error("Could not run %s: %s", cmd[0], e)
+        return 127
+
+
+def _evict() -> None:
+    entries = []
+    for path in ARTIFACT_CACHE_DIR.iterdir():
+        if path.name.startswith("."):
+            continue
+        try:
+            stat = path.stat()
+            size = sum(f.stat().st_size for f in path.iterdir())
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= ARTIFACT_CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in TOOLS:
+        sys.exit(f"usage: {sys.argv[0]} {{{'|'.join(TOOLS)}}} [options] source")
+    logging.basicConfig(level=logging.WARNING, format="artifact cache: %(message)s")
+    sys.exit(run(sys.argv[1], sys.argv[2:]))
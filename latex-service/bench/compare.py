@@ -0,0 +1,71 @@
+"""Compare two reports written by run.py.
+
+    python bench/compare.py before.json after.json
+
+Prints latency percentiles and throughput side by side with the relative
+change, per endpoint and per endpoint:kind, followed by cache hit rates and
+peak RSS.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+METRICS = ("p50", "p95", "p99", "throughput")
+
+
+def _change(before: float | None, after: float | None) -> str:
+    if before is None or after is None:
+        return ""
+    if before == 0:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def _fmt(value: float | None) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def _table(title: str, before: dict, after: dict) -> None:
+    print(f"\n{title}")
+    print(f"  {'':28} {'metric':>10} {'before':>10} {'after':>10} {'change':>9}")
+    for name in sorted(before.keys() | after.keys()):
+        old, new = before.get(name, {}), after.get(name, {})
+        for metric in METRICS:
+            print(
+                f"  {name:28} {metric:>10} {_fmt(old.get(metric)):>10} {_fmt(new.get(metric)):>10}"
+                f" {_change(old.get(metric), new.get(metric)):>9}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    args = parser.parse_args()
+    before = json.loads(args.before.read_text())
+    after = json.loads(args.after.read_text())
+
+    if before["config"] != after["config"]:
+        changed = sorted(k for k in before["config"].keys() | after["config"].keys()
+                         if before["config"].get(k) != after["config"].get(k))
+        print(f"warning: runs used different settings: {', '.join(changed)}")
+
+    _table("overall", {"all": before["overall"]}, {"all": after["overall"]})
+    _table("endpoints", before["endpoints"], after["endpoints"])
+    _table("kinds", before["kinds"], after["kinds"])
+
+    print("\ncache hit rates")
+    for cache in sorted(before["caches"].keys() | after["caches"].keys()):
+        old = before["caches"].get(cache, {}).get("hit_rate")
+        new = after["caches"].get(cache, {}).get("hit_rate")
+        print(f"  {cache:28} {_fmt(old):>10} {_fmt(new):>10}")
+
+    print("\npeak RSS (KiB)")
+    for name in ("service", "any_process"):
+        old, new = before["peak_rss_kib"].get(name), after["peak_rss_kib"].get(name)
+        print(f"  {name:28} {old or '-':>10} {new or '-':>10} {_change(old, new):>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Deterministic synthetic LaTeX projects for benchmarking.
+
+Each kind stresses a different part of a compile:
+
+- note: two short pages, the common interactive case
+- book: about 100 pages of \\include'd chapters, engine-bound
+- images: a dozen PNG figures, upload/materialization-bound
+- biblatex: a large .bib and hundreds of citations, biber-bound
+
+    python bench/corpus.py OUT_DIR [--count 2] [--seed 0]
+"""
+
+import argparse
+import json
+import random
+import struct
+import zlib
+from pathlib import Path
+
+KINDS = ("note", "book", "images", "biblatex")
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+    "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur"
+).split()
+
+
+def _paragraph(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + "."
+
+
+def _png(rng: random.Random, size: int) -> bytes:
+    """An RGB PNG of random-ish noise, which compresses about as badly as a photo."""
+    rows = []
+    for _ in range(size):
+        rows.append(b"\0" + bytes(rng.getrandbits(8) for _ in range(size * 3)))
+    raw = zlib.compress(b"".join(rows), 6)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", raw) + chunk(b"IEND", b"")
+
+
+def note(rng: random.Random) -> dict[str, bytes | str]:
+    body = "\n\n".join(_paragraph(rng, 80) for _ in range(8))
+    return {
+        "main.tex": (
+            "\\documentclass{article}\n\\usepackage{amsmath}\n\\begin{document}\n"
+            "\\section{Notes}\n" + body + "\n\\begin{equation}\n  e^{i\\pi} + 1 = 0\n\\end{equation}\n"
+            "\\end{document}\n"
+        ),
+    }
+
+
+def book(rng: random.Random) -> dict[str, bytes | str]:
+    files: dict[str, bytes | str] = {}
+    includes = []
+    for chapter in range(1, 11):
+        sections = []
+        for section in range(1, 6):
+            paragraphs = "\n\n".join(_paragraph(rng, 120) for _ in range(7))
+            sections.append(f"\\section{{Section {chapter}.{section}}}\\label{{sec:{chapter}-{section}}}\n{paragraphs}\n")
+        files[f"chapters/ch{chapter}.tex"] = f"\\chapter{{Chapter {chapter}}}\n" + "\n".join(sections)
+        includes.append(f"\\include{{chapters/ch{chapter}}}")
+    files["main.tex"] = (
+        "\\documentclass{book}\n\\usepackage{amsmath}\n\\usepackage{hyperref}\n\\begin{document}\n"
+        "\\tableofcontents\n" + "\n".join(includes) + "\n\\end{document}\n"
+    )
+    return files
+
+
+def images(rng: random.Random) -> dict[str, bytes | str]:
+    files: dict[str, bytes | str] = {}
+    figures = []
+    for i in range(12):
+        files[f"figures/fig{i}.png"] = _png(rng, 256)
+        figures.append(
+            "\\begin{figure}[h]\n\\centering\n"
+            f"\\includegraphics[width=0.6\\linewidth]{{figures/fig{i}.png}}\n"
+            f"\\caption{{Figure {i}. {_paragraph(rng, 12)}}}\n\\end{{figure}}\n"
+        )
+    files["main.tex"] = (
+        "\\documentclass{article}\n\\usepackage{graphicx}\n\\begin{document}\n"
+        + "\n".join(f"{_paragraph(rng, 60)}\n\n{figure}" for figure in figures)
+        + "\\end{document}\n"
+    )
+    return files
+
+
+def biblatex(rng: random.Random) -> dict[str, bytes | str]:
+    entries = []
+    for i in range(400):
+        entries.append(
+            f"@article{{ref{i},\n  author = {{{rng.choice(WORDS).title()}, {rng.choice(WORDS).title()}}},\n"
+            f"  title = {{{_paragraph(rng, 8)}}},\n  journal = {{Journal of {rng.choice(WORDS).title()}}},\n"
+            f"  year = {{{rng.randint(1950, 2025)}}},\n  volume = {{{rng.randint(1, 80)}}},\n"
+            f"  pages = {{{rng.randint(1, 500)}--{rng.randint(501, 900)}}}\n}}\n"
+        )
+    paragraphs = []
+    for _ in range(40):
+        cites = ",".join(f"ref{rng.randrange(400)}" for _ in range(rng.randint(1, 4)))
+        paragraphs.append(f"{_paragraph(rng, 70)} \\cite{{{cites}}}")
+    return {
+        "refs.bib": "\n".join(entries),
+        "main.tex": (
+            "\\documentclass{article}\n\\usepackage[backend=biber,style=authoryear]{biblatex}\n"
+            "\\addbibresource{refs.bib}\n\\begin{document}\n" + "\n\n".join(paragraphs)
+            + "\n\\nocite{*}\n\\printbibliography\n\\end{document}\n"
+        ),
+    }
+
+
+GENERATORS = {"note": note, "book": book, "images": images, "biblatex": biblatex}
+
+
+def generate(out_dir: Path, kinds: tuple[str, ...] = KINDS, count: int = 2, seed: int = 0) -> list[str]:
+    """Write count projects of each kind to out_dir/<kind>-<n>/ and return their ids."""
+    project_ids = []
+    for kind in kinds:
+        for n in range(count):
+            project_id = f"{kind}-{n}"
+            rng = random.Random(f"{seed}:{project_id}")
+            root = out_dir / project_id
+            for name, content in GENERATORS[kind](rng).items():
+                path = root / name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if isinstance(content, str):
+                    path.write_text(content)
+                else:
+                    path.write_bytes(content)
+            (root / "project.json").write_text(json.dumps({"kind": kind, "entrypoint": "main.tex"}))
+            project_ids.append(project_id)
+    return project_ids
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--kinds", default=",".join(KINDS))
+    parser.add_argument("--count", type=int, default=2, help="projects per kind")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    kinds = tuple(args.kinds.split(","))
+    for project_id in generate(args.out_dir, kinds, args.count, args.seed):
+        print(project_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+"""Load generator and latency report for the compile service.
+
+Generates a corpus, starts the app against the local Convex stand-in (see
+stand_in.py) with fresh caches, drives /compile and /compile-project, and
+prints a JSON report: latency percentiles and throughput per endpoint and
+project kind, cache hit rates from /metrics, and peak RSS.
+
+    python bench/run.py --concurrency 4 --requests 200 --edit-fraction 0.5 -o before.json
+    python bench/compare.py before.json after.json
+
+With --nodes N, N workers run behind the coordinator (coordinator.py) and
+share a cluster state file; requests go through the coordinator and the report
+adds where they were routed. --leave-after stops one worker part-way through
+to watch its projects move to the others.
+
+Arrival patterns: `closed` keeps --concurrency requests in flight; `poisson`
+starts requests at --rate per second regardless of completions (capped at
+--concurrency in flight); `burst` sends --concurrency requests at once every
+--burst-interval seconds. Requests are drawn from the corpus with --seed, so
+two runs with the same arguments send the same sequence.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import resource
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import httpx
+
+from corpus import KINDS, generate
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+ENDPOINTS = ("compile", "compile-project")
+STARTUP_TIMEOUT = 600.0  # includes the warm-up of every engine
+REQUEST_TIMEOUT = 180.0
+CACHE_SAMPLE = re.compile(r'^latex_cache_lookups_total\{cache="(\w+)",result="(\w+)"\} (\S+)$', re.MULTILINE)
+ROUTE_SAMPLE = re.compile(r'^latex_cluster_routes_total\{node="([^"]+)",reason="(\w+)"\} (\S+)$', re.MULTILINE)
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    kind: str
+    edited: bool
+    status: int
+    seconds: float
+    bytes: int
+    server_timing: str
+    project: str = ""
+    served_by: str = ""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _zip_project(root: Path, revision: int) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(p for p in root.rglob("*") if p.is_file() and p.name != "project.json"):
+            data = path.read_bytes()
+            if path.name == "main.tex" and revision:
+                data += f"\n% bench revision {revision}\n".encode()
+            zf.writestr(str(path.relative_to(root)), data)
+    return buffer.getvalue()
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def _summarize(samples: list[Sample], wall: float) -> dict:
+    ok = [s.seconds for s in samples if s.status == 200]
+    summary = {
+        "requests": len(samples),
+        "ok": len(ok),
+        "statuses": dict(Counter(str(s.status) for s in samples)),
+        "throughput": round(len(ok) / wall, 3) if wall else 0.0,
+        "bytes": sum(s.bytes for s in samples),
+    }
+    if ok:
+        summary.update(
+            p50=round(_percentile(ok, 0.50), 4),
+            p95=round(_percentile(ok, 0.95), 4),
+            p99=round(_percentile(ok, 0.99), 4),
+            mean=round(sum(ok) / len(ok), 4),
+            max=round(max(ok), 4),
+        )
+    return summary
+
+
+def _cache_counts(metrics_texts: list[str]) -> dict[tuple[str, str], float]:
+    counts: dict[tuple[str, str], float] = defaultdict(float)
+    for text in metrics_texts:
+        for cache, result, value in CACHE_SAMPLE.findall(text):
+            counts[(cache, result)] += float(value)
+    return counts
+
+
+def _peak_rss_kib(pid: int) -> int | None:
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    match = re.search(r"^VmHWM:\s+(\d+) kB", status, re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace, corpus: Path, project_ids: list[str]) -> None:
+        self.args = args
+        self.corpus = corpus
+        self.project_ids = project_ids
+        self.rng = random.Random(args.seed)
+        self.revisions: dict[str, int] = defaultdict(int)
+        self.samples: list[Sample] = []
+        self.secret = secrets.token_hex(16)
+        # (port, storage port) per worker; with one node the bench talks to it directly
+        self.nodes = [(_free_port(), _free_port()) for _ in range(args.nodes)]
+        self.port = _free_port() if args.nodes > 1 else self.nodes[0][0]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.headers = {"Authorization": f"Bearer {self.secret}"}
+        self.scratch = Path(tempfile.mkdtemp(prefix="bench-caches-"))  # fresh service caches per run
+
+    def plan(self) -> list[tuple[str, str, bool]]:
+        """The (endpoint, project, edit first) sequence of requests to send."""
+        endpoints = ENDPOINTS if self.args.endpoint == "mixed" else (self.args.endpoint,)
+        return [
+            (self.rng.choice(endpoints), self.rng.choice(self.project_ids), self.rng.random() < self.args.edit_fraction)
+            for _ in range(self.args.warmup + self.args.requests)
+        ]
+
+    def start_servers(self, log_file: io.TextIOBase) -> list[subprocess.Popen]:
+        """The workers, then the coordinator if there is more than one worker."""
+        env = {**os.environ, "LATEX_API_SECRET": self.secret}
+        if self.args.nodes > 1:
+            env.update(CLUSTER_STATE_FILE=str(self.scratch / "cluster.json"), HEARTBEAT_INTERVAL="1", NODE_TTL="5")
+        servers = []
+        for i, (port, storage_port) in enumerate(self.nodes):
+            scratch = self.scratch / f"node{i}"
+            node_env = {
+                **env,
+                **{
+                    name: str(scratch / name.lower())
+                    for name in (
+                        "BUILD_CACHE_DIR", "BLOB_CACHE_DIR", "PDF_CACHE_DIR", "FORMAT_CACHE_DIR",
+                        "ARTIFACT_CACHE_DIR", "RENDER_CACHE_DIR",
+                        # Otherwise shared between nodes and runs: a node would
+                        # pick up other nodes' spooled uploads at startup
+                        "UPLOAD_SPOOL_DIR", "SCRATCH_DIR", "SCRATCH_FALLBACK_DIR",
+                    )
+                },
+            }
+            if self.args.nodes > 1:
+                node_env["NODE_URL"] = f"http://127.0.0.1:{port}"
+            cmd = [
+                sys.executable, str(SERVICE_DIR / "bench" / "stand_in.py"),
+                "--corpus", str(self.corpus), "--port", str(port), "--storage-port", str(storage_port),
+            ]
+            servers.append(subprocess.Popen(cmd, cwd=SERVICE_DIR, env=node_env, stdout=log_file, stderr=subprocess.STDOUT))
+        if self.args.nodes > 1:
+            cmd = [
+                sys.executable, "-m", "uvicorn", "coordinator:app",
+                "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning",
+            ]
+            servers.append(subprocess.Popen(cmd, cwd=SERVICE_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT))
+        return servers
+
+    async def wait_ready(self, client: httpx.AsyncClient, servers: list[subprocess.Popen]) -> None:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            for server in servers:
+                if server.poll() is not None:
+                    raise RuntimeError(f"Service exited with code {server.returncode} during startup")
+            try:
+                # Measure warm nodes: wait out the startup warm-up
+                if self.args.nodes == 1:
+                    if (await client.get(f"{self.url}/ready")).status_code == 200:
+                        return
+                else:
+                    # The coordinator is up before every worker has announced itself
+                    nodes = (await client.get(f"{self.url}/health")).json()["nodes"]
+                    if len(nodes) == self.args.nodes and all(node.get("ready") for node in nodes.values()):
+                        return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("Service did not become healthy in time")
+
+    async def scrape(self, client: httpx.AsyncClient, url: str) -> str:
+        try:
+            return (await client.get(f"{url}/metrics", headers=self.headers)).text
+        except httpx.TransportError:
+            return ""  # a worker stopped by --leave-after
+
+    async def worker_metrics(self, client: httpx.AsyncClient) -> list[str]:
+        return [await self.scrape(client, f"http://127.0.0.1:{port}") for port, _ in self.nodes]
+
+    async def leave(self, servers: list[subprocess.Popen]) -> None:
+        await asyncio.sleep(self.args.leave_after)
+        # Terminated cleanly, so it deregisters and its projects move at once
+        servers[0].terminate()
+
+    async def send(self, client: httpx.AsyncClient, endpoint: str, project_id: str, edit: bool) -> None:
+        if edit:
+            self.revisions[project_id] += 1
+            if endpoint == "compile-project":
+                # Each worker has its own stand-in storage
+                for _, storage_port in self.nodes:
+                    try:
+                        await client.post(f"http://127.0.0.1:{storage_port}/projects/{project_id}/edit")
+                    except httpx.TransportError:
+                        pass
+        started = time.perf_counter()
+        try:
+            if endpoint == "compile":
+                data = await asyncio.to_thread(_zip_project, self.corpus / project_id, self.revisions[project_id])
+                response = await client.post(
+                    f"{self.url}/compile",
+                    headers=self.headers,
+                    files={"file": ("project.zip", data, "application/zip")},
+                    data={"entrypoint": "main.tex", "timeout": "120"},
+                )
+            else:
+                response = await client.post(
+                    f"{self.url}/compile-project",
+                    headers=self.headers,
+                    data={"project_id": project_id, "timeout": "120"},
+                )
+            status, size, timing = response.status_code, len(response.content), response.headers.get("Server-Timing", "")
+            served_by = response.headers.get("X-Served-By", "")
+        except httpx.HTTPError:
+            status, size, timing, served_by = 0, 0, "", ""
+        kind = project_id.rsplit("-", 1)[0]
+        self.samples.append(
+            Sample(endpoint, kind, edit, status, time.perf_counter() - started, size, timing, project_id, served_by)
+        )
+
+    async def drive(self, client: httpx.AsyncClient, plan: list[tuple[str, str, bool]]) -> None:
+        slots = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(request: tuple[str, str, bool]) -> None:
+            async with slots:
+                await self.send(client, *request)
+
+        if self.args.pattern == "closed":
+            await asyncio.gather(*(one(request) for request in plan))
+            return
+        tasks = []
+        for i, request in enumerate(plan):
+            tasks.append(asyncio.create_task(one(request)))
+            if self.args.pattern == "poisson":
+                await asyncio.sleep(self.rng.expovariate(self.args.rate))
+            elif (i + 1) % self.args.concurrency == 0:
+                await asyncio.sleep(self.args.burst_interval)
+        await asyncio.gather(*tasks)
+
+    async def run(self, servers: list[subprocess.Popen]) -> dict:
+        limits = httpx.Limits(max_connections=self.args.concurrency + 4)
+        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client:
+            await self.wait_ready(client, servers)
+            plan = self.plan()
+            warmup, measured = plan[: self.args.warmup], plan[self.args.warmup :]
+            for request in warmup:
+                await self.send(client, *request)
+            self.samples.clear()
+
+            before = _cache_counts(await self.worker_metrics(client))
+            leave = asyncio.create_task(self.leave(servers)) if self.args.leave_after is not None else None
+            started = time.perf_counter()
+            await self.drive(client, measured)
+            wall = time.perf_counter() - started
+            if leave:
+                leave.cancel()
+            rss = {f"node{i}": _peak_rss_kib(server.pid) for i, server in enumerate(servers[: self.args.nodes])}
+            after = _cache_counts(await self.worker_metrics(client))
+            report = self.report(wall, before, after, max((v for v in rss.values() if v), default=None))
+            if self.args.nodes > 1:
+                report["peak_rss_kib"]["nodes"] = rss
+                report["peak_rss_kib"]["coordinator"] = _peak_rss_kib(servers[-1].pid)
+                report["cluster"] = self.cluster_report(await self.scrape(client, self.url))
+        return report
+
+    def cluster_report(self, coordinator_metrics: str) -> dict:
+        routes: dict[str, dict[str, int]] = defaultdict(dict)
+        for node, reason, value in ROUTE_SAMPLE.findall(coordinator_metrics):
+            routes[node][reason] = int(float(value))
+        # How many nodes each project was served by; 1 means full affinity
+        nodes_per_project: dict[str, set[str]] = defaultdict(set)
+        for sample in self.samples:
+            if sample.endpoint == "compile-project" and sample.served_by:
+                nodes_per_project[sample.project].add(sample.served_by)
+        return {
+            "routes": routes,
+            "nodes_per_project": {project: len(nodes) for project, nodes in sorted(nodes_per_project.items())},
+        }
+
+    def report(self, wall: float, before: dict, after: dict, service_rss: int | None) -> dict:
+        by_endpoint: dict[str, list[Sample]] = defaultdict(list)
+        by_kind: dict[str, list[Sample]] = defaultdict(list)
+        for sample in self.samples:
+            by_endpoint[sample.endpoint].append(sample)
+            by_kind[f"{sample.endpoint}:{sample.kind}"].append(sample)
+
+        caches = {}
+        for cache in sorted({cache for cache, _ in after}):
+            hits = after.get((cache, "hit"), 0.0) - before.get((cache, "hit"), 0.0)
+            misses = after.get((cache, "miss"), 0.0) - before.get((cache, "miss"), 0.0)
+            caches[cache] = {
+                "hits": int(hits),
+                "misses": int(misses),
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            }
+
+        config = {k: v for k, v in vars(self.args).items() if k not in ("output", "keep_corpus")}
+        report = {
+            "config": config,
+            "wall_seconds": round(wall, 3),
+            "overall": _summarize(self.samples, wall),
+            "endpoints": {name: _summarize(samples, wall) for name, samples in sorted(by_endpoint.items())},
+            "kinds": {name: _summarize(samples, wall) for name, samples in sorted(by_kind.items())},
+            "caches": caches,
+            "peak_rss_kib": {"service": service_rss},
+        }
+        if self.args.samples:
+            report["samples"] = [asdict(sample) for sample in self.samples]
+        return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=(*ENDPOINTS, "mixed"), default="mixed")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="comma-separated corpus kinds")
+    parser.add_argument("--projects", type=int, default=2, help="projects per kind")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests")
+    parser.add_argument("--warmup", type=int, default=0, help="sequential requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--pattern", choices=("closed", "poisson", "burst"), default="closed")
+    parser.add_argument("--rate", type=float, default=2.0, help="requests per second for --pattern poisson")
+    parser.add_argument("--burst-interval", type=float, default=10.0)
+    parser.add_argument("--edit-fraction", type=float, default=0.5, help="share of requests preceded by an edit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nodes", type=int, default=1, help="workers; more than one adds the coordinator")
+    parser.add_argument("--leave-after", type=float, help="stop one worker this many seconds into the run")
+    parser.add_argument("--samples", action="store_true", help="include every request in the report")
+    parser.add_argument("--keep-corpus", action="store_true")
+    parser.add_argument("-o", "--output", type=Path, help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.leave_after is not None and args.nodes < 2:
+        parser.error("--leave-after needs --nodes 2 or more")
+
+    corpus = Path(tempfile.mkdtemp(prefix="bench-corpus-"))
+    project_ids = generate(corpus, tuple(args.kinds.split(",")), args.projects, args.seed)
+    bench = Bench(args, corpus, project_ids)
+
+    with tempfile.NamedTemporaryFile("w", prefix="bench-service-", suffix=".log", delete=False) as log_file:
+        servers = bench.start_servers(log_file)
+        try:
+            report = asyncio.run(bench.run(servers))
+        finally:
+            for server in servers:
+                server.terminate()
+            for server in servers:
+                server.wait()
+            shutil.rmtree(bench.scratch, ignore_errors=True)
+    # The largest of the service and every process it ran (latexmk, engines, biber)
+    report["peak_rss_kib"]["any_process"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    report["service_log"] = log_file.name
+    if args.keep_corpus:
+        report["corpus"] = str(corpus)
+    else:
+        shutil.rmtree(corpus, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Run the service against a local stand-in for Convex and its file storage.
+
+The stand-in answers the four service functions the app calls from a corpus
+directory written by corpus.py, and serves storage URLs (binary project files,
+uploaded PDFs) from a small HTTP server on --storage-port. A project is edited
+with POST /projects/<id>/edit on that server, which appends a comment to its
+entrypoint so its content hash changes.
+
+    python bench/stand_in.py --corpus DIR --port 8000 --storage-port 8001
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class Storage:
+    """Content-addressed blobs plus the project and compilation tables."""
+
+    def __init__(self, corpus: Path, base_url: str) -> None:
+        self.base_url = base_url
+        self._lock = threading.Lock()
+        self._blobs: dict[str, bytes] = {}
+        self._projects: dict[str, dict] = {}
+        self._revisions: dict[str, int] = {}
+        self._compilations: dict[tuple[str, str], str] = {}
+        for meta_path in sorted(corpus.glob("*/project.json")):
+            self._load(meta_path.parent, json.loads(meta_path.read_text()))
+
+    def _load(self, root: Path, meta: dict) -> None:
+        files = []
+        for path in sorted(p for p in root.rglob("*") if p.is_file() and p.name != "project.json"):
+            name = str(path.relative_to(root))
+            data = path.read_bytes()
+            if path.suffix in (".tex", ".bib", ".sty", ".cls"):
+                files.append({"name": name, "content": data.decode("utf-8"), "storageUrl": None})
+            else:
+                files.append({"name": name, "content": None, "storageUrl": self.url(self.put(data))})
+        self._projects[root.name] = {
+            "compiler": meta.get("compiler", "pdflatex"),
+            "haltOnError": False,
+            "entrypoint": meta.get("entrypoint", "main.tex"),
+            "files": files,
+        }
+
+    def url(self, storage_id: str) -> str:
+        return f"{self.base_url}/storage/{storage_id}"
+
+    def put(self, data: bytes) -> str:
+        storage_id = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._blobs[storage_id] = data
+        return storage_id
+
+    def get(self, storage_id: str) -> bytes | None:
+        with self._lock:
+            return self._blobs.get(storage_id)
+
+    def edit(self, project_id: str) -> int:
+        with self._lock:
+            project = self._projects[project_id]
+            revision = self._revisions.get(project_id, 0) + 1
+            self._revisions[project_id] = revision
+            for file in project["files"]:
+                if file["name"] == project["entrypoint"]:
+                    file["content"] = file["content"].split("\n% bench revision")[0] + f"\n% bench revision {revision}\n"
+            return revision
+
+    def project(self, project_id: str) -> dict:
+        with self._lock:
+            if project_id not in self._projects:
+                raise KeyError(f"Project not found: {project_id}")
+            project = self._projects[project_id]
+            return {**project, "files": [dict(f) for f in project["files"]]}
+
+    def compilation(self, project_id: str, zip_hash: str) -> dict | None:
+        with self._lock:
+            storage_id = self._compilations.get((project_id, zip_hash))
+        return {"pdfUrl": self.url(storage_id)} if storage_id else None
+
+    def save_compilation(self, project_id: str, zip_hash: str, storage_id: str) -> None:
+        with self._lock:
+            self._compilations[(project_id, zip_hash)] = storage_id
+
+
+class StandInClient:
+    """Drop-in for convex.ConvexClient, covering the functions in convex/service.ts."""
+
+    storage: Storage
+
+    def __init__(self, url: str) -> None:
+        pass
+
+    def set_admin_auth(self, key: str) -> None:
+        pass
+
+    def query(self, name: str, args: dict) -> object:
+        if name == "service:getProjectWithFiles":
+            return self.storage.project(args["projectId"])
+        if name == "service:getCompilationByHash":
+            return self.storage.compilation(args["projectId"], args["zipHash"])
+        raise ValueError(f"Unknown query {name}")
+
+    def mutation(self, name: str, args: dict) -> object:
+        if name == "service:generateUploadUrl":
+            return f"{self.storage.base_url}/upload"
+        if name == "service:saveCompilation":
+            return self.storage.save_compilation(args["projectId"], args["zipHash"], args["storageId"])
+        raise ValueError(f"Unknown mutation {name}")
+
+
+def _storage_handler(storage: Storage) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            data = storage.get(self.path.removeprefix("/storage/"))
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", "0"))
+            data = self.rfile.read(length)
+            if self.path == "/upload":
+                self._json({"storageId": storage.put(data)})
+            elif self.path.startswith("/projects/") and self.path.endswith("/edit"):
+                project_id = self.path.split("/")[2]
+                try:
+                    self._json({"revision": storage.edit(project_id)})
+                except KeyError:
+                    self.send_error(404)
+            else:
+                self.send_error(404)
+
+        def _json(self, body: dict) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", type=Path, required=True)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--storage-port", type=int, default=8001)
+    args = parser.parse_args()
+
+    os.environ.setdefault("CONVEX_URL", "http://stand-in")
+    os.environ.setdefault("CONVEX_DEPLOY_KEY", "bench")
+
+    storage = Storage(args.corpus, f"http://127.0.0.1:{args.storage_port}")
+    server = ThreadingHTTPServer(("127.0.0.1", args.storage_port), _storage_handler(storage))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import convex_fetcher
+    import uvicorn
+
+    StandInClient.storage = storage
+    convex_fetcher.ConvexClient = StandInClient
+    uvicorn.run("main:app", host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""On-disk content-addressed cache of binary project assets.
+
+Blobs are stored under their SHA-256 and indexed by the Convex storage URL they
+were downloaded from. Convex storage objects are immutable, so a URL seen once
+never needs to be fetched again while its blob is cached.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+BLOB_CACHE_DIR = Path(os.environ.get("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-blobs")))
+BLOB_CACHE_MAX_BYTES = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CHUNK_SIZE = 256 * 1024
+
+
+def storage_key(url: str) -> str:
+    """Identify a storage object by host and path; the query string may vary."""
+    parts = urlsplit(url)
+    return parts.netloc + parts.path
+
+
+class BlobCache:
+    def __init__(self, root: Path = BLOB_CACHE_DIR, max_bytes: int = BLOB_CACHE_MAX_BYTES) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._blobs: OrderedDict[str, int] = OrderedDict()  # digest -> size, LRU order
+        self._total_bytes = 0
+        self._inflight: dict[str, asyncio.Future[str]] = {}
+
+    def start(self) -> None:
+        """Index blobs kept from a previous run, oldest first."""
+        (self._root / "blobs").mkdir(parents=True, exist_ok=True)
+        (self._root / "refs").mkdir(parents=True, exist_ok=True)
+        tmp_dir = self._root / "tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+
+        entries = []
+        for path in (self._root / "blobs").iterdir():
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        for _, digest, size in sorted(entries):
+            self._blobs[digest] = size
+            self._total_bytes += size
+        self._evict()
+        for ref in (self._root / "refs").iterdir():
+            if ref.read_text() not in self._blobs:
+                ref.unlink()
+        log.info("Blob cache: %d blobs, %d bytes", len(self._blobs), self._total_bytes)
+
+    def blob_path(self, digest: str) -> Path:
+        return self._root / "blobs" / digest
+
+    def _ref_path(self, key: str) -> Path:
+        return self._root / "refs" / hashlib.sha256(key.encode()).hexdigest()
+
+    def has(self, digest: str) -> bool:
+        return digest in self._blobs
+
+    def size(self, digest: str) -> int | None:
+        return self._blobs.get(digest)
+
+    def touch(self, digest: str) -> bool:
+        """Mark a blob recently used. Returns False if it is not cached."""
+        if digest not in self._blobs:
+            return False
+        self._blobs.move_to_end(digest)
+        return True
+
+    def lookup(self, key: str) -> str | None:
+        """Return the digest cached for a storage key, marking it recently used."""
+        try:
+            digest = self._ref_path(key).read_text()
+        except OSError:
+            return None
+        if digest not in self._blobs:
+            return None
+        self._blobs.move_to_end(digest)
+        return digest
+
+    async def fetch(self, http: httpx.AsyncClient, url: str) -> str:
+        """Return the digest of the blob behind url, downloading it on a miss.
+        Concurrent fetches of the same object share one download."""
+        key = storage_key(url)
+        digest = self.lookup(key)
+        if digest is not None:
+            return digest
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            digest = await self._download(http, url)
+            self._ref_path(key).write_text(digest)
+            future.set_result(digest)
+            return digest
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _download(self, http: httpx.AsyncClient, url: str) -> str:
+        async with http.stream("GET", url) as response:
+            response.raise_for_status()
+            return await self._store(response.aiter_bytes(CHUNK_SIZE))
+
+    async def put_stream(self, chunks: AsyncIterator[bytes], digest: str, max_bytes: int) -> None:
+        """Store an uploaded blob, checking it really hashes to `digest`.
+        Raises ValueError if it doesn't or if it is larger than max_bytes."""
+        await self._store(chunks, expected=digest, max_bytes=max_bytes)
+
+    async def _store(
+        self, chunks: AsyncIterator[bytes], expected: str | None = None, max_bytes: int | None = None
+    ) -> str:
+        # Disk writes run in a thread so a slow disk doesn't stall the event loop
+        fd, tmp_name = await asyncio.to_thread(tempfile.mkstemp, dir=self._root / "tmp")
+        tmp = Path(tmp_name)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise ValueError(f"Blob exceeds {max_bytes} bytes")
+                    digest.update(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            if expected is not None and digest.hexdigest() != expected:
+                raise ValueError(f"Content hashes to {digest.hexdigest()}, not {expected}")
+            if digest.hexdigest() not in self._blobs:
+                await asyncio.to_thread(_publish, tmp, self.blob_path(digest.hexdigest()))
+            self._record(digest.hexdigest(), size)
+            return digest.hexdigest()
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def put_file(self, src: Path, digest: str) -> None:
+        """Adopt a fully written file on the cache filesystem as blob `digest`.
+        The file is moved into the cache, or removed if the blob already exists."""
+        self._commit(src, digest, src.stat().st_size)
+
+    def _commit(self, tmp: Path, digest: str, size: int) -> str:
+        if digest not in self._blobs:
+            _publish(tmp, self.blob_path(digest))
+        else:
+            tmp.unlink(missing_ok=True)
+        self._record(digest, size)
+        return digest
+
+    def _record(self, digest: str, size: int) -> None:
+        """Index a blob file now in place, or mark an indexed one recently used."""
+        if digest not in self._blobs:
+            self._blobs[digest] = size
+            self._total_bytes += size
+            self._evict(keep=digest)
+        self._blobs.move_to_end(digest)
+
+    def link_into(self, digest: str, dest: Path) -> None:
+        """Materialize a blob at dest: hardlink, else reflink/copy."""
+        src = self.blob_path(digest)
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(src, dest)
+            return
+        except FileNotFoundError:
+            raise
+        except OSError:
+            pass
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                # copy_file_range shares extents on filesystems that support reflinks
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                copied = -1
+            if copied != size:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+    def forget(self, digest: str) -> None:
+        size = self._blobs.pop(digest, None)
+        if size is not None:
+            self._total_bytes -= size
+        self.blob_path(digest).unlink(missing_ok=True)
+
+    def _evict(self, keep: str | None = None) -> None:
+        while self._total_bytes > self._max_bytes and self._blobs:
+            digest = next(iter(self._blobs))
+            if digest == keep:
+                break
+            self.forget(digest)
+            log.info("Evicted blob %s", digest[:16])
+
+
+def _publish(tmp: Path, blob: Path) -> None:
+    # Blobs are shared via hardlinks; make them read-only so a linked copy
+    # can't be modified in place. Replacing a blob another store published
+    # meanwhile is harmless: the content is the same.
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, blob)
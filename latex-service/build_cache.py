@@ -0,0 +1,97 @@
+"""Persistent per-project build directories reused across compilations.
+
+Keeping a project's work dir between compiles lets latexmk see the previous
+.aux/.toc/.bbl/.fdb_latexmk files and skip passes whose inputs did not change.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+BUILD_CACHE_DIR = Path(os.environ.get("BUILD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-builds")))
+MAX_BUILD_DIRS = int(os.environ.get("MAX_BUILD_DIRS", "32"))
+
+
+class BuildDirStore:
+    """Bounded, LRU-evicted set of build dirs keyed by project id (with a
+    ":draft" suffix for draft builds).
+
+    A dir is leased to one compilation at a time; leased dirs are never evicted.
+    """
+
+    def __init__(self, root: Path = BUILD_CACHE_DIR, max_dirs: int = MAX_BUILD_DIRS) -> None:
+        self._root = root
+        self._max_dirs = max_dirs
+        self._dirs: OrderedDict[str, Path] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._users: dict[str, int] = {}  # holders plus waiters, per project
+
+    def start(self) -> None:
+        # Dirs left by a previous process have no lease bookkeeping; start clean.
+        shutil.rmtree(self._root, ignore_errors=True)
+        self._root.mkdir(parents=True, exist_ok=True)
+
+    async def acquire(self, project_id: str) -> Path:
+        """Lease the project's build dir, creating it if needed. Pair with release()."""
+        lock = self._locks.setdefault(project_id, asyncio.Lock())
+        self._users[project_id] = self._users.get(project_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._drop_user(project_id)
+            raise
+
+        path = self._dirs.get(project_id)
+        if path is None or not path.is_dir():
+            # On disk, not scratch: build dirs live on and grow between compiles
+            path = Path(tempfile.mkdtemp(prefix="build-", dir=self._root))
+            self._dirs[project_id] = path
+            log.info("New build dir for project=%s: %s", project_id, path)
+        self._dirs.move_to_end(project_id)
+        self._evict()
+        return path
+
+    async def try_acquire(self, project_id: str) -> Path | None:
+        """Lease the build dir only if nobody holds it or is waiting for it."""
+        if project_id in self._users:
+            return None
+        return await self.acquire(project_id)  # uncontended, so doesn't wait
+
+    def release(self, project_id: str, discard: bool = False) -> None:
+        """End the lease. With discard=True the dir is deleted (e.g. after a timeout
+        left intermediate files in an unknown state)."""
+        if discard:
+            path = self._dirs.pop(project_id, None)
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+        lock = self._locks.get(project_id)
+        if lock is not None and lock.locked():
+            lock.release()
+            self._drop_user(project_id)
+        self._evict()
+
+    def _drop_user(self, project_id: str) -> None:
+        remaining = self._users.get(project_id, 0) - 1
+        if remaining > 0:
+            self._users[project_id] = remaining
+        else:
+            self._users.pop(project_id, None)
+            if project_id not in self._dirs:
+                self._locks.pop(project_id, None)
+
+    def _evict(self) -> None:
+        for project_id in list(self._dirs):
+            if len(self._dirs) <= self._max_dirs:
+                return
+            if project_id in self._users:
+                continue
+            path = self._dirs.pop(project_id)
+            self._locks.pop(project_id, None)
+            shutil.rmtree(path, ignore_errors=True)
+            log.info("Evicted build dir for project=%s", project_id)
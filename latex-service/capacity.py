@@ -0,0 +1,102 @@
+"""Probe how much CPU and memory this process may actually use.
+
+Container limits (cgroup v2, then v1) take precedence over what the host reports.
+"""
+
+import os
+from pathlib import Path
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+
+def available_cpus() -> float:
+    cpus = float(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(cpus, 1.0)
+
+
+def _cgroup_cpu_quota() -> float | None:
+    try:
+        quota, period = (CGROUP_ROOT / "cpu.max").read_text().split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int((CGROUP_ROOT / "cpu" / "cpu.cfs_quota_us").read_text())
+        period = int((CGROUP_ROOT / "cpu" / "cpu.cfs_period_us").read_text())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def total_memory() -> int:
+    """Memory limit in bytes for this process tree."""
+    limit = _cgroup_memory_file("memory.max", "memory/memory.limit_in_bytes")
+    host = _meminfo("MemTotal")
+    if limit is None or (host is not None and limit > host):
+        return host or 0
+    return limit
+
+
+def available_memory() -> int:
+    """Bytes that can still be allocated before hitting the limit."""
+    limit = _cgroup_memory_file("memory.max", "memory/memory.limit_in_bytes")
+    usage = _cgroup_memory_file("memory.current", "memory/memory.usage_in_bytes")
+    host_available = _meminfo("MemAvailable") or 0
+    if limit is None or usage is None:
+        return host_available
+    return min(max(limit - usage, 0), host_available)
+
+
+def cpu_pressure() -> float | None:
+    """Share of the last 10s in which some of this cgroup's tasks were waiting
+    for CPU (PSI "some avg10", 0-1), or None where PSI isn't available."""
+    try:
+        for line in (CGROUP_ROOT / "cpu.pressure").read_text().splitlines():
+            if line.startswith("some "):
+                fields = dict(field.split("=", 1) for field in line.split()[1:])
+                return float(fields["avg10"]) / 100
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def load_per_cpu() -> float:
+    """Host load average per usable CPU. Counts other containers' work too, so
+    only a fallback for when cpu_pressure() is unavailable."""
+    try:
+        return os.getloadavg()[0] / available_cpus()
+    except OSError:
+        return 0.0
+
+
+def _cgroup_memory_file(v2_name: str, v1_name: str) -> int | None:
+    for path in (CGROUP_ROOT / v2_name, CGROUP_ROOT / v1_name):
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        if value == "max":
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _meminfo(field: str) -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
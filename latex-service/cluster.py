@@ -0,0 +1,130 @@
+"""Cluster membership for running several compile nodes behind a coordinator.
+
+Each worker node publishes a heartbeat with its queue stats to a shared
+registry. The coordinator (see coordinator.py) reads the live nodes from it,
+places them on a consistent-hash ring, and routes every project to the same
+node so its build dir, PDFs and formats stay warm there. When a node joins or
+leaves, only the projects on its arcs of the ring move.
+
+The registry here is a JSON file guarded by flock, which is enough for nodes
+on one host or sharing a volume, and is the local stand-in for a shared store.
+"""
+
+import asyncio
+import bisect
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CLUSTER_STATE_FILE = os.environ.get("CLUSTER_STATE_FILE", "")
+NODE_URL = os.environ.get("NODE_URL", "")  # how the coordinator reaches this worker
+HEARTBEAT_INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "2"))
+NODE_TTL = float(os.environ.get("NODE_TTL", "10"))  # a node missing heartbeats this long is gone
+VIRTUAL_NODES = 160
+
+
+def _point(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: list[str], replicas: int = VIRTUAL_NODES) -> None:
+        self.nodes = sorted(nodes)
+        points = sorted((_point(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def preference(self, key: str) -> list[str]:
+        """Every node, ordered by preference for key: its owner first, then the
+        nodes that would take over if the ones before them left."""
+        if not self._points:
+            return []
+        start = bisect.bisect(self._points, _point(key))
+        order: list[str] = []
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
+
+
+class FileClusterState:
+    """Node registry kept in a JSON file: {node_url: {stats..., "updated": epoch}}."""
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock_path = path.with_name(path.name + ".lock")
+
+    def _locked(self, update: Callable[[dict], None] | None = None) -> dict:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if update else fcntl.LOCK_SH)
+            try:
+                nodes = json.loads(self._path.read_text())
+            except (OSError, ValueError):
+                nodes = {}
+            if update:
+                update(nodes)
+                tmp = self._path.with_name(f".{self._path.name}.{os.getpid()}.tmp")
+                tmp.write_text(json.dumps(nodes))
+                os.replace(tmp, self._path)
+            return nodes
+
+    def publish(self, node: str, stats: dict) -> None:
+        def update(nodes: dict) -> None:
+            nodes[node] = {**stats, "updated": time.time()}
+            # Forget nodes that died without deregistering
+            for name in [n for n, s in nodes.items() if time.time() - s.get("updated", 0) > 10 * NODE_TTL]:
+                del nodes[name]
+
+        self._locked(update)
+
+    def remove(self, node: str) -> None:
+        self._locked(lambda nodes: nodes.pop(node, None))
+
+    def live_nodes(self) -> dict[str, dict]:
+        now = time.time()
+        return {node: stats for node, stats in self._locked().items() if now - stats.get("updated", 0) <= NODE_TTL}
+
+
+class Heartbeat:
+    """Publishes this worker's queue stats to the registry until stopped."""
+
+    def __init__(self, node: str, state: FileClusterState, stats: Callable[[], dict]) -> None:
+        self._node = node
+        self._state = state
+        self._stats = stats
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._state.publish, self._node, self._stats())
+        log.info("Joined cluster as %s", self._node)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Leave right away rather than after NODE_TTL, so projects move on now
+        await asyncio.to_thread(self._state.remove, self._node)
+        log.info("Left cluster")
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self._state.publish, self._node, self._stats())
+            except OSError as e:
+                log.warning("Heartbeat failed: %s", e)
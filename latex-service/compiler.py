@@ -1,59 +1,101 @@
+import asyncio
 import logging
 import re
-import subprocess
+import time
+from collections.abc import Callable, Sequence
 from dataclasses import dataclass
 from pathlib import Path
 
+import artifact_cache
+import deps
+import format_cache
+from runner import ProcessResult, run_process
+
 log = logging.getLogger(__name__)
 
 
 @dataclass
 class CompileResult:
     success: bool
-    pdf_bytes: bytes | None
+    pdf_path: Path | None  # in the work dir until the queue moves it to the PDF cache
     log_tail: str
-
-
-def _fix_flat_file_references(work_path: Path) -> None:
-    """Scan .tex files for references like images/foo.jpg. If the file exists
-    at the root but not at the referenced path, create the subdirectory and
-    symlink it."""
-    root_files = {f.name: f for f in work_path.iterdir() if f.is_file()}
-
-    # Collect all paths referenced in tex files
-    ref_pattern = re.compile(
-        r"\\(?:includegraphics|input|include|bibliography|addbibresource)"
-        r"(?:\[[^\]]*\])?\{([^}]+)\}"
-    )
-    for tex_file in work_path.glob("*.tex"):
-        text = tex_file.read_text(errors="replace")
-        for match in ref_pattern.finditer(text):
-            ref = match.group(1).strip()
-            ref_path = work_path / ref
-            if ref_path.exists():
-                continue
-            # Check if the basename exists at root
-            basename = Path(ref).name
-            if basename in root_files:
-                ref_path.parent.mkdir(parents=True, exist_ok=True)
-                ref_path.symlink_to(root_files[basename])
-                log.info("Symlinked %s -> %s", ref, root_files[basename])
-
-
-def compile_latex(work_dir: str, entrypoint: str, timeout: int, compiler: str = "pdflatex", halt_on_error: bool = False) -> CompileResult:
-    """Run latexmk in work_dir. Must be picklable (runs in ProcessPoolExecutor)."""
+    timed_out: bool = False
+    superseded: bool = False
+    cpu_seconds: float = 0.0  # CPU used by all latexmk runs, 0 if unmeasured
+
+
+MODES = ("final", "draft")
+INCLUDE_NAME = re.compile(r"\w[\w./-]*")
+
+
+def parse_mode(mode: str, include_only: str = "") -> tuple[bool, tuple[str, ...]]:
+    """Validate the mode and comma-separated include_only list of a request.
+    Returns (draft, include_only); raises ValueError."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {', '.join(MODES)}")
+    names = tuple(name.strip() for name in include_only.split(",") if name.strip())
+    if names and mode != "draft":
+        raise ValueError("include_only is only supported in draft mode")
+    for name in names:
+        if not INCLUDE_NAME.fullmatch(name) or ".." in name.split("/"):
+            raise ValueError(f"Invalid include_only name {name!r}")
+    return mode == "draft", names
+
+
+def mode_tag(draft: bool, include_only: Sequence[str]) -> str:
+    """Suffix distinguishing draft outputs in dedup and cache keys; empty for
+    final compiles so their keys are unchanged."""
+    if not draft:
+        return ""
+    return ":draft" + (":" + ",".join(include_only) if include_only else "")
+
+
+async def _run_compile(
+    cmd: list[str],
+    cwd: Path,
+    compiler: str,
+    fmt_name: str | None,
+    deadline: float,
+    on_output: Callable[[str], None] | None,
+) -> ProcessResult:
+    if fmt_name and cmd[0] == "latexmk":
+        # Preload the cached preamble format in every engine run latexmk makes
+        cmd = [cmd[0], f"-{compiler}={compiler} -fmt={fmt_name} %O %S", *cmd[1:]]
+    elif fmt_name:
+        cmd = [cmd[0], f"-fmt={fmt_name}", *cmd[1:]]
+    log.info("Running command: %s", cmd)
+    return await run_process(cmd, cwd, deadline - time.monotonic(), on_output)
+
+
+async def compile_latex(
+    work_dir: str,
+    entrypoint: str,
+    timeout: int,
+    compiler: str = "pdflatex",
+    halt_on_error: bool = False,
+    on_output: Callable[[str], None] | None = None,
+    draft: bool = False,
+    include_only: Sequence[str] = (),
+    graph: deps.DependencyGraph | None = None,
+) -> CompileResult:
+    """Run latexmk in work_dir, passing each output line to on_output as it
+    arrives. Cancelling the call kills the latexmk process group.
+
+    A draft compile is a single engine pass without latexmk, so bibliography
+    and index tools never run; include_only limits it to those \\include files.
+    graph is the project's dependency graph if the caller already has it.
+    """
     work_path = Path(work_dir)
     entrypoint_rel = Path(entrypoint)
     entrypoint_path = work_path / entrypoint_rel
 
-    log.info("compile_latex called: work_dir=%s, entrypoint=%s, timeout=%d, compiler=%s, halt_on_error=%s", work_dir, entrypoint, timeout, compiler, halt_on_error)
-    log.info("Files in work_dir: %s", [str(p.relative_to(work_path)) for p in work_path.rglob("*") if p.is_file()])
+    log.info("compile_latex called: work_dir=%s, entrypoint=%s, timeout=%d, compiler=%s, halt_on_error=%s, draft=%s", work_dir, entrypoint, timeout, compiler, halt_on_error, draft)
 
     if not entrypoint_path.exists():
         log.error("Entrypoint not found: %s", entrypoint_path)
         return CompileResult(
             success=False,
-            pdf_bytes=None,
+            pdf_path=None,
             log_tail=f"Entrypoint not found: {entrypoint}",
         )
 
@@ -67,56 +109,88 @@ def compile_latex(work_dir: str, entrypoint: str, timeout: int, compiler: str =
     compile_cwd = entrypoint_path.parent
     entrypoint_file = entrypoint_path.name
 
-    cmd = [
-        "latexmk",
-        engine_flag,
-        "-interaction=nonstopmode",
-        "-outdir=.",
-        entrypoint_file,
-    ]
+    if draft:
+        # References come from whatever .aux files a warm build dir kept
+        target = entrypoint_file
+        if include_only:
+            target = f"\\includeonly{{{','.join(include_only)}}}\\input{{{entrypoint_file}}}"
+        cmd = [compiler, "-interaction=nonstopmode", f"-jobname={entrypoint_rel.stem}", target]
+    else:
+        cmd = [
+            "latexmk",
+            engine_flag,
+            "-interaction=nonstopmode",
+            "-outdir=.",
+            # Restore .bbl/.ind from earlier compiles with the same inputs
+            *artifact_cache.latexmk_options(),
+            entrypoint_file,
+        ]
     if halt_on_error:
         cmd.insert(-1, "-halt-on-error")
-    log.info("Running command: %s", cmd)
     log.info("Compilation cwd: %s", compile_cwd)
 
     # Files may be stored flat but referenced with subdirectory paths
-    # (e.g. images/foo.jpg). Scan tex files and create missing dirs + symlinks.
-    _fix_flat_file_references(compile_cwd)
+    # (e.g. images/foo.jpg); link them where the source expects them.
+    if graph is None:
+        graph = await asyncio.to_thread(deps.resolve, work_path, entrypoint_rel.as_posix())
+    await asyncio.to_thread(deps.apply_links, work_path, graph)
+
+    # A reused build dir still holds the previous PDF; drop it so a failed run
+    # isn't mistaken for a successful one.
+    pdf_name = entrypoint_rel.stem + ".pdf"
+    pdf_path = compile_cwd / pdf_name
+    pdf_path.unlink(missing_ok=True)
 
+    deadline = time.monotonic() + timeout
+    fmt_name = None
     try:
-        result = subprocess.run(
-            cmd,
-            cwd=compile_cwd,
-            capture_output=True,
-            encoding="utf-8",
-            errors="replace",
-            timeout=timeout,
-        )
-    except subprocess.TimeoutExpired:
+        # A format skips the main file's preamble, which can't be combined
+        # with reading it through \includeonly...\input
+        if not include_only:
+            fmt_name = await format_cache.prepare_format(
+                compiler, compile_cwd, entrypoint_file, deadline - time.monotonic()
+            )
+    except OSError as e:
+        log.warning("Preamble format unavailable: %s", e)
+
+    try:
+        result = await _run_compile(cmd, compile_cwd, compiler, fmt_name, deadline, on_output)
+        cpu_seconds = result.cpu_seconds
+        if fmt_name and not pdf_path.exists():
+            # Fall back to a normal run when the format may be the problem: it
+            # reported a format error, or it has never produced a PDF yet.
+            format_error = format_cache.FORMAT_ERROR_PATTERNS.search(result.output) is not None
+            if format_error or not format_cache.is_verified(fmt_name):
+                log.info("Retrying without preamble format %s", fmt_name)
+                result = await _run_compile(cmd, compile_cwd, compiler, None, deadline, on_output)
+                cpu_seconds += result.cpu_seconds
+                if format_error or pdf_path.exists():
+                    format_cache.invalidate(fmt_name)
+        elif fmt_name:
+            format_cache.mark_verified(fmt_name)
+    except TimeoutError:
         return CompileResult(
             success=False,
-            pdf_bytes=None,
+            pdf_path=None,
             log_tail=f"Compilation timed out after {timeout}s",
+            timed_out=True,
         )
 
-    log.info("latexmk returncode: %d", result.returncode)
-    log.info("latexmk stdout (last 500 chars): %s", result.stdout[-500:] if result.stdout else "(empty)")
-    log.info("latexmk stderr (last 500 chars): %s", result.stderr[-500:] if result.stderr else "(empty)")
-
-    pdf_name = entrypoint_rel.stem + ".pdf"
-    pdf_path = compile_cwd / pdf_name
+    log.info("%s returncode: %d", cmd[0], result.returncode)
+    log.info("%s output (last 500 chars): %s", cmd[0], result.output[-500:] if result.output else "(empty)")
 
     log.info("Looking for PDF at: %s (exists=%s)", pdf_path, pdf_path.exists())
 
     if pdf_path.exists():
         return CompileResult(
             success=True,
-            pdf_bytes=pdf_path.read_bytes(),
+            pdf_path=pdf_path,
             log_tail="",
+            cpu_seconds=cpu_seconds,
         )
 
-    # Collect log tail from the .log file or stdout/stderr
-    log_text = result.stdout + "\n" + result.stderr
+    # Collect log tail from the .log file or latexmk's output
+    log_text = result.output
     log_file = compile_cwd / (entrypoint_rel.stem + ".log")
     if log_file.exists():
         log_text = log_file.read_text(errors="replace")
@@ -124,4 +198,4 @@ def compile_latex(work_dir: str, entrypoint: str, timeout: int, compiler: str =
     log_lines = log_text.strip().splitlines()
     tail = "\n".join(log_lines[-50:])
 
-    return CompileResult(success=False, pdf_bytes=None, log_tail=tail)
+    return CompileResult(success=False, pdf_path=None, log_tail=tail, cpu_seconds=cpu_seconds)
@@ -3,54 +3,181 @@
 import asyncio
 import hashlib
 import json
+import logging
 import os
+import random
+import re
+import threading
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
 from pathlib import Path
+from typing import TypeVar
 
 import httpx
 from convex import ConvexClient
 
+import metrics
+from blob_cache import BlobCache, storage_key
+
+log = logging.getLogger(__name__)
+
 CONVEX_URL = os.environ["CONVEX_URL"]
 CONVEX_DEPLOY_KEY = os.environ["CONVEX_DEPLOY_KEY"]
 
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "8"))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2  # seconds, doubled per attempt, with jitter
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0)
+HTTP2 = os.environ.get("HTTP2", "1") == "1"  # via httpx[http2]
+# The native Convex client reports lost connections as plain Exceptions
+_CONVEX_CONNECTION_ERROR = re.compile(r"connect|websocket|timed? ?out", re.IGNORECASE)
+
+T = TypeVar("T")
+
+# Long-lived clients, opened and closed by the app lifespan (see start/stop)
+_convex: ConvexClient | None = None
+_convex_lock = threading.Lock()
+_http: httpx.AsyncClient | None = None
+_download_slots: asyncio.Semaphore | None = None
+
+
+async def start() -> None:
+    global _http, _download_slots
+    _http = httpx.AsyncClient(http2=HTTP2, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    _download_slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    await asyncio.to_thread(_get_client)
+
+
+async def stop() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """The shared async HTTP client. Callers must not close it."""
+    if _http is None:
+        raise RuntimeError("convex_fetcher.start() has not been called")
+    return _http
+
 
 def _get_client() -> ConvexClient:
-    client = ConvexClient(CONVEX_URL)
-    client.set_admin_auth(CONVEX_DEPLOY_KEY)
-    return client
+    global _convex
+    with _convex_lock:
+        if _convex is None:
+            _convex = ConvexClient(CONVEX_URL)
+            _convex.set_admin_auth(CONVEX_DEPLOY_KEY)
+        return _convex
+
+
+def is_retryable(e: Exception) -> bool:
+    """Only network trouble is worth retrying. Errors from Convex function code
+    (ConvexError or a thrown Error) and local ones (a missing file, bad data)
+    would fail the same way again."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    return type(e) is Exception and _CONVEX_CONNECTION_ERROR.search(str(e)) is not None
+
+
+def _backoff(attempt: int) -> float:
+    return RETRY_BASE_DELAY * 2**attempt * random.uniform(0.5, 1.5)
+
+
+async def with_retries(op: Callable[[], Awaitable[T]]) -> T:
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await op()
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = _backoff(attempt)
+            log.warning("Retrying in %.2fs after: %s", delay, e)
+            await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def _with_retries_sync(op: Callable[[], T]) -> T:
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return op()
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = _backoff(attempt)
+            log.warning("Retrying in %.2fs after: %s", delay, e)
+            time.sleep(delay)
+    raise AssertionError("unreachable")
 
 
 def fetch_project(project_id: str) -> dict:
     """Fetch project metadata and all files from Convex."""
     client = _get_client()
-    return client.query("service:getProjectWithFiles", {"projectId": project_id})
+    return _with_retries_sync(lambda: client.query("service:getProjectWithFiles", {"projectId": project_id}))
 
 
-async def materialize_files(files: list[dict], work_dir: Path) -> str:
-    """Write all project files to work_dir and return the content hash.
+MANIFEST_NAME = ".materialized.json"
 
-    Hash algorithm matches the client-side buildZip:
-      SHA-256 of JSON.stringify([[name, storageUrl_or_content], ...]) sorted by name.
+
+async def materialize_files(files: list[dict], work_dir: Path, blob_cache: BlobCache) -> str:
+    """Write all project files to work_dir and return the content hash (see content_hash).
+
+    work_dir may hold a previous materialization of the same project. A manifest
+    of what was written last time lets us skip files that did not change (keeping
+    their mtimes, so latexmk sees them as untouched) and delete removed ones,
+    while leaving latexmk's generated files in place. Binary files come from the
+    local blob cache and are only downloaded on a cache miss.
     """
     sorted_files = sorted(files, key=lambda f: f["name"])
 
-    # Write text files, collect binary files for async download
+    manifest_path = work_dir / MANIFEST_NAME
+    try:
+        previous = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        previous = {}
+    manifest: dict[str, str] = {}
+
+    # Write changed text files, collect changed binary files for async download
     binary_files = []
     for file in sorted_files:
+        path = work_dir / file["name"]
+        if file.get("storageUrl"):
+            token = file["storageUrl"]
+        else:
+            token = "sha256:" + hashlib.sha256(file["content"].encode("utf-8")).hexdigest()
+        manifest[file["name"]] = token
+        if previous.get(file["name"]) == token and path.is_file():
+            continue
         if file.get("storageUrl"):
             binary_files.append(file)
         else:
-            path = work_dir / file["name"]
             path.parent.mkdir(parents=True, exist_ok=True)
+            # May be a hardlink into the blob cache from an earlier binary version
+            path.unlink(missing_ok=True)
             path.write_text(file["content"], encoding="utf-8")
 
-    # Download binary files concurrently
+    for name in previous.keys() - manifest.keys():
+        (work_dir / name).unlink(missing_ok=True)
+
+    # Link binary files from the blob cache, downloading misses concurrently
     if binary_files:
-        async with httpx.AsyncClient() as http:
-            await asyncio.gather(
-                *[_download_binary(http, file, work_dir / file["name"]) for file in binary_files]
-            )
+        await asyncio.gather(*[_materialize_binary(blob_cache, file, work_dir / file["name"]) for file in binary_files])
+
+    manifest_path.write_text(json.dumps(manifest))
+    return content_hash(files)
 
-    # Compute hash matching client-side buildZip algorithm
+
+def content_hash(files: list[dict]) -> str:
+    """Hash the project files without touching disk or network.
+
+    Hash algorithm matches the client-side buildZip:
+      SHA-256 of JSON.stringify([[name, storageUrl_or_content], ...]) sorted by name.
+    """
+    sorted_files = sorted(files, key=lambda f: f["name"])
     hash_input = []
     for file in sorted_files:
         if file.get("storageUrl"):
@@ -63,37 +190,69 @@ async def materialize_files(files: list[dict], work_dir: Path) -> str:
     return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 
-async def _download_binary(http: httpx.AsyncClient, file: dict, path: Path) -> None:
+async def _fetch_blob(blob_cache: BlobCache, url: str) -> str:
+    if blob_cache.lookup(storage_key(url)) is None:
+        metrics.CACHE_LOOKUPS.inc("blob", "miss")
+        # Only downloads take a slot; cache hits never wait
+        async with _download_slots:
+            with metrics.timed("download"):
+                return await with_retries(lambda: blob_cache.fetch(http_client(), url))
+    metrics.CACHE_LOOKUPS.inc("blob", "hit")
+    return await blob_cache.fetch(http_client(), url)
+
+
+async def _materialize_binary(blob_cache: BlobCache, file: dict, path: Path) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
-    response = await http.get(file["storageUrl"])
-    response.raise_for_status()
-    path.write_bytes(response.content)
+    digest = await _fetch_blob(blob_cache, file["storageUrl"])
+    try:
+        blob_cache.link_into(digest, path)
+    except FileNotFoundError:
+        # Evicted between lookup and link; fetch it again
+        blob_cache.forget(digest)
+        digest = await _fetch_blob(blob_cache, file["storageUrl"])
+        blob_cache.link_into(digest, path)
 
 
 def check_cache(project_id: str, zip_hash: str) -> dict | None:
     """Check if a compilation result is cached in Convex. Returns {pdfUrl} or None."""
     client = _get_client()
-    return client.query(
-        "service:getCompilationByHash",
-        {"projectId": project_id, "zipHash": zip_hash},
+    return _with_retries_sync(
+        lambda: client.query(
+            "service:getCompilationByHash",
+            {"projectId": project_id, "zipHash": zip_hash},
+        )
     )
 
 
-def upload_and_cache(pdf_bytes: bytes, project_id: str, zip_hash: str) -> None:
-    """Upload PDF to Convex storage and save the compilation record."""
+async def upload_pdf(pdf_path: Path) -> str:
+    """Upload a PDF to Convex storage and return its storage id. A single
+    attempt: the upload queue retries, and keeps the id if only
+    save_compilation failed."""
     client = _get_client()
-    upload_url = client.mutation("service:generateUploadUrl", {})
+    upload_url = await asyncio.to_thread(client.mutation, "service:generateUploadUrl", {})
+    response = await http_client().post(
+        upload_url,
+        content=_read_chunks(pdf_path),
+        headers={"Content-Type": "application/pdf", "Content-Length": str(pdf_path.stat().st_size)},
+    )
+    response.raise_for_status()
+    return response.json()["storageId"]
 
-    with httpx.Client() as http:
-        upload_res = http.post(
-            upload_url,
-            content=pdf_bytes,
-            headers={"Content-Type": "application/pdf"},
-        )
-        upload_res.raise_for_status()
-        storage_id = upload_res.json()["storageId"]
 
-    client.mutation(
+async def save_compilation(project_id: str, zip_hash: str, storage_id: str) -> None:
+    """Record an uploaded PDF as the project's compilation for zip_hash."""
+    client = _get_client()
+    await asyncio.to_thread(
+        client.mutation,
         "service:saveCompilation",
         {"projectId": project_id, "zipHash": zip_hash, "storageId": storage_id},
     )
+
+
+async def _read_chunks(path: Path) -> AsyncIterator[bytes]:
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE):
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,341 @@
+"""Coordinator mode: one entry point in front of several compile nodes.
+
+    CLUSTER_STATE_FILE=/shared/cluster.json uvicorn coordinator:app
+
+Workers are the usual main:app started with NODE_URL and the same
+CLUSTER_STATE_FILE, so they announce themselves (see cluster.py). Requests are
+forwarded as they are, Authorization included:
+
+- /compile-project goes to the node owning the project on the hash ring, so
+  repeat compiles of a project hit its warm build dir and caches. When the
+  owner's estimated wait passes SPILL_WAIT and a nearby node on the ring is
+  much less busy, the compile spills there instead. /prefetch-project goes
+  to the owner and never spills.
+- /manifest, /blobs and /compile-manifest are keyed by client, since a delta
+  upload only works against the node holding its blobs.
+- /compile has no affinity and goes to the least busy node.
+- /jobs and /results go to the node that created the job or result.
+
+A node that refuses connections is skipped until its heartbeat expires, and
+its projects fall to the next node on the ring.
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+import cluster
+import metrics
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+log = logging.getLogger(__name__)
+
+API_SECRET = os.environ.get("LATEX_API_SECRET", "")
+if not API_SECRET:
+    raise RuntimeError("LATEX_API_SECRET env var must be set")
+if not cluster.CLUSTER_STATE_FILE:
+    raise RuntimeError("CLUSTER_STATE_FILE env var must be set")
+
+ALLOWED_ORIGIN = os.environ.get("ALLOWED_ORIGIN", "https://betterleaf.micwilk.com")
+
+SPILL_WAIT = float(os.environ.get("SPILL_WAIT", "15"))  # owner's estimated wait, in seconds, before spilling
+SPILL_CANDIDATES = 2  # how far along the ring a spilled project may go
+REFRESH_INTERVAL = 1.0
+MAX_AFFINITIES = 50_000
+DISCONNECT_POLL_INTERVAL = 1.0
+PROXY_CHUNK_SIZE = 256 * 1024
+# Compiles hold the request open for as long as they queue and run
+HTTP_TIMEOUT = httpx.Timeout(None, connect=5.0, write=60.0)
+HTTP_LIMITS = httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=60.0)
+
+# Not forwarded in either direction
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "upgrade", "host", "content-length"}
+
+
+class Coordinator:
+    """Live nodes, the ring over them, and which node holds which job or result."""
+
+    def __init__(self, state: cluster.FileClusterState) -> None:
+        self._state = state
+        self._nodes: dict[str, dict] = {}
+        self._ring = cluster.HashRing([])
+        self._refreshed = 0.0
+        # Requests sent since the node's last heartbeat, which its stats don't show yet
+        self._routed: dict[str, int] = {}
+        self._down: dict[str, float] = {}
+        self._affinity: OrderedDict[str, str] = OrderedDict()
+
+    async def refresh(self) -> None:
+        if time.monotonic() - self._refreshed < REFRESH_INTERVAL:
+            return
+        self._refreshed = time.monotonic()
+        nodes = await asyncio.to_thread(self._state.live_nodes)
+        # A node joins the ring once its warm-up is done, unless none are warm yet
+        warm = {node: stats for node, stats in nodes.items() if stats.get("ready", True)}
+        nodes = warm or nodes
+        if set(nodes) != set(self._nodes):
+            log.info(
+                "Cluster changed: joined=%s left=%s, %d node(s)",
+                sorted(set(nodes) - set(self._nodes)), sorted(set(self._nodes) - set(nodes)), len(nodes),
+            )
+            self._ring = cluster.HashRing(list(nodes))
+        for node, stats in nodes.items():
+            if stats.get("updated") != self._nodes.get(node, {}).get("updated"):
+                self._routed[node] = 0
+                # A fresh heartbeat means it's up again
+                self._down.pop(node, None)
+        self._nodes = nodes
+
+    def _usable(self, node: str) -> bool:
+        failed = self._down.get(node)
+        return failed is None or time.monotonic() - failed > cluster.NODE_TTL
+
+    def wait(self, node: str) -> float:
+        """The node's estimated queue wait, counting what was sent since it reported it."""
+        stats = self._nodes.get(node, {})
+        per_job = stats.get("mean_job_seconds", 0.0) / max(stats.get("concurrency_limit", 1), 1)
+        return stats.get("estimated_wait", 0.0) + self._routed.get(node, 0) * per_job
+
+    def for_key(self, key: str, spill: bool = False) -> tuple[list[str], bool]:
+        """Nodes to try for key, best first, and whether the first is a spill."""
+        order = [node for node in self._ring.preference(key) if self._usable(node)]
+        if spill and len(order) > 1:
+            owner_wait = self.wait(order[0])
+            if owner_wait > SPILL_WAIT:
+                best = min(order[1:1 + SPILL_CANDIDATES], key=self.wait)
+                if self.wait(best) < owner_wait / 2:
+                    order.remove(best)
+                    order.insert(0, best)
+                    return order, True
+        return order, False
+
+    def least_busy(self) -> list[str]:
+        return sorted((node for node in self._nodes if self._usable(node)), key=self.wait)
+
+    def holder(self, resource_id: str) -> list[str]:
+        """The node known to hold a job or result; otherwise every node, to ask in turn."""
+        node = self._affinity.get(resource_id)
+        if node is not None and self._usable(node):
+            return [node]
+        return self.least_busy()
+
+    def remember(self, resource_id: str, node: str) -> None:
+        self._affinity[resource_id] = node
+        self._affinity.move_to_end(resource_id)
+        while len(self._affinity) > MAX_AFFINITIES:
+            self._affinity.popitem(last=False)
+
+    def sent(self, node: str) -> None:
+        self._routed[node] = self._routed.get(node, 0) + 1
+
+    def failed(self, node: str) -> None:
+        log.warning("Node %s unreachable, routing around it", node)
+        self._down[node] = time.monotonic()
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            node: {**stats, "effective_wait": round(self.wait(node), 2), "reachable": self._usable(node)}
+            for node, stats in sorted(self._nodes.items())
+        }
+
+
+coordinator = Coordinator(cluster.FileClusterState(Path(cluster.CLUSTER_STATE_FILE)))
+_http: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _http
+    _http = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    await coordinator.refresh()
+    yield
+    await _http.aclose()
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=[ALLOWED_ORIGIN],
+    allow_methods=["GET", "POST", "PUT"],
+    allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["X-Result-Id", "X-Served-By"],
+)
+
+
+@app.middleware("http")
+async def log_and_auth(request: Request, call_next):
+    # Workers check Authorization too; checking here keeps junk off them
+    if request.url.path != "/health":
+        auth = request.headers.get("Authorization", "")
+        if not secrets.compare_digest(auth, f"Bearer {API_SECRET}"):
+            return JSONResponse(status_code=401, content={"error": "unauthorized"})
+    await coordinator.refresh()
+    response = await call_next(request)
+    log.info("Response status: %d for %s %s", response.status_code, request.method, request.url.path)
+    return response
+
+
+def _no_nodes_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": "no_nodes", "detail": "No compile nodes available"},
+        headers={"Retry-After": str(max(1, round(cluster.HEARTBEAT_INTERVAL)))},
+    )
+
+
+def _forward_headers(request: Request, streamed: bool) -> dict[str, str]:
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS}
+    if streamed and "Content-Length" in request.headers:
+        # Pass the upload through as sent rather than re-chunked
+        headers["Content-Length"] = request.headers["Content-Length"]
+    # Workers run with --proxy-headers, so per-client fair queueing keeps
+    # seeing the real client rather than the coordinator
+    peer = request.client.host if request.client else ""
+    forwarded = request.headers.get("X-Forwarded-For")
+    headers["X-Forwarded-For"] = f"{forwarded}, {peer}" if forwarded else peer
+    return headers
+
+
+async def _send(request: Request, upstream: httpx.Request) -> httpx.Response | None:
+    """Send upstream, giving up (and so dropping the connection, which the
+    node notices) if the client goes away while the node is still working."""
+    send = asyncio.ensure_future(_http.send(upstream, stream=True))
+    while True:
+        done, _ = await asyncio.wait({send}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return send.result()
+        if await request.is_disconnected():
+            send.cancel()
+            return None
+
+
+async def _forward(
+    request: Request, nodes: list[str], reason: str, body: bytes | None = None, try_all_on_404: bool = False
+) -> Response:
+    """Forward the request to the first node that takes it. Only a buffered
+    body can be replayed to the next node after a connection failure."""
+    if not nodes:
+        return _no_nodes_response()
+    content = body if body is not None else request.stream()
+    for i, node in enumerate(nodes):
+        upstream_request = _http.build_request(
+            request.method,
+            node.rstrip("/") + request.url.path,
+            params=request.query_params,
+            headers=_forward_headers(request, streamed=body is None),
+            content=content,
+        )
+        if request.url.path.startswith("/compile"):
+            coordinator.sent(node)
+        try:
+            upstream = await _send(request, upstream_request)
+        except httpx.TransportError as e:
+            if isinstance(e, httpx.ConnectError):
+                coordinator.failed(node)
+            if body is None or i == len(nodes) - 1:
+                return JSONResponse(status_code=502, content={"error": "node_unavailable", "detail": str(e)})
+            reason = "failover"
+            continue
+        if upstream is None:
+            return Response(status_code=499)
+        if upstream.status_code == 404 and try_all_on_404 and i < len(nodes) - 1:
+            await upstream.aclose()
+            continue
+        metrics.CLUSTER_ROUTES.inc(node, reason)
+        return _relay(upstream, node)
+    return _no_nodes_response()
+
+
+def _relay(upstream: httpx.Response, node: str) -> StreamingResponse:
+    if upstream.status_code == 202 and upstream.headers.get("Location", "").startswith("/jobs/"):
+        coordinator.remember(upstream.headers["Location"].removeprefix("/jobs/"), node)
+    if "X-Result-Id" in upstream.headers:
+        coordinator.remember(upstream.headers["X-Result-Id"], node)
+
+    async def body():
+        try:
+            async for chunk in upstream.aiter_raw(PROXY_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS - {"content-length"}}
+    headers["X-Served-By"] = node
+    return StreamingResponse(body(), status_code=upstream.status_code, headers=headers)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "nodes": coordinator.stats()}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    metrics.CLUSTER_NODES.set(len(coordinator.least_busy()))
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/compile-project")
+async def compile_project(request: Request):
+    body = await request.body()
+    project_id = (await request.form()).get("project_id")
+    if not isinstance(project_id, str) or not project_id:
+        # The node would reject it too; any node can say so
+        return await _forward(request, coordinator.least_busy(), "any", body)
+    nodes, spilled = coordinator.for_key(f"project:{project_id}", spill=True)
+    if spilled:
+        log.info("Spilling project %s to %s", project_id, nodes[0])
+    return await _forward(request, nodes, "spill" if spilled else "owner", body)
+
+
+@app.post("/prefetch-project")
+async def prefetch_project(request: Request):
+    # Warms the owner only; a spill node wouldn't see the project's next compile
+    body = await request.body()
+    project_id = (await request.form()).get("project_id")
+    if not isinstance(project_id, str) or not project_id:
+        return await _forward(request, coordinator.least_busy(), "any", body)
+    nodes, _ = coordinator.for_key(f"project:{project_id}")
+    return await _forward(request, nodes, "owner", body)
+
+
+@app.post("/compile")
+async def compile(request: Request):
+    # Uploads can be large, so they are streamed through and not retried
+    return await _forward(request, coordinator.least_busy()[:1], "least_busy")
+
+
+@app.post("/manifest")
+@app.post("/compile-manifest")
+async def client_keyed(request: Request):
+    body = await request.body()
+    nodes, _ = coordinator.for_key(f"client:{request.client.host if request.client else ''}")
+    return await _forward(request, nodes, "owner", body)
+
+
+@app.put("/blobs/{digest}")
+async def put_blob(request: Request, digest: str):
+    nodes, _ = coordinator.for_key(f"client:{request.client.host if request.client else ''}")
+    return await _forward(request, nodes[:1], "owner")
+
+
+@app.get("/jobs/{job_id}")
+@app.get("/jobs/{job_id}/{rest:path}")
+async def job(request: Request, job_id: str, rest: str = ""):
+    return await _forward(request, coordinator.holder(job_id), "holder", b"", try_all_on_404=True)
+
+
+@app.get("/results/{result_id}/{rest:path}")
+async def result(request: Request, result_id: str, rest: str):
+    return await _forward(request, coordinator.holder(result_id), "holder", b"", try_all_on_404=True)
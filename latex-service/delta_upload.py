@@ -0,0 +1,90 @@
+"""Manifest-based uploads for /compile.
+
+Instead of a zip of the whole project the client sends a manifest of
+(path, sha256, size) entries. The service answers with the hashes missing from
+its blob cache, the client PUTs only those, and the compile assembles the tree
+from the cache by hardlinking each blob into a fresh work dir.
+"""
+
+import hashlib
+import json
+import re
+from pathlib import Path, PurePosixPath
+
+from pydantic import BaseModel, Field
+
+from blob_cache import BlobCache
+from zip_safety import MAX_FILE_COUNT, MAX_UNCOMPRESSED_SIZE, ZipSafetyError, check_path
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ManifestEntry(BaseModel):
+    path: str = Field(min_length=1)
+    sha256: str = Field(pattern=DIGEST_PATTERN.pattern)
+    size: int = Field(ge=0)
+
+
+class Manifest(BaseModel):
+    files: list[ManifestEntry]
+
+
+class ManifestCompile(Manifest):
+    entrypoint: str
+    timeout: int | None = None
+    compiler: str = "pdflatex"
+    halt_on_error: bool = False
+    mode: str = "final"
+    include_only: str = ""
+
+
+def validate(manifest: Manifest) -> None:
+    """Apply the same limits an uploaded zip is held to."""
+    if len(manifest.files) > MAX_FILE_COUNT:
+        raise ZipSafetyError(f"Too many files: {len(manifest.files)} exceeds limit {MAX_FILE_COUNT}")
+    total = sum(entry.size for entry in manifest.files)
+    if total > MAX_UNCOMPRESSED_SIZE:
+        raise ZipSafetyError(f"Uncompressed size {total} exceeds limit {MAX_UNCOMPRESSED_SIZE}")
+    files: set[str] = set()
+    dirs: set[str] = set()
+    for entry in manifest.files:
+        check_path(entry.path)
+        path = PurePosixPath(entry.path)
+        if str(path) in files:
+            raise ZipSafetyError(f"Duplicate path in manifest: {entry.path}")
+        files.add(str(path))
+        dirs.update(str(parent) for parent in path.parents)
+    # "a" and "a/b" can't both be materialized
+    clashes = files & dirs
+    if clashes:
+        raise ZipSafetyError(f"Path is both a file and a directory in manifest: {min(clashes)}")
+
+
+def missing_blobs(manifest: Manifest, blob_cache: BlobCache) -> list[str]:
+    """Hashes the client still has to upload. Cached ones are marked recently
+    used so they survive until the compile that follows."""
+    missing = {entry.sha256 for entry in manifest.files if not blob_cache.touch(entry.sha256)}
+    return sorted(missing)
+
+
+def check_sizes(manifest: Manifest, blob_cache: BlobCache) -> None:
+    """Hold each entry to the size of the blob actually stored, since the
+    limits in validate() are checked against the declared sizes."""
+    for entry in manifest.files:
+        size = blob_cache.size(entry.sha256)
+        if size is not None and size != entry.size:
+            raise ZipSafetyError(f"{entry.path} is {size} bytes, not the declared {entry.size}")
+
+
+def manifest_hash(manifest: Manifest) -> str:
+    entries = sorted([entry.path, entry.sha256] for entry in manifest.files)
+    return hashlib.sha256(json.dumps(entries, separators=(",", ":")).encode()).hexdigest()
+
+
+def assemble(manifest: Manifest, blob_cache: BlobCache, work_dir: Path) -> None:
+    """Link every manifest entry into work_dir. Raises FileNotFoundError if a
+    blob was evicted since missing_blobs() was answered."""
+    for entry in manifest.files:
+        path = work_dir / entry.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        blob_cache.link_into(entry.sha256, path)
@@ -0,0 +1,234 @@
+"""Dependency graph of a LaTeX project, followed from its entrypoint.
+
+Editors often store files flat while the source refers to them with folders
+(images/foo.png), and \\includegraphics usually omits the extension. The graph
+records which project files each reference resolves to, and the symlinks that
+make the flat ones reachable under the referenced path.
+
+It also yields a dependency hash: a hash of only the files a compile can read.
+Two versions of a project that differ only in .tex files the entrypoint never
+reaches (an unused chapter, a scratch file) share a dependency hash, so the
+earlier PDF can be reused. Packages read files through commands we don't
+parse, so an unreached .tex file still counts if any reached source mentions
+its name.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import posixpath
+import re
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+MAX_CACHED_GRAPHS = int(os.environ.get("MAX_CACHED_GRAPHS", "256"))
+
+TEX_EXTENSIONS = (".tex",)
+# What pdflatex/xelatex try, in order, for \includegraphics without an extension
+GRAPHICS_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".eps", ".mps", ".jbig2", ".jb2", ".PDF", ".PNG", ".JPG", ".JPEG")
+
+_COMMENT = re.compile(r"(?<!\\)%.*")
+_OPTIONS = r"\*?\s*(?:\[[^\]]*\]\s*)*"
+_REFERENCE = re.compile(
+    r"\\(input|include|subfile|InputIfFileExists|includegraphics|includepdf|includesvg|lstinputlisting"
+    r"|verbatiminput|bibliography|addbibresource|bibliographystyle|usepackage|RequirePackage|documentclass"
+    r"|includestandalone|loadglsentries)"
+    + _OPTIONS + r"\{([^}]*)\}"
+)
+# Plain TeX \input: the file name ends at a space or control sequence
+_BARE_INPUT = re.compile(r"\\input(?:\s+|(?=\\))(\\|[^\s{}\\]+)")
+_IMPORT = re.compile(r"\\(?:sub)?(?:import|inputfrom|includefrom)\*?\s*\{([^}]*)\}\s*\{([^}]*)\}")
+_GRAPHICSPATH = re.compile(r"\\graphicspath\s*\{((?:\s*\{[^}]*\})+)\s*\}")
+
+# command -> (extensions to try, whether the file is TeX source to follow)
+_KINDS: dict[str, tuple[tuple[str, ...], bool]] = {
+    "input": (TEX_EXTENSIONS + ("",), True),
+    "include": (TEX_EXTENSIONS, True),
+    "subfile": (TEX_EXTENSIONS + ("",), True),
+    "InputIfFileExists": (TEX_EXTENSIONS + ("",), True),
+    "includegraphics": (("",) + GRAPHICS_EXTENSIONS, False),
+    "includepdf": (("", ".pdf"), False),
+    "includesvg": (("", ".svg"), False),
+    "lstinputlisting": (("",), False),
+    "verbatiminput": (("",), False),
+    "bibliography": ((".bib",), False),
+    "addbibresource": (("",), False),
+    "bibliographystyle": ((".bst",), False),
+    "usepackage": ((".sty",), True),
+    "RequirePackage": ((".sty",), True),
+    "documentclass": ((".cls",), True),
+    "includestandalone": (TEX_EXTENSIONS + ("",), True),
+    "loadglsentries": (TEX_EXTENSIONS + ("",), True),
+}
+# Package and class names mostly refer to the TeX distribution, not the project
+_OPTIONAL = {"usepackage", "RequirePackage", "documentclass", "bibliographystyle"}
+_LIST_COMMANDS = {"bibliography", "usepackage", "RequirePackage"}
+
+
+@dataclass
+class DependencyGraph:
+    files: set[str] = field(default_factory=set)  # project files the compile reads
+    links: dict[str, str] = field(default_factory=dict)  # referenced path -> project file
+    missing: list[str] = field(default_factory=list)
+    complete: bool = True  # every reference was literal and resolved
+    dependency_hash: str | None = None  # set when complete
+
+
+def _strip_comments(text: str) -> str:
+    return "\n".join(_COMMENT.sub("", line) for line in text.splitlines())
+
+
+class _Resolver:
+    def __init__(self, work_dir: Path, entrypoint: str, sources: set[str]) -> None:
+        self.work_dir = work_dir
+        self.cwd = posixpath.dirname(entrypoint)  # TeX resolves paths from here, not the including file
+        self.sources = sources
+        self.by_name: dict[str, list[str]] = {}
+        for name in sorted(sources, key=lambda n: (n.count("/"), n)):
+            self.by_name.setdefault(posixpath.basename(name), []).append(name)
+        self.graph = DependencyGraph()
+        self.graphics_paths = [""]
+        self.texts: list[str] = []  # comment-stripped sources followed so far
+
+    def _find(self, ref: str, extensions: tuple[str, ...], prefixes: list[str]) -> tuple[str, str | None] | None:
+        """(path as referenced, project file providing it) for the first candidate
+        TeX would find, or None."""
+        for prefix in prefixes:
+            for ext in extensions:
+                wanted = posixpath.normpath(posixpath.join(self.cwd, prefix + ref + ext))
+                if wanted in self.sources:
+                    return wanted, None
+        # Not where TeX looks: fall back to a flat copy with the same file name
+        for prefix in prefixes:
+            for ext in extensions:
+                wanted = posixpath.normpath(posixpath.join(self.cwd, prefix + ref + ext))
+                candidates = self.by_name.get(posixpath.basename(wanted))
+                if candidates:
+                    return wanted, candidates[0]
+        return None
+
+    def visit(self, name: str) -> None:
+        if name in self.graph.files:
+            return
+        self.graph.files.add(name)
+        try:
+            text = (self.work_dir / name).read_text(errors="replace")
+        except OSError:
+            return
+        text = _strip_comments(text)
+        self.texts.append(text)
+
+        for match in _GRAPHICSPATH.finditer(text):
+            self.graphics_paths.extend(re.findall(r"\{([^}]*)\}", match.group(1)))
+
+        references = [(m.group(1), m.group(2)) for m in _REFERENCE.finditer(text)]
+        references.extend(("input", directory.rstrip("/") + "/" + file) for directory, file in _IMPORT.findall(text))
+        references.extend(("input", name) for name in _BARE_INPUT.findall(text))
+        for command, argument in references:
+            refs = argument.split(",") if command in _LIST_COMMANDS else [argument]
+            for ref in refs:
+                self.reference(command, ref.strip())
+
+    def reference(self, command: str, ref: str) -> None:
+        if not ref:
+            return
+        if "\\" in ref or "#" in ref:
+            # Built by a macro; we can't tell which file it names
+            self.graph.complete = False
+            return
+        extensions, follow = _KINDS[command]
+        prefixes = self.graphics_paths if command == "includegraphics" else [""]
+        found = self._find(ref, extensions, prefixes)
+        if found is None:
+            if command not in _OPTIONAL:
+                self.graph.missing.append(ref)
+                self.graph.complete = False
+            return
+        wanted, target = found
+        if target is not None:
+            self.graph.links[wanted] = target
+        source = target or wanted
+        if follow:
+            self.visit(source)
+        else:
+            self.graph.files.add(source)
+
+
+def resolve(work_dir: Path, entrypoint: str, sources: Iterable[str] | None = None) -> DependencyGraph:
+    """Follow references from entrypoint (relative to work_dir). sources are the
+    project's files; without them, every regular file in work_dir counts."""
+    if sources is None:
+        sources = (
+            str(path.relative_to(work_dir))
+            for path in work_dir.rglob("*")
+            if path.is_file() and not path.is_symlink()
+        )
+    resolver = _Resolver(work_dir, entrypoint, set(sources))
+    resolver.visit(entrypoint)
+    graph = resolver.graph
+    if graph.missing:
+        log.info("Unresolved references from %s: %s", entrypoint, graph.missing[:20])
+    if graph.complete:
+        graph.dependency_hash = _dependency_hash(work_dir, entrypoint, resolver.sources, graph, resolver.texts)
+    return graph
+
+
+def _dependency_hash(
+    work_dir: Path, entrypoint: str, sources: set[str], graph: DependencyGraph, texts: list[str]
+) -> str:
+    """Hash of the files a compile may read. Unreached .tex files are left out
+    unless a reached source mentions their name; anything else (images, data
+    files, styles) can also be loaded by commands we don't parse, such as TikZ
+    or pgfplots, so it always counts."""
+    digest = hashlib.sha256(entrypoint.encode())
+    for name in sorted(sources):
+        if name not in graph.files and name.endswith(TEX_EXTENSIONS):
+            stem = posixpath.basename(name).removesuffix(".tex")
+            if not any(stem in text for text in texts):
+                continue
+        digest.update(b"\0" + name.encode() + b"\0")
+        digest.update(hashlib.sha256((work_dir / name).read_bytes()).digest())
+    for link, target in sorted(graph.links.items()):
+        digest.update(f"\0{link}->{target}".encode())
+    return digest.hexdigest()
+
+
+def apply_links(work_dir: Path, graph: DependencyGraph) -> None:
+    """Create the graph's symlinks in work_dir, replacing stale ones from an
+    earlier compile of a reused build dir."""
+    for link, target in graph.links.items():
+        path = work_dir / link
+        if path.is_symlink():
+            path.unlink()
+        elif path.exists():
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(os.path.relpath(work_dir / target, path.parent))
+        log.info("Symlinked %s -> %s", link, target)
+
+
+class DependencyCache:
+    """Graphs by project content key. The same content always yields the same
+    graph, so only the first compile of a version pays for the scan."""
+
+    def __init__(self, max_entries: int = MAX_CACHED_GRAPHS) -> None:
+        self._max_entries = max_entries
+        self._graphs: OrderedDict[str, DependencyGraph] = OrderedDict()
+
+    async def resolve(
+        self, key: str, work_dir: Path, entrypoint: str, sources: Iterable[str] | None = None
+    ) -> DependencyGraph:
+        graph = self._graphs.get(key)
+        if graph is not None:
+            self._graphs.move_to_end(key)
+            return graph
+        graph = await asyncio.to_thread(resolve, work_dir, entrypoint, sources)
+        self._graphs[key] = graph
+        while len(self._graphs) > self._max_entries:
+            self._graphs.popitem(last=False)
+        return graph
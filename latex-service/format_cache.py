@@ -0,0 +1,192 @@
+"""Cache of precompiled preamble formats (mylatexformat-style .fmt dumps).
+
+Loading a heavy preamble (tikz, biblatex, ...) dominates short compiles. We dump
+the entrypoint's preamble into a custom format once and run later compiles with
+`-fmt`, which skips straight to \\begin{document}.
+
+All state lives on disk, so formats survive restarts.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from runner import run_process
+
+log = logging.getLogger(__name__)
+
+FORMAT_CACHE_DIR = Path(os.environ.get("FORMAT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-formats")))
+FORMAT_CACHE_MAX_BYTES = int(os.environ.get("FORMAT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+FORMAT_FAILURE_TTL = 24 * 3600  # don't retry a preamble that failed to dump for a day
+FORMAT_BUILD_TIMEOUT = 30
+
+# LuaTeX can't dump Lua state (luaotfload, fontspec callbacks), so lualatex always
+# runs with its stock format.
+FORMAT_ENGINES = ("pdflatex", "xelatex")
+
+# Local support files a preamble may load; any change must rebuild the format.
+_SUPPORT_SUFFIXES = {".sty", ".cls", ".cfg", ".def", ".clo", ".fd"}
+_PREAMBLE_INPUT = re.compile(r"\\(?:input|include)\s*\{([^}]+)\}")
+
+_BEGIN_DOCUMENT = re.compile(r"\\begin\s*\{document\}")
+_END_OF_DUMP = re.compile(r"\\endofdump\b|\\csname\s+endofdump\s*\\endcsname")
+
+# Log lines meaning the format itself (not the document) is unusable.
+FORMAT_ERROR_PATTERNS = re.compile(
+    r"Fatal format file error|I can't find the format file|"
+    r"made by different executable version|---! .* was written by"
+)
+
+
+def extract_preamble(tex_source: str) -> str | None:
+    """Return the part of the source a mylatexformat dump would capture, or None
+    if there is no \\begin{document} to stop at."""
+    end = _BEGIN_DOCUMENT.search(tex_source)
+    if end is None:
+        return None
+    preamble = tex_source[: end.start()]
+    dump_end = _END_OF_DUMP.search(preamble)
+    if dump_end is not None:
+        preamble = preamble[: dump_end.start()]
+    return preamble
+
+
+def format_key(compiler: str, preamble: str, compile_cwd: Path) -> str:
+    digest = hashlib.sha256()
+    digest.update(compiler.encode())
+    engine_path = shutil.which(compiler)
+    if engine_path:
+        # A TeX Live update replaces the binary and invalidates old dumps
+        digest.update(str(os.stat(engine_path).st_mtime_ns).encode())
+    digest.update(b"\0" + preamble.encode("utf-8"))
+    inputs = set()
+    for ref in _PREAMBLE_INPUT.findall(preamble):
+        ref = ref.strip()
+        inputs.update({ref, ref + ".tex"})
+    for path in sorted(compile_cwd.rglob("*")):
+        rel = str(path.relative_to(compile_cwd))
+        if (path.suffix in _SUPPORT_SUFFIXES or rel in inputs) and path.is_file():
+            digest.update(b"\0" + rel.encode() + b"\0")
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _fmt_name(key: str) -> str:
+    return f"preamble-{key[:24]}"
+
+
+async def prepare_format(compiler: str, compile_cwd: Path, entrypoint_file: str, timeout: float) -> str | None:
+    """Make a cached format for the entrypoint's preamble available in compile_cwd,
+    building it on a miss. Returns the name to pass as -fmt, or None to run normally."""
+    if compiler not in FORMAT_ENGINES:
+        return None
+    source = (compile_cwd / entrypoint_file).read_text(errors="replace")
+    preamble = extract_preamble(source)
+    if preamble is None:
+        return None
+
+    key = await asyncio.to_thread(format_key, compiler, preamble, compile_cwd)
+    name = _fmt_name(key)
+    FORMAT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cached = FORMAT_CACHE_DIR / f"{name}.fmt"
+    failed_marker = FORMAT_CACHE_DIR / f"{name}.failed"
+
+    if failed_marker.exists():
+        if time.time() - failed_marker.stat().st_mtime < FORMAT_FAILURE_TTL:
+            return None
+        failed_marker.unlink(missing_ok=True)
+
+    if not cached.exists() and not await _build_format(compiler, compile_cwd, entrypoint_file, name, min(timeout, FORMAT_BUILD_TIMEOUT)):
+        failed_marker.touch()
+        return None
+
+    local = compile_cwd / f"{name}.fmt"
+    local.unlink(missing_ok=True)
+    try:
+        os.link(cached, local)
+        os.utime(cached)  # LRU by mtime
+    except FileNotFoundError:
+        return None  # evicted by another worker in the meantime
+    except OSError:
+        shutil.copyfile(cached, local)
+    return name
+
+
+async def _build_format(compiler: str, compile_cwd: Path, entrypoint_file: str, name: str, timeout: float) -> bool:
+    cmd = [
+        compiler,
+        "-ini",
+        "-interaction=nonstopmode",
+        f"-jobname={name}",
+        f"&{compiler}",
+        "mylatexformat.ltx",
+        entrypoint_file,
+    ]
+    log.info("Building preamble format: %s", cmd)
+    started = time.monotonic()
+    try:
+        result = await run_process(cmd, compile_cwd, timeout)
+    except (TimeoutError, OSError) as e:
+        log.warning("Format build failed for %s: %s", name, e)
+        return False
+    except asyncio.CancelledError:
+        # Superseded or abandoned; run_process killed the build
+        (compile_cwd / f"{name}.fmt").unlink(missing_ok=True)
+        raise
+    finally:
+        (compile_cwd / f"{name}.log").unlink(missing_ok=True)
+
+    built = compile_cwd / f"{name}.fmt"
+    if result.returncode != 0 or not built.exists():
+        log.warning("Format build failed for %s (returncode %d): %s", name, result.returncode, result.output[-500:])
+        built.unlink(missing_ok=True)
+        return False
+
+    # Publish atomically: other workers may be looking for the same format.
+    tmp = FORMAT_CACHE_DIR / f".{name}.{os.getpid()}.tmp"
+    shutil.move(built, tmp)
+    os.replace(tmp, FORMAT_CACHE_DIR / f"{name}.fmt")
+    log.info("Built preamble format %s in %.1fs", name, time.monotonic() - started)
+    _evict()
+    return True
+
+
+def is_verified(name: str) -> bool:
+    """Whether this format has already produced a PDF at least once."""
+    return (FORMAT_CACHE_DIR / f"{name}.ok").exists()
+
+
+def mark_verified(name: str) -> None:
+    (FORMAT_CACHE_DIR / f"{name}.ok").touch()
+
+
+def invalidate(name: str) -> None:
+    """Drop a format that turned out stale or broken and stop rebuilding it for a while."""
+    log.warning("Invalidating preamble format %s", name)
+    (FORMAT_CACHE_DIR / f"{name}.fmt").unlink(missing_ok=True)
+    (FORMAT_CACHE_DIR / f"{name}.ok").unlink(missing_ok=True)
+    (FORMAT_CACHE_DIR / f"{name}.failed").touch()
+
+
+def _evict() -> None:
+    entries = []
+    for path in FORMAT_CACHE_DIR.glob("*.fmt"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= FORMAT_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        path.with_suffix(".ok").unlink(missing_ok=True)
+        total -= size
+        log.info("Evicted preamble format %s", path.name)
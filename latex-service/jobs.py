@@ -0,0 +1,162 @@
+"""Registry of compile jobs submitted asynchronously (?wait=false).
+
+Each record holds one waiter reference on its queue job, so the compilation
+runs to completion even though no request is waiting for it. Finished records
+expire after JOB_TTL; the registry never holds more than MAX_JOBS.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+from queue_manager import Job, QueueManager
+
+log = logging.getLogger(__name__)
+
+JOB_TTL = float(os.environ.get("JOB_TTL", "600"))
+MAX_JOBS = int(os.environ.get("MAX_JOBS", "1000"))
+LOG_BUFFER_LINES = 500
+EVENT_TICK = 1.0  # seconds between queue position updates on an event stream
+
+# latexmk announces every tool invocation, e.g. "Run number 2 of rule 'pdflatex'"
+RUN_PATTERN = re.compile(r"Run number (\d+) of rule '([^']+)'")
+
+
+@dataclass(eq=False)
+class JobRecord:
+    id: str
+    job: Job
+    created_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+    runs: int = 0  # tool runs latexmk has started (engine passes, bibtex, ...)
+    rule: str | None = None
+    log: deque[str] = field(default_factory=lambda: deque(maxlen=LOG_BUFFER_LINES))
+    log_count: int = 0  # lines ever emitted; log holds the last LOG_BUFFER_LINES
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def on_output(self, line: str) -> None:
+        self.log.append(line)
+        self.log_count += 1
+        match = RUN_PATTERN.search(line)
+        if match:
+            self.runs += 1
+            self.rule = match.group(2)
+        self.notify()
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def status(self) -> str:
+        future = self.job.future
+        if not future.done():
+            return "running" if self.job.started else "queued"
+        if future.cancelled() or future.exception() is not None:
+            return "cancelled" if future.cancelled() else "error"
+        result = future.result()
+        if result.success:
+            return "succeeded"
+        if result.superseded:
+            return "superseded"
+        return "timed_out" if result.timed_out else "failed"
+
+
+class JobRegistry:
+    def __init__(self, queue: QueueManager) -> None:
+        self._queue = queue
+        self._records: OrderedDict[str, JobRecord] = OrderedDict()
+
+    def add(self, job: Job) -> JobRecord:
+        """Register job, taking over the caller's waiter reference on it."""
+        self._expire()
+        record = JobRecord(id=secrets.token_urlsafe(16), job=job)
+        self._records[record.id] = record
+        job.output_listeners.append(record.on_output)
+
+        def finished(_: asyncio.Future) -> None:
+            record.finished_at = time.monotonic()
+            record.notify()
+
+        job.future.add_done_callback(finished)
+        while len(self._records) > MAX_JOBS:
+            self._drop(self._oldest())
+        return record
+
+    def get(self, job_id: str) -> JobRecord | None:
+        self._expire()
+        return self._records.get(job_id)
+
+    def _oldest(self) -> str:
+        # Prefer finished records; only drop live ones when nothing else is left
+        for job_id, record in self._records.items():
+            if record.finished_at is not None:
+                return job_id
+        return next(iter(self._records))
+
+    def _drop(self, job_id: str) -> None:
+        record = self._records.pop(job_id)
+        record.job.output_listeners.remove(record.on_output)
+        if record.finished_at is None:
+            log.info("Dropping unfinished job %s from the registry", job_id)
+        self._queue.release(record.job)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        expired = [
+            job_id
+            for job_id, record in self._records.items()
+            if record.finished_at is not None and now - record.finished_at > JOB_TTL
+        ]
+        for job_id in expired:
+            self._drop(job_id)
+
+    def describe(self, record: JobRecord) -> dict:
+        status = self.status(record)
+        if record.job.future.done() and status["status"] in ("failed", "timed_out"):
+            status["log"] = record.job.future.result().log_tail
+        if status["status"] == "succeeded":
+            status["pdf_url"] = f"/jobs/{record.id}/pdf"
+        return status
+
+    def status(self, record: JobRecord) -> dict:
+        status = {"id": record.id, "status": record.status(), "runs": record.runs, "rule": record.rule}
+        position = self._queue.position(record.job)
+        if position is not None:
+            status["position"] = position
+            status["estimated_wait"] = round(self._queue.estimated_wait(), 1)
+        return status
+
+    async def events(self, record: JobRecord) -> AsyncIterator[str]:
+        """Server-sent events for one job: `status` whenever the queue position,
+        state or latexmk run changes, `log` per output line, then `done`."""
+        sent_lines = max(record.log_count - len(record.log), 0)
+        last_status = None
+        while True:
+            changed = record.changed
+            new_lines = record.log_count - sent_lines
+            if new_lines > 0:
+                for line in list(record.log)[-min(new_lines, len(record.log)):]:
+                    yield _sse("log", {"line": line})
+                sent_lines = record.log_count
+            status = self.status(record)
+            if status != last_status:
+                yield _sse("status", status)
+                last_status = status
+            if record.job.future.done():
+                yield _sse("done", self.describe(record))
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=EVENT_TICK)
+            except TimeoutError:
+                pass
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -1,27 +1,46 @@
 import asyncio
+import hashlib
+import itertools
 import logging
 import os
 import secrets
 import shutil
-import tempfile
 from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import BinaryIO
 
 import httpx
 from fastapi import FastAPI, File, Form, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
+import cluster
 import convex_fetcher
+import delta_upload
+import metrics
+import scratch
+from blob_cache import BlobCache
+from build_cache import BuildDirStore
+from deps import DependencyCache
+from jobs import JobRecord, JobRegistry
+from page_render import DEFAULT_DPI, MAX_DPI, MIN_DPI, PageRenderer, RenderError, changed_pages
+from pdf_cache import PdfCache, cache_key
+from pdf_optimize import PdfOptimizer
+from compiler import CompileResult, mode_tag, parse_mode
 from queue_manager import Job, QueueFullError, QueueManager
+from upload_queue import UploadQueue
 from zip_safety import ZipSafetyError, validate_and_extract
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 log = logging.getLogger(__name__)
 
 MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # 50 MB
+UPLOAD_CHUNK_SIZE = 256 * 1024
+PROXY_CHUNK_SIZE = 256 * 1024
 MAX_TIMEOUT = 120
 DEFAULT_TIMEOUT = 60
+DISCONNECT_POLL_INTERVAL = 1.0
+MAX_PREFETCHES = int(os.environ.get("MAX_PREFETCHES", "8"))  # being prepared at once
 
 API_SECRET = os.environ.get("LATEX_API_SECRET", "")
 if not API_SECRET:
@@ -29,14 +48,41 @@ if not API_SECRET:
 
 ALLOWED_ORIGIN = os.environ.get("ALLOWED_ORIGIN", "https://betterleaf.micwilk.com")
 
-queue_manager = QueueManager()
+pdf_cache = PdfCache()
+pdf_optimizer = PdfOptimizer()
+queue_manager = QueueManager(pdf_cache, pdf_optimizer)
+build_dirs = BuildDirStore()
+job_registry = JobRegistry(queue_manager)
+blob_cache = BlobCache()
+page_renderer = PageRenderer()
+dependency_cache = DependencyCache()
+upload_queue = UploadQueue()
+heartbeat = (
+    cluster.Heartbeat(cluster.NODE_URL, cluster.FileClusterState(Path(cluster.CLUSTER_STATE_FILE)), queue_manager.stats)
+    if cluster.NODE_URL and cluster.CLUSTER_STATE_FILE
+    else None
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    scratch.start()
+    build_dirs.start()
+    blob_cache.start()
+    pdf_cache.start()
+    page_renderer.start()
+    pdf_optimizer.start()
+    await convex_fetcher.start()
     await queue_manager.start()
+    upload_queue.start()
+    if heartbeat:
+        await heartbeat.start()
     yield
+    if heartbeat:
+        await heartbeat.stop()
     await queue_manager.stop()
+    await upload_queue.stop()
+    await convex_fetcher.stop()
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
@@ -44,30 +90,135 @@ app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[ALLOWED_ORIGIN],
-    allow_methods=["GET", "POST"],
+    allow_methods=["GET", "POST", "PUT"],
     allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["X-Result-Id"],
 )
 
 
-PROTECTED_PATHS = {"/compile", "/compile-project"}
+PROTECTED_PATHS = {"/compile", "/compile-project", "/compile-manifest", "/manifest", "/prefetch-project", "/metrics"}
+PROTECTED_PREFIXES = ("/blobs/", "/jobs/", "/results/")
 
 
 @app.middleware("http")
 async def log_and_auth(request: Request, call_next):
     log.info("Incoming %s %s", request.method, request.url.path)
-    if request.url.path in PROTECTED_PATHS:
+    timings = metrics.start_request()
+    if request.url.path in PROTECTED_PATHS or request.url.path.startswith(PROTECTED_PREFIXES):
         auth = request.headers.get("Authorization", "")
         if not secrets.compare_digest(auth, f"Bearer {API_SECRET}"):
             log.info("Response status: 401 for %s %s", request.method, request.url.path)
             return JSONResponse(status_code=401, content={"error": "unauthorized"})
     response = await call_next(request)
+    if timings:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    if response.headers.get("Content-Type") == "application/pdf" and "Content-Length" in response.headers:
+        metrics.RESPONSE_BYTES.observe(int(response.headers["Content-Length"]))
     log.info("Response status: %d for %s %s", response.status_code, request.method, request.url.path)
     return response
 
 
+def _should_discard(job: Job) -> bool:
+    """A build dir is kept for the next compile unless the job died mid-run, in
+    which case its intermediate files can't be trusted."""
+    if job.future.cancelled():
+        return job.started
+    if job.future.exception() is not None:
+        return True
+    result = job.future.result()
+    return result.timed_out or (result.superseded and job.started)
+
+
+def _pdf_response(pdf_path: Path) -> Response:
+    # Streamed from disk (sendfile where the server supports it), with Range support
+    return FileResponse(
+        pdf_path,
+        media_type="application/pdf",
+        filename="output.pdf",
+        content_disposition_type="inline",
+        # The PDF cache key, for fetching page previews of this result
+        headers={"X-Result-Id": pdf_path.stem},
+    )
+
+
+async def _open_pdf_stream(url: str) -> httpx.Response:
+    http = convex_fetcher.http_client()
+
+    async def open_stream() -> httpx.Response:
+        response = await http.send(http.build_request("GET", url), stream=True)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            await response.aclose()
+            raise
+        return response
+
+    return await convex_fetcher.with_retries(open_stream)
+
+
+async def _proxy_pdf(url: str, key: str) -> Response:
+    """Stream a PDF from Convex storage to the client, keeping a copy in the
+    local cache."""
+    upstream = await _open_pdf_stream(url)
+
+    async def body():
+        try:
+            async for chunk in pdf_cache.tee(key, upstream.aiter_bytes(PROXY_CHUNK_SIZE)):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    headers = {"Content-Disposition": "inline; filename=output.pdf", "X-Result-Id": key}
+    if "Content-Length" in upstream.headers:
+        headers["Content-Length"] = upstream.headers["Content-Length"]
+    return StreamingResponse(body(), media_type="application/pdf", headers=headers)
+
+
+def _superseded_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=409,
+        content={"error": "superseded", "detail": "A newer version of this project is being compiled"},
+    )
+
+
+def _queue_full_response(e: QueueFullError) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={
+            "error": "queue_full",
+            "detail": "Too many pending compilations",
+            "estimated_wait": round(e.estimated_wait, 1),
+        },
+        headers={"Retry-After": str(max(1, round(e.estimated_wait)))},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    stats = queue_manager.stats()
+    metrics.ACTIVE_WORKERS.set(stats["active"])
+    metrics.CONCURRENCY_LIMIT.set(stats["concurrency_limit"])
+    metrics.QUEUE_DEPTH.replace({(client,): depth for client, depth in queue_manager.depths().items()})
+    metrics.UPLOAD_QUEUE_DEPTH.set(upload_queue.stats()["pending"])
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "queue": queue_manager.stats(),
+        "pdf_cache": pdf_cache.stats(),
+        "uploads": upload_queue.stats(),
+    }
+
+
+@app.get("/ready")
+async def ready():
+    """200 once the startup warm-up is done; until then compiles work but run cold."""
+    if not queue_manager.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready"}
 
 
 @app.post("/compile")
@@ -78,13 +229,21 @@ async def compile(
     timeout: int = Form(DEFAULT_TIMEOUT),
     compiler: str = Form("pdflatex"),
     halt_on_error: bool = Form(False),
+    mode: str = Form("final"),
+    include_only: str = Form(""),
+    wait: bool = True,
 ):
     # Validate timeout
     timeout = min(max(timeout, 1), MAX_TIMEOUT)
-
-    # Read and validate size
-    zip_bytes = await file.read()
-    if len(zip_bytes) > MAX_UPLOAD_SIZE:
+    try:
+        draft, include_names = parse_mode(mode, include_only)
+    except ValueError as e:
+        return _invalid_mode_response(e)
+
+    # Starlette spools the upload to a temp file; it is hashed and extracted
+    # from there in chunks rather than read into memory.
+    zip_size = file.size if file.size is not None else await asyncio.to_thread(file.file.seek, 0, os.SEEK_END)
+    if zip_size > MAX_UPLOAD_SIZE:
         return JSONResponse(
             status_code=413,
             content={"error": "upload_too_large", "detail": "Max upload size is 50MB"},
@@ -94,22 +253,66 @@ async def compile(
     if compiler not in ("pdflatex", "xelatex", "lualatex"):
         compiler = "pdflatex"
 
-    log.info("Compile request: entrypoint=%s, timeout=%d, compiler=%s, halt_on_error=%s, zip_size=%d bytes", entrypoint, timeout, compiler, halt_on_error, len(zip_bytes))
+    log.info("Compile request: entrypoint=%s, timeout=%d, compiler=%s, halt_on_error=%s, zip_size=%d bytes", entrypoint, timeout, compiler, halt_on_error, zip_size)
+
+    # Identical uploads already in flight share that compilation
+    options = f"\0{entrypoint}\0{compiler}\0{halt_on_error}{mode_tag(draft, include_names)}".encode()
+    dedup_key = "upload:" + await asyncio.to_thread(_hash_upload, file.file, options)
+    result_key = hashlib.sha256(dedup_key.encode()).hexdigest()
+    pdf_path = pdf_cache.get(result_key)
+    metrics.CACHE_LOOKUPS.inc("pdf", "miss" if pdf_path is None else "hit")
+    if pdf_path is not None:
+        log.info("Local cache hit for upload %s", dedup_key[:23])
+        return _pdf_response(pdf_path)
+    job = queue_manager.join(dedup_key)
+    if job is not None:
+        log.info("Joined in-flight compilation %s", dedup_key[:23])
+        return await _job_response(request, job, wait)
 
     # Extract to temp dir
-    work_dir = Path(tempfile.mkdtemp(prefix="latex-"))
+    work_dir = scratch.mkdtemp("latex-")
     try:
-        validate_and_extract(zip_bytes, work_dir)
+        with metrics.timed("materialize"):
+            await asyncio.to_thread(validate_and_extract, file.file, work_dir)
     except ZipSafetyError as e:
-        import shutil
-
         shutil.rmtree(work_dir, ignore_errors=True)
         return JSONResponse(
             status_code=400,
             content={"error": "zip_safety_violation", "detail": str(e)},
         )
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
 
-    # Submit to queue
+    return await _submit_temp_job(
+        request, work_dir, entrypoint, timeout, compiler, halt_on_error, draft, include_names, dedup_key, result_key, wait
+    )
+
+
+def _hash_upload(upload: BinaryIO, suffix: bytes) -> str:
+    upload.seek(0)
+    digest = hashlib.sha256()
+    while chunk := upload.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+    upload.seek(0)
+    digest.update(suffix)
+    return digest.hexdigest()
+
+
+async def _submit_temp_job(
+    request: Request,
+    work_dir: Path,
+    entrypoint: str,
+    timeout: int,
+    compiler: str,
+    halt_on_error: bool,
+    draft: bool,
+    include_only: tuple[str, ...],
+    dedup_key: str,
+    result_key: str,
+    wait: bool,
+) -> Response:
+    """Queue a compile of a throwaway work dir, which the queue removes when done."""
     client_id = request.client.host if request.client else "unknown"
     loop = asyncio.get_event_loop()
     job = Job(
@@ -118,43 +321,120 @@ async def compile(
         timeout=timeout,
         compiler=compiler,
         halt_on_error=halt_on_error,
+        draft=draft,
+        include_only=include_only,
+        key=dedup_key,
+        result_key=result_key,
+        deps=await dependency_cache.resolve(dedup_key, work_dir, entrypoint),
         future=loop.create_future(),
     )
 
     try:
         queue_manager.submit(client_id, job)
-    except QueueFullError:
-        import shutil
-
+    except QueueFullError as e:
         shutil.rmtree(work_dir, ignore_errors=True)
-        return JSONResponse(
-            status_code=503,
-            content={"error": "queue_full", "detail": "Too many pending compilations"},
-        )
+        return _queue_full_response(e)
 
     log.info("Job submitted for client=%s, work_dir=%s", client_id, work_dir)
-    extracted_files = [str(p.relative_to(work_dir)) for p in work_dir.rglob("*") if p.is_file()]
-    log.info("Extracted files: %s", extracted_files)
+    return await _job_response(request, job, wait)
 
-    # Await result
-    result = await job.future
 
-    log.info("Compilation result: success=%s, pdf_size=%s, log_tail=%s",
-             result.success,
-             len(result.pdf_bytes) if result.pdf_bytes else 0,
-             result.log_tail[:200] if result.log_tail else "(empty)")
+def _invalid_mode_response(e: ValueError) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"error": "invalid_mode", "detail": str(e)})
+
+
+def _manifest_invalid_response(e: ZipSafetyError) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"error": "manifest_invalid", "detail": str(e)})
 
-    if result.success:
-        return Response(
-            content=result.pdf_bytes,
-            media_type="application/pdf",
-            headers={"Content-Disposition": "inline; filename=output.pdf"},
-        )
-    else:
-        return JSONResponse(
-            status_code=422,
-            content={"error": "compilation_failed", "log": result.log_tail},
-        )
+
+def _missing_blobs_response(missing: list[str]) -> JSONResponse:
+    return JSONResponse(
+        status_code=412,
+        content={"error": "missing_blobs", "detail": "Upload these blobs first", "missing": missing},
+    )
+
+
+@app.post("/manifest")
+async def manifest(body: delta_upload.Manifest):
+    """First step of a delta upload: report which file contents are not cached."""
+    try:
+        delta_upload.validate(body)
+    except ZipSafetyError as e:
+        return _manifest_invalid_response(e)
+    missing = delta_upload.missing_blobs(body, blob_cache)
+    log.info("Manifest: files=%d, missing=%d", len(body.files), len(missing))
+    return {"missing": missing}
+
+
+@app.put("/blobs/{digest}")
+async def put_blob(request: Request, digest: str):
+    """Second step: upload one file's content, addressed by its SHA-256."""
+    if not delta_upload.DIGEST_PATTERN.match(digest):
+        return JSONResponse(status_code=400, content={"error": "invalid_digest"})
+    if blob_cache.touch(digest):
+        return {"stored": digest}
+    try:
+        await blob_cache.put_stream(request.stream(), digest, MAX_UPLOAD_SIZE)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": "blob_rejected", "detail": str(e)})
+    return {"stored": digest}
+
+
+@app.post("/compile-manifest")
+async def compile_manifest(request: Request, body: delta_upload.ManifestCompile, wait: bool = True):
+    """Final step: compile the tree described by a manifest whose blobs are all cached."""
+    timeout = min(max(body.timeout or DEFAULT_TIMEOUT, 1), MAX_TIMEOUT)
+    compiler = body.compiler if body.compiler in ("pdflatex", "xelatex", "lualatex") else "pdflatex"
+    try:
+        draft, include_names = parse_mode(body.mode, body.include_only)
+    except ValueError as e:
+        return _invalid_mode_response(e)
+    try:
+        delta_upload.validate(body)
+    except ZipSafetyError as e:
+        return _manifest_invalid_response(e)
+
+    digest = hashlib.sha256(delta_upload.manifest_hash(body).encode())
+    digest.update(f"\0{body.entrypoint}\0{compiler}\0{body.halt_on_error}{mode_tag(draft, include_names)}".encode())
+    dedup_key = "manifest:" + digest.hexdigest()
+    result_key = hashlib.sha256(dedup_key.encode()).hexdigest()
+    pdf_path = pdf_cache.get(result_key)
+    metrics.CACHE_LOOKUPS.inc("pdf", "miss" if pdf_path is None else "hit")
+    if pdf_path is not None:
+        log.info("Local cache hit for manifest %s", dedup_key[:25])
+        return _pdf_response(pdf_path)
+    job = queue_manager.join(dedup_key)
+    if job is not None:
+        log.info("Joined in-flight compilation %s", dedup_key[:25])
+        return await _job_response(request, job, wait)
+
+    missing = delta_upload.missing_blobs(body, blob_cache)
+    if missing:
+        return _missing_blobs_response(missing)
+    try:
+        delta_upload.check_sizes(body, blob_cache)
+    except ZipSafetyError as e:
+        return _manifest_invalid_response(e)
+
+    log.info("Compile manifest: entrypoint=%s, timeout=%d, compiler=%s, files=%d", body.entrypoint, timeout, compiler, len(body.files))
+    work_dir = scratch.mkdtemp("latex-")
+    try:
+        with metrics.timed("materialize"):
+            await asyncio.to_thread(delta_upload.assemble, body, blob_cache, work_dir)
+    except FileNotFoundError:
+        # A blob was evicted in the meantime
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return _missing_blobs_response(delta_upload.missing_blobs(body, blob_cache))
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    return await _submit_temp_job(
+        request, work_dir, body.entrypoint, timeout, compiler, body.halt_on_error, draft, include_names, dedup_key, result_key, wait
+    )
+
+
+_fetch_order = itertools.count()
 
 
 @app.post("/compile-project")
@@ -162,12 +442,21 @@ async def compile_project(
     request: Request,
     project_id: str = Form(...),
     timeout: int = Form(DEFAULT_TIMEOUT),
+    mode: str = Form("final"),
+    include_only: str = Form(""),
+    wait: bool = True,
 ):
     timeout = min(max(timeout, 1), MAX_TIMEOUT)
+    try:
+        draft, include_names = parse_mode(mode, include_only)
+    except ValueError as e:
+        return _invalid_mode_response(e)
 
     # Fetch project and files from Convex
+    fetch_order = next(_fetch_order)
     try:
-        project = await asyncio.to_thread(convex_fetcher.fetch_project, project_id)
+        with metrics.timed("fetch_project"):
+            project = await asyncio.to_thread(convex_fetcher.fetch_project, project_id)
     except Exception as e:
         log.error("Failed to fetch project %s: %s", project_id, e)
         return JSONResponse(
@@ -184,41 +473,50 @@ async def compile_project(
         compiler = "pdflatex"
 
     log.info(
-        "compile-project: project_id=%s, entrypoint=%s, compiler=%s, halt_on_error=%s, files=%d",
-        project_id, entrypoint, compiler, halt_on_error, len(files),
+        "compile-project: project_id=%s, entrypoint=%s, compiler=%s, halt_on_error=%s, mode=%s, files=%d",
+        project_id, entrypoint, compiler, halt_on_error, mode, len(files),
     )
 
-    # Materialize files to temp dir and compute content hash
-    work_dir = Path(tempfile.mkdtemp(prefix="latex-"))
-    try:
-        zip_hash = await convex_fetcher.materialize_files(files, work_dir)
-    except Exception as e:
-        shutil.rmtree(work_dir, ignore_errors=True)
-        log.error("Failed to materialize files for project %s: %s", project_id, e)
-        return JSONResponse(
-            status_code=500,
-            content={"error": "file_materialization_failed", "detail": str(e)},
-        )
-
-    # Check Convex compilation cache
-    try:
-        cached = await asyncio.to_thread(convex_fetcher.check_cache, project_id, zip_hash)
-        if cached and cached.get("pdfUrl"):
-            shutil.rmtree(work_dir, ignore_errors=True)
-            log.info("Cache hit for project=%s hash=%s", project_id, zip_hash[:16])
-            async with httpx.AsyncClient() as http:
-                pdf_response = await http.get(cached["pdfUrl"])
-                pdf_response.raise_for_status()
-            return Response(
-                content=pdf_response.content,
-                media_type="application/pdf",
-                headers={"Content-Disposition": "inline; filename=output.pdf"},
-            )
-    except Exception as e:
-        log.warning("Cache check failed for project %s: %s — proceeding to compile", project_id, e)
-
-    # Submit to queue
-    client_id = request.client.host if request.client else "unknown"
+    zip_hash = convex_fetcher.content_hash(files)
+    tag = mode_tag(draft, include_names)
+    # Drafts and final builds supersede only their own kind: a preview taken
+    # while typing must not kill the full build the user asked for.
+    stream = project_id + (":draft" if draft else "")
+    dedup_key = f"project:{project_id}:{zip_hash}{tag}"
+    # Anything still queued or running for an older version of the project is
+    # moot. Fetches finish in any order, so versions are ordered by the
+    # project's revision, then by when the fetch started.
+    queue_manager.announce(stream, dedup_key, (project.get("revision", 0), fetch_order))
+
+    # Local PDF cache first: an unchanged project needs no Convex or storage round trip
+    result_key = cache_key(project_id, zip_hash + tag)
+    pdf_path = pdf_cache.get(result_key)
+    metrics.CACHE_LOOKUPS.inc("pdf", "miss" if pdf_path is None else "hit")
+    if pdf_path is not None:
+        log.info("Local cache hit for project=%s hash=%s", project_id, zip_hash[:16])
+        return _pdf_response(pdf_path)
+
+    # Identical compilation already in flight: share its result
+    job = queue_manager.join(dedup_key)
+    if job is not None:
+        log.info("Joined in-flight compilation for project=%s hash=%s", project_id, zip_hash[:16])
+        return await _job_response(request, job, wait)
+
+    # Materialize files into the project's warm build dir. Drafts have their
+    # own, so a preview neither waits for a full build nor rewrites its .aux
+    # files. The lease on the dir ends when the job's future resolves (or is
+    # cancelled on any early return below). Waiting for the lease means another
+    # compile of this kind just finished, possibly for this very hash.
+    if not draft:
+        queue_manager.preempt_idle(project_id)  # a prefetch holding the dir gives it up
+    work_dir = await build_dirs.acquire(stream)
+    if queue_manager.is_superseded(stream, dedup_key):
+        build_dirs.release(stream)
+        return _superseded_response()
+    pdf_path = pdf_cache.get(result_key)
+    if pdf_path is not None:
+        build_dirs.release(stream)
+        return _pdf_response(pdf_path)
     loop = asyncio.get_event_loop()
     job = Job(
         work_dir=str(work_dir),
@@ -226,43 +524,356 @@ async def compile_project(
         timeout=timeout,
         compiler=compiler,
         halt_on_error=halt_on_error,
+        draft=draft,
+        include_only=include_names,
+        keep_work_dir=True,
+        key=dedup_key,
+        project_id=stream,
+        result_key=result_key,
         future=loop.create_future(),
     )
-
+    job.future.add_done_callback(lambda f: build_dirs.release(stream, discard=_should_discard(job)))
+    if not draft:
+        job.on_stored.append(lambda result: _store_project_result(result, project_id, zip_hash))
+    submitted = False
     try:
-        queue_manager.submit(client_id, job)
-    except QueueFullError:
-        shutil.rmtree(work_dir, ignore_errors=True)
-        return JSONResponse(
-            status_code=503,
-            content={"error": "queue_full", "detail": "Too many pending compilations"},
-        )
+        try:
+            with metrics.timed("materialize"):
+                await convex_fetcher.materialize_files(files, work_dir, blob_cache)
+                job.deps = await dependency_cache.resolve(
+                    f"project:{project_id}:{zip_hash}", work_dir, entrypoint, [file["name"] for file in files]
+                )
+        except Exception as e:
+            job.future.set_exception(e)
+            log.error("Failed to materialize files for project %s: %s", project_id, e)
+            return JSONResponse(
+                status_code=500,
+                content={"error": "file_materialization_failed", "detail": str(e)},
+            )
+
+        # An earlier version that differs only in files this compile never
+        # reads produced the same PDF
+        if job.deps.dependency_hash is not None:
+            deps_key = cache_key(project_id, "deps:" + job.deps.dependency_hash + tag)
+            pdf_path = pdf_cache.get(deps_key)
+            metrics.CACHE_LOOKUPS.inc("pdf_deps", "miss" if pdf_path is None else "hit")
+            if pdf_path is not None:
+                log.info("Dependency cache hit for project=%s hash=%s", project_id, zip_hash[:16])
+                pdf_cache.alias(result_key, pdf_path)
+                return _pdf_response(pdf_path)
+            job.on_stored.append(lambda result: pdf_cache.alias(deps_key, result.pdf_path))
+
+        # Check Convex compilation cache, which only holds final builds
+        if not draft:
+            try:
+                with metrics.timed("cache_lookup"):
+                    cached = await asyncio.to_thread(convex_fetcher.check_cache, project_id, zip_hash)
+                metrics.CACHE_LOOKUPS.inc("convex", "hit" if cached and cached.get("pdfUrl") else "miss")
+                if cached and cached.get("pdfUrl"):
+                    log.info("Cache hit for project=%s hash=%s", project_id, zip_hash[:16])
+                    return await _proxy_pdf(cached["pdfUrl"], result_key)
+            except Exception as e:
+                log.warning("Cache check failed for project %s: %s — proceeding to compile", project_id, e)
+
+        # Submit to queue
+        client_id = request.client.host if request.client else "unknown"
+        try:
+            queue_manager.submit(client_id, job)
+        except QueueFullError as e:
+            return _queue_full_response(e)
+        submitted = True
+    finally:
+        if not submitted and not job.future.done():
+            job.future.cancel()
 
     log.info("Job submitted for client=%s project=%s work_dir=%s", client_id, project_id, work_dir)
+    return await _job_response(request, job, wait)
 
-    result = await job.future
+
+_prefetches: dict[str, asyncio.Task[None]] = {}  # project id -> preparation
+
+
+@app.post("/prefetch-project")
+async def prefetch_project(request: Request, project_id: str = Form(...)):
+    """Compile a project ahead of need, e.g. when the editor opens it. Answers
+    at once; the compile runs at idle priority and its result lands in the
+    caches. A compile requested meanwhile joins it, or preempts it if the
+    project changed."""
+    if project_id in _prefetches or len(_prefetches) >= MAX_PREFETCHES:
+        return JSONResponse(status_code=202, content={"status": "skipped"})
+    client_id = request.client.host if request.client else "unknown"
+    task = asyncio.create_task(_prefetch(project_id, client_id))
+    _prefetches[project_id] = task
+    task.add_done_callback(lambda _: _prefetches.pop(project_id, None))
+    return JSONResponse(status_code=202, content={"status": "prefetching"})
+
+
+async def _prefetch(project_id: str, client_id: str) -> None:
+    """The final build of compile_project, at idle priority, without a client
+    waiting on it. Gives up whenever a compile of the project needs the dir."""
+    try:
+        project = await asyncio.to_thread(convex_fetcher.fetch_project, project_id)
+    except Exception as e:
+        log.warning("Prefetch of project %s failed: %s", project_id, e)
+        return
+    compiler = project.get("compiler", "pdflatex")
+    if compiler not in ("pdflatex", "xelatex", "lualatex"):
+        compiler = "pdflatex"
+    entrypoint = project["entrypoint"]
+    files = project["files"]
+
+    zip_hash = convex_fetcher.content_hash(files)
+    dedup_key = f"project:{project_id}:{zip_hash}"
+    result_key = cache_key(project_id, zip_hash)
+    if (
+        pdf_cache.get(result_key) is not None
+        or queue_manager.has(dedup_key)
+        or queue_manager.is_superseded(project_id, dedup_key)
+    ):
+        return
+    work_dir = await build_dirs.try_acquire(project_id)
+    if work_dir is None:
+        return  # a compile of the project is under way
+
+    job = Job(
+        work_dir=str(work_dir),
+        entrypoint=entrypoint,
+        timeout=DEFAULT_TIMEOUT,
+        compiler=compiler,
+        halt_on_error=project.get("haltOnError", False),
+        keep_work_dir=True,
+        key=dedup_key,
+        project_id=project_id,
+        result_key=result_key,
+        idle=True,
+        waiters=0,
+    )
+    # Joinable, and preemptable, while it is being prepared. Preempting it
+    # cancels the preparation wherever it is, so the lease on the build dir
+    # ends right away instead of after the next download or Convex call.
+    queue_manager.track(job)
+    submitted = False
+    preparation = asyncio.current_task()
+
+    def stop_preparing(_: asyncio.Future) -> None:
+        if not submitted and preparation is not None:
+            preparation.cancel()
+
+    job.future.add_done_callback(stop_preparing)
+    try:
+        await convex_fetcher.materialize_files(files, work_dir, blob_cache)
+        job.deps = await dependency_cache.resolve(
+            f"project:{project_id}:{zip_hash}", work_dir, entrypoint, [file["name"] for file in files]
+        )
+        if job.future.done():
+            return  # preempted
+        if job.deps.dependency_hash is not None:
+            deps_key = cache_key(project_id, "deps:" + job.deps.dependency_hash)
+            pdf_path = pdf_cache.get(deps_key)
+            if pdf_path is not None and not job.future.done():
+                job.future.set_result(CompileResult(True, pdf_cache.alias(result_key, pdf_path) or pdf_path, ""))
+                return
+            job.on_stored.append(lambda result: pdf_cache.alias(deps_key, result.pdf_path))
+
+        cached = await asyncio.to_thread(convex_fetcher.check_cache, project_id, zip_hash)
+        if job.future.done():
+            return  # preempted
+        if cached and cached.get("pdfUrl"):
+            upstream = await _open_pdf_stream(cached["pdfUrl"])
+            try:
+                async for _ in pdf_cache.tee(result_key, upstream.aiter_bytes(PROXY_CHUNK_SIZE)):
+                    pass
+            finally:
+                await upstream.aclose()
+            pdf_path = pdf_cache.get(result_key)
+            if pdf_path is not None and not job.future.done():
+                job.future.set_result(CompileResult(True, pdf_path, ""))
+                return
+
+        if job.future.done():
+            return  # preempted
+        job.future.add_done_callback(lambda f: build_dirs.release(project_id, discard=_should_discard(job)))
+        job.on_stored.append(lambda result: _store_project_result(result, project_id, zip_hash))
+        submitted = True
+        try:
+            queue_manager.submit_idle(client_id, job)
+        except QueueFullError as e:
+            # Promoted by a join, and then no room in the queue
+            job.future.set_exception(e)
+            return
+        log.info("Prefetch submitted for project=%s hash=%s", project_id, zip_hash[:16])
+    except Exception as e:
+        log.warning("Prefetch of project %s failed: %s", project_id, e)
+        if job.waiters and not job.future.done():
+            job.future.set_exception(e)
+    finally:
+        if not submitted:
+            build_dirs.release(project_id)
+            if not job.future.done():
+                job.future.cancel()
+
+
+def _store_project_result(result: CompileResult, project_id: str, zip_hash: str) -> None:
+    """Cache a finished project compilation in Convex, once per job regardless
+    of how many clients were waiting on it. The queue calls this once the
+    PDF it already stored locally is final."""
+    upload_queue.submit(result.pdf_path, project_id, zip_hash)
+
+
+async def _wait_for_job(request: Request, job: Job) -> CompileResult | None:
+    """Wait for job on behalf of one client. Returns None if the client went away
+    first; the job is only dropped once all of its waiters are gone."""
+    try:
+        while True:
+            done, _ = await asyncio.wait({job.future}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return job.future.result()
+            if await request.is_disconnected():
+                log.info("Client disconnected while waiting for %s", job.key)
+                return None
+    finally:
+        queue_manager.release(job)
+
+
+async def _job_response(request: Request, job: Job, wait: bool = True) -> Response:
+    """Answer with the job's outcome, or with 202 and a job resource to poll
+    when the client asked not to wait."""
+    if not wait:
+        return _accepted_response(job_registry.add(job))
+    result = await _wait_for_job(request, job)
+    if result is None:
+        return Response(status_code=499)
+    if job.started:
+        # Observed once per job by the queue; reported to every waiter
+        metrics.add_timing("queue_wait", job.started_at - job.submitted_at)
+        metrics.add_timing("compile", job.compile_seconds)
 
     log.info(
-        "Compilation result: success=%s, pdf_size=%s, log_tail=%s",
+        "Compilation result: success=%s, pdf=%s, log_tail=%s",
         result.success,
-        len(result.pdf_bytes) if result.pdf_bytes else 0,
+        result.pdf_path,
         result.log_tail[:200] if result.log_tail else "(empty)",
     )
 
     if result.success:
-        # Fire-and-forget: cache PDF in Convex
-        asyncio.create_task(
-            asyncio.to_thread(
-                convex_fetcher.upload_and_cache, result.pdf_bytes, project_id, zip_hash
-            )
-        )
-        return Response(
-            content=result.pdf_bytes,
-            media_type="application/pdf",
-            headers={"Content-Disposition": "inline; filename=output.pdf"},
-        )
+        return _pdf_response(result.pdf_path)
+    elif result.superseded:
+        return _superseded_response()
     else:
         return JSONResponse(
             status_code=422,
             content={"error": "compilation_failed", "log": result.log_tail},
         )
+
+
+def _accepted_response(record: JobRecord) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={**job_registry.status(record), "status_url": f"/jobs/{record.id}", "events_url": f"/jobs/{record.id}/events"},
+        headers={"Location": f"/jobs/{record.id}"},
+    )
+
+
+def _job_not_found_response() -> JSONResponse:
+    return JSONResponse(status_code=404, content={"error": "job_not_found"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    record = job_registry.get(job_id)
+    if record is None:
+        return _job_not_found_response()
+    return job_registry.describe(record)
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    record = job_registry.get(job_id)
+    if record is None:
+        return _job_not_found_response()
+    return StreamingResponse(
+        job_registry.events(record),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/jobs/{job_id}/pdf")
+async def job_pdf(job_id: str):
+    record = job_registry.get(job_id)
+    if record is None:
+        return _job_not_found_response()
+    if record.status() != "succeeded":
+        return JSONResponse(status_code=409, content={"error": "not_ready", "status": record.status()})
+    pdf_path = record.job.future.result().pdf_path
+    if not pdf_path.exists():
+        return JSONResponse(status_code=410, content={"error": "pdf_expired"})
+    return _pdf_response(pdf_path)
+
+
+def _result_not_found_response() -> JSONResponse:
+    return JSONResponse(status_code=404, content={"error": "result_not_found"})
+
+
+@app.get("/results/{result_id}/pages")
+async def result_pages(
+    result_id: str,
+    dpi: int = DEFAULT_DPI,
+    first: int = 1,
+    last: int | None = None,
+    since: str | None = None,
+):
+    """Render pages first..last (default: all) of a compiled PDF, identified
+    by its X-Result-Id, and list their content hashes. Only pages not rendered
+    before at this dpi are rasterized. With since=<earlier result id>, also
+    report which of these pages differ from that result, so only those need
+    fetching."""
+    if not delta_upload.DIGEST_PATTERN.match(result_id):
+        return _result_not_found_response()
+    dpi = min(max(dpi, MIN_DPI), MAX_DPI)
+    pdf_path = pdf_cache.get(result_id)
+    if pdf_path is None:
+        return _result_not_found_response()
+    try:
+        page_count = await page_renderer.page_count(result_id, pdf_path)
+        last = page_count if last is None else min(last, page_count)
+        if first < 1 or first > last:
+            return JSONResponse(
+                status_code=400,
+                content={"error": "invalid_page_range", "detail": f"Document has {page_count} pages"},
+            )
+        pages = await page_renderer.render(result_id, pdf_path, dpi, first, last)
+    except RenderError as e:
+        log.warning("Rendering %s failed: %s", result_id, e)
+        return JSONResponse(status_code=500, content={"error": "render_failed", "detail": str(e)})
+
+    # Pages of an unknown or evicted previous result count as changed
+    previous = {}
+    if since:
+        for page in pages:
+            digest = page_renderer.cached_page(since, dpi, page)
+            if digest is not None:
+                previous[page] = digest
+    return {
+        "result_id": result_id,
+        "dpi": dpi,
+        "page_count": page_count,
+        "pages": [
+            {"page": page, "hash": digest, "url": f"/results/{result_id}/pages/{digest}.png"}
+            for page, digest in pages.items()
+        ],
+        "changed": changed_pages(pages, previous),
+    }
+
+
+@app.get("/results/{result_id}/pages/{digest}.png")
+async def result_page(result_id: str, digest: str):
+    # Page images are content-addressed, so they never change once served
+    path = page_renderer.page_path(digest) if delta_upload.DIGEST_PATTERN.match(digest) else None
+    if path is None:
+        return JSONResponse(status_code=404, content={"error": "page_not_found"})
+    return FileResponse(
+        path,
+        media_type="image/png",
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
+    )
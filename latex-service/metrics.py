@@ -0,0 +1,179 @@
+"""Prometheus metrics and per-request Server-Timing.
+
+Metrics are plain in-process counters rendered in the Prometheus text format
+by GET /metrics. Stages timed while handling a request (see timed()) are also
+reported back to the client in a Server-Timing header.
+"""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS = (10_000, 100_000, 500_000, 1_000_000, 5_000_000, 10_000_000, 50_000_000, 100_000_000)
+
+_registry: list["_Metric"] = []
+
+# Stage -> seconds for the request being handled, if any
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry.append(self)
+
+    def _label_str(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{self._label_str(k)} {_num(v)}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Set at scrape time from the component that owns the value."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, *label_values: str) -> None:
+        self._values[label_values] = value
+
+    def replace(self, values: dict[tuple[str, ...], float]) -> None:
+        """Set all label combinations at once, dropping ones that are gone."""
+        self._values = dict(values)
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{self._label_str(k)} {_num(v)}" for k, v in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = SECONDS_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._series: dict[tuple[str, ...], list[float]] = {}  # bucket counts..., +Inf count, sum
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            bounds = [_num(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, series):
+                le = 'le="' + bound + '"'
+                lines.append(f"{self.name}_bucket{self._label_str(key, le)} {_num(count)}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {_num(series[-1])}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {_num(series[-2])}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "latex_stage_seconds",
+    "Time spent per request stage (queue_wait, materialize, download, cache_lookup, compile, optimize, upload).",
+    ("stage",),
+)
+COMPILE_CPU_SECONDS = Histogram("latex_compile_cpu_seconds", "CPU time of the latexmk process tree per compile.")
+RESPONSE_BYTES = Histogram("latex_response_bytes", "Size of PDF responses.", buckets=BYTES_BUCKETS)
+CACHE_LOOKUPS = Counter("latex_cache_lookups_total", "Cache lookups by cache and result.", ("cache", "result"))
+COMPILES = Counter("latex_compiles_total", "Finished compiles by outcome.", ("outcome",))
+QUEUE_DEPTH = Gauge("latex_queue_depth", "Queued compiles per client.", ("client",))
+ACTIVE_WORKERS = Gauge("latex_active_workers", "Compiles currently running.")
+CONCURRENCY_LIMIT = Gauge("latex_concurrency_limit", "Current adaptive limit on concurrent compiles.")
+WORK_DIRS = Counter("latex_work_dirs_total", "Work dirs created, by where they were placed.", ("location",))
+PDF_OPTIMIZE = Counter("latex_pdf_optimize_total", "PDF post-processing runs by outcome.", ("outcome",))
+PDF_OPTIMIZE_BYTES = Counter(
+    "latex_pdf_optimize_bytes_total", "Size of post-processed PDFs before and after, summed.", ("stage",)
+)
+UPLOADS = Counter("latex_uploads_total", "Background PDF uploads to Convex by outcome.", ("outcome",))
+UPLOAD_QUEUE_DEPTH = Gauge("latex_upload_queue_depth", "PDF uploads waiting to be sent to Convex.")
+# Coordinator only
+CLUSTER_ROUTES = Counter(
+    "latex_cluster_routes_total", "Requests forwarded by the coordinator, by node and reason.", ("node", "reason")
+)
+CLUSTER_NODES = Gauge("latex_cluster_nodes", "Live worker nodes seen by the coordinator.")
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record how long the block takes under stage, in the stage histogram and
+    in the current request's Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage)
+        add_timing(stage, elapsed)
+
+
+def add_timing(stage: str, seconds: float) -> None:
+    """Report a stage in the current request's Server-Timing header only, for
+    work already observed elsewhere (e.g. a compile shared by several requests)."""
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def start_request() -> dict[str, float]:
+    timings: dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def server_timing(timings: dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
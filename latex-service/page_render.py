@@ -0,0 +1,204 @@
+"""PNG rasters of compiled PDF pages, cached per page content.
+
+Renders are keyed by (result, dpi, page), where a result id names one cached
+PDF, and pdftoppm only rasterizes the requested pages that aren't cached yet.
+Page images are stored under the SHA-256 of their PNG bytes, so a page that
+looks the same in two versions of a document is stored once and reported as
+unchanged between them.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+from runner import run_process
+
+log = logging.getLogger(__name__)
+
+RENDER_CACHE_DIR = Path(os.environ.get("RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-pages")))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", "2"))
+RENDER_TIMEOUT = 60.0
+MAX_RENDERINGS = 100_000  # (result, dpi, page) hashes remembered
+MIN_DPI = 36
+MAX_DPI = 300
+DEFAULT_DPI = 96
+
+
+class RenderError(Exception):
+    pass
+
+
+class PageRenderer:
+    def __init__(self, root: Path = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_MAX_BYTES) -> None:
+        self._root = root
+        self._max_bytes = max_bytes
+        self._pages: OrderedDict[str, int] = OrderedDict()  # page hash -> size, LRU order
+        self._total_bytes = 0
+        self._renderings: OrderedDict[tuple[str, int, int], str] = OrderedDict()  # (result, dpi, page) -> hash
+        self._page_counts: OrderedDict[str, int] = OrderedDict()
+        self._inflight: dict[tuple[str, int, int], asyncio.Future[str]] = {}
+        self._slots = asyncio.Semaphore(RENDER_CONCURRENCY)
+
+    def start(self) -> None:
+        (self._root / "pages").mkdir(parents=True, exist_ok=True)
+        for path in self._root.glob("render-*"):
+            shutil.rmtree(path, ignore_errors=True)
+        entries = []
+        for path in (self._root / "pages").glob("*.png"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, digest, size in sorted(entries):
+            self._pages[digest] = size
+            self._total_bytes += size
+        self._evict()
+
+    def page_path(self, digest: str) -> Path | None:
+        if digest not in self._pages:
+            return None
+        self._pages.move_to_end(digest)
+        return self._root / "pages" / f"{digest}.png"
+
+    def cached_page(self, result_id: str, dpi: int, page: int) -> str | None:
+        """Hash of an earlier rendering of the page, if its image is still cached."""
+        digest = self._renderings.get((result_id, dpi, page))
+        if digest is None or digest not in self._pages:
+            return None
+        self._renderings.move_to_end((result_id, dpi, page))
+        self._pages.move_to_end(digest)
+        return digest
+
+    async def page_count(self, result_id: str, pdf_path: Path) -> int:
+        count = self._page_counts.get(result_id)
+        if count is not None:
+            self._page_counts.move_to_end(result_id)
+            return count
+        try:
+            result = await run_process(["pdfinfo", str(pdf_path)], pdf_path.parent, RENDER_TIMEOUT)
+        except TimeoutError:
+            raise RenderError(f"pdfinfo timed out after {RENDER_TIMEOUT:.0f}s")
+        match = re.search(r"^Pages:\s+(\d+)", result.output, re.MULTILINE)
+        if result.returncode != 0 or match is None:
+            raise RenderError(f"pdfinfo failed: {result.output[-500:]}")
+        count = int(match.group(1))
+        self._page_counts[result_id] = count
+        while len(self._page_counts) > MAX_RENDERINGS:
+            self._page_counts.popitem(last=False)
+        return count
+
+    async def render(self, result_id: str, pdf_path: Path, dpi: int, first: int, last: int) -> dict[int, str]:
+        """Return the hash of each page in first..last rendered at dpi,
+        rasterizing only the pages that aren't cached. Concurrent requests for
+        the same page share one run."""
+        pages: dict[int, str] = {}
+        waiting: dict[int, asyncio.Future[str]] = {}
+        missing = []
+        for page in range(first, last + 1):
+            digest = self.cached_page(result_id, dpi, page)
+            if digest is not None:
+                pages[page] = digest
+            elif (result_id, dpi, page) in self._inflight:
+                waiting[page] = self._inflight[(result_id, dpi, page)]
+            else:
+                missing.append(page)
+        if missing:
+            await self._render_missing(result_id, pdf_path, dpi, missing)
+            for page in missing:
+                pages[page] = self._renderings[(result_id, dpi, page)]
+        for page, future in waiting.items():
+            pages[page] = await asyncio.shield(future)
+        return dict(sorted(pages.items()))
+
+    async def _render_missing(self, result_id: str, pdf_path: Path, dpi: int, missing: list[int]) -> None:
+        loop = asyncio.get_running_loop()
+        futures = {page: loop.create_future() for page in missing}
+        for page, future in futures.items():
+            self._inflight[(result_id, dpi, page)] = future
+        try:
+            async with self._slots:
+                # One pdftoppm run over the span; pages in between that were
+                # already cached come out with the same hash
+                hashed = await self._rasterize(pdf_path, dpi, missing[0], missing[-1])
+            for page, digest in hashed.items():
+                self._renderings[(result_id, dpi, page)] = digest
+                self._renderings.move_to_end((result_id, dpi, page))
+            while len(self._renderings) > MAX_RENDERINGS:
+                self._renderings.popitem(last=False)
+            for page, future in futures.items():
+                if page not in hashed:
+                    raise RenderError(f"pdftoppm produced no image for page {page}")
+                future.set_result(hashed[page])
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            for page in missing:
+                del self._inflight[(result_id, dpi, page)]
+
+    async def _rasterize(self, pdf_path: Path, dpi: int, first: int, last: int) -> dict[int, str]:
+        out_dir = Path(tempfile.mkdtemp(dir=self._root, prefix="render-"))
+        try:
+            cmd = [
+                "pdftoppm", "-png", "-r", str(dpi), "-f", str(first), "-l", str(last),
+                str(pdf_path), str(out_dir / "page"),
+            ]
+            try:
+                result = await run_process(cmd, out_dir, RENDER_TIMEOUT)
+            except TimeoutError:
+                raise RenderError(f"Rendering timed out after {RENDER_TIMEOUT:.0f}s")
+            if result.returncode != 0:
+                raise RenderError(f"pdftoppm failed: {result.output[-500:]}")
+            # page-1.png ... page-10.png; the number is zero-padded to the page count width
+            files = {int(path.stem.rsplit("-", 1)[1]): path for path in out_dir.glob("page-*.png")}
+            hashed = await asyncio.to_thread(_hash_files, files)
+            return self._adopt(hashed)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def _adopt(self, hashed: dict[int, tuple[Path, str, int]]) -> dict[int, str]:
+        pages = {}
+        for page, (path, digest, size) in hashed.items():
+            pages[page] = digest
+            if digest not in self._pages:
+                os.replace(path, self._root / "pages" / f"{digest}.png")
+                self._pages[digest] = size
+                self._total_bytes += size
+            self._pages.move_to_end(digest)
+        self._evict(keep=set(pages.values()))
+        return pages
+
+    def _evict(self, keep: set[str] = frozenset()) -> None:
+        for digest in list(self._pages):
+            if self._total_bytes <= self._max_bytes:
+                break
+            if digest in keep:
+                continue
+            self._total_bytes -= self._pages.pop(digest)
+            (self._root / "pages" / f"{digest}.png").unlink(missing_ok=True)
+
+
+def _hash_files(files: dict[int, Path]) -> dict[int, tuple[Path, str, int]]:
+    hashed = {}
+    for page, path in files.items():
+        data = path.read_bytes()
+        hashed[page] = (path, hashlib.sha256(data).hexdigest(), len(data))
+    return hashed
+
+
+def changed_pages(pages: dict[int, str], previous: dict[int, str]) -> list[int]:
+    """Numbers of the pages that differ from the previous rendering; a page
+    it doesn't have counts as changed."""
+    return [page for page, digest in pages.items() if previous.get(page) != digest]
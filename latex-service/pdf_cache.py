@@ -0,0 +1,151 @@
+"""Local on-disk LRU cache of compiled PDFs.
+
+Sits in front of the Convex compilation cache so repeat views of an unchanged
+project cost no network round trips. It is also where finished compilations
+leave their PDF: responses are served straight from these files, so a PDF is
+never held in memory.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+PDF_CACHE_DIR = Path(os.environ.get("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "latex-pdfs")))
+PDF_CACHE_DISK_BYTES = int(os.environ.get("PDF_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+
+def cache_key(project_id: str, content_hash: str) -> str:
+    return hashlib.sha256(f"{project_id}:{content_hash}".encode()).hexdigest()
+
+
+class PdfCache:
+    def __init__(self, root: Path = PDF_CACHE_DIR, disk_bytes: int = PDF_CACHE_DISK_BYTES) -> None:
+        self._root = root
+        self._disk_limit = disk_bytes
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key -> size
+        self._disk_bytes = 0
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "evictions": 0,
+        }
+
+    def start(self) -> None:
+        """Index PDFs kept on disk from a previous run, oldest first."""
+        self._root.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for path in self._root.glob("*.pdf"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for path in self._root.glob("*.tmp"):
+            path.unlink(missing_ok=True)
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self._root / f"{key}.pdf"
+
+    def get(self, key: str) -> Path | None:
+        if key in self._disk:
+            path = self._path(key)
+            if path.exists():
+                self._disk.move_to_end(key)
+                self._counters["hits"] += 1
+                return path
+            self._drop(key)
+        self._counters["misses"] += 1
+        return None
+
+    async def put_file(self, key: str, src: Path) -> Path:
+        """Adopt the PDF at src (hardlinked, or copied across filesystems) and
+        return its path in the cache. src is left in place."""
+        tmp = self._tmp_path(key)
+        try:
+            await asyncio.to_thread(_link_or_copy, src, tmp)
+            return self._commit(key, tmp)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def alias(self, key: str, path: Path) -> Path | None:
+        """Also serve the cached PDF at path under key. Entries are replaced,
+        never rewritten in place, so two keys can share one file."""
+        tmp = self._tmp_path(key)
+        try:
+            os.link(path, tmp)
+            return self._commit(key, tmp)
+        except OSError as e:
+            log.warning("Failed to alias PDF cache entry: %s", e)
+            return None
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    async def tee(self, key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass chunks through while writing them to the cache. The entry is
+        only committed if the stream is consumed to the end."""
+        tmp = self._tmp_path(key)
+        try:
+            with open(tmp, "wb") as out:
+                async for chunk in chunks:
+                    out.write(chunk)
+                    yield chunk
+            self._commit(key, tmp)
+        except OSError as e:
+            log.warning("Failed to write PDF cache entry: %s", e)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def _tmp_path(self, key: str) -> Path:
+        fd, name = tempfile.mkstemp(dir=self._root, prefix=f"{key}.", suffix=".tmp")
+        os.close(fd)
+        os.unlink(name)
+        return Path(name)
+
+    def _commit(self, key: str, tmp: Path) -> Path:
+        size = tmp.stat().st_size
+        path = self._path(key)
+        self._counters["puts"] += 1
+        os.replace(tmp, path)
+        self._disk_bytes += size - self._disk.pop(key, 0)
+        self._disk[key] = size
+        self._evict(keep=key)
+        return path
+
+    def _drop(self, key: str) -> None:
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+        self._path(key).unlink(missing_ok=True)
+
+    def _evict(self, keep: str | None = None) -> None:
+        # Unlinking is safe while a response is still streaming the file
+        while self._disk_bytes > self._disk_limit and self._disk:
+            key = next(iter(self._disk))
+            if key == keep:
+                break
+            self._drop(key)
+            self._counters["evictions"] += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            **self._counters,
+            "entries": len(self._disk),
+            "bytes": self._disk_bytes,
+        }
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
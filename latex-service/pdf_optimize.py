@@ -0,0 +1,80 @@
+"""Post-processing of compiled PDFs with qpdf.
+
+Engines write PDFs in whatever order they produce objects, so a viewer can't
+paint page 1 before it has the whole file. qpdf rewrites the PDF linearized
+("fast web view": page 1's objects first, plus hint tables for range requests)
+and packs objects into compressed object streams. Streams the engine already
+compressed are left as they are; recompressing them costs far more CPU than
+the bytes it saves.
+
+The result replaces the engine's PDF in the cache once it is ready. Any
+failure leaves the engine's PDF in place, so this stage can only cost time,
+never a compile.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import metrics
+import scratch
+from runner import run_process
+
+log = logging.getLogger(__name__)
+
+PDF_OPTIMIZE = os.environ.get("PDF_OPTIMIZE", "1") == "1"
+OPTIMIZE_CONCURRENCY = int(os.environ.get("OPTIMIZE_CONCURRENCY", "1"))
+OPTIMIZE_TIMEOUT = float(os.environ.get("OPTIMIZE_TIMEOUT", "30"))
+# Outside the compile slots, so it runs at the lowest CPU priority and only
+# gets what the compiles leave over
+OPTIMIZE_NICE = ("nice", "-n", "19")
+
+QPDF_FLAGS = (
+    "--linearize",
+    "--object-streams=generate",
+    "--compress-streams=y",
+)
+QPDF_WARNINGS = 3  # exit status when the output was written despite warnings
+
+
+class PdfOptimizer:
+    def __init__(self, enabled: bool = PDF_OPTIMIZE) -> None:
+        self.enabled = enabled
+        self._slots = asyncio.Semaphore(OPTIMIZE_CONCURRENCY)
+
+    def start(self) -> None:
+        if self.enabled and shutil.which("qpdf") is None:
+            log.warning("qpdf not found, PDFs are served as the engine wrote them")
+            self.enabled = False
+
+    async def optimize(self, pdf_path: Path) -> Path | None:
+        """Write a linearized, compressed copy of the PDF to a new temp dir and
+        return its path, or None if the stage is off or failed. The caller
+        removes the copy's dir."""
+        if not self.enabled:
+            return None
+        async with self._slots:
+            out_dir = scratch.mkdtemp("optimize-")
+            out = out_dir / "output.pdf"
+            try:
+                with metrics.timed("optimize"):
+                    cmd = [*OPTIMIZE_NICE, "qpdf", *QPDF_FLAGS, str(pdf_path), str(out)]
+                    result = await run_process(cmd, out_dir, OPTIMIZE_TIMEOUT)
+                if result.returncode not in (0, QPDF_WARNINGS) or not out.exists():
+                    raise RuntimeError(result.output[-500:])
+            except BaseException as e:
+                await asyncio.to_thread(shutil.rmtree, out_dir, True)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                log.warning("Failed to optimize %s: %r", pdf_path.name, e)
+                metrics.PDF_OPTIMIZE.inc("failed")
+                return None
+
+        before, after = pdf_path.stat().st_size, out.stat().st_size
+        metrics.PDF_OPTIMIZE.inc("optimized")
+        metrics.PDF_OPTIMIZE_BYTES.inc("before", amount=before)
+        metrics.PDF_OPTIMIZE_BYTES.inc("after", amount=after)
+        log.info("Optimized %s: %d -> %d bytes", pdf_path.name, before, after)
+        return out
@@ -1,104 +1,551 @@
 import asyncio
-import random
+import itertools
+import logging
+import os
 import shutil
-from concurrent.futures import ProcessPoolExecutor
+import time
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import Callable
 from dataclasses import dataclass, field
 
+import capacity
+import metrics
+import warmup
 from compiler import CompileResult, compile_latex
+from deps import DependencyGraph
+from pdf_cache import PdfCache
+from pdf_optimize import PdfOptimizer
+from scheduler import FairScheduler
 
-MAX_CONCURRENT = 2
-MAX_QUEUE_SIZE = 20
+log = logging.getLogger(__name__)
 
+# Upper bound on concurrent compiles; 0 sizes it from available CPUs and memory.
+MAX_CONCURRENT = int(os.environ.get("MAX_CONCURRENT", "0"))
+MEMORY_PER_JOB = int(os.environ.get("MEMORY_PER_JOB", str(512 * 1024 * 1024)))
+# Admission is decided by estimated wait; this only bounds memory held by the queue.
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "200"))
 
-@dataclass
+ADJUST_INTERVAL = 5.0
+DEFAULT_JOB_SECONDS = 10.0
+EWMA_ALPHA = 0.3
+HIGH_PRESSURE = 0.4  # share of time this cgroup's tasks waited for CPU (PSI)
+LOW_PRESSURE = 0.1
+HIGH_LOAD = 1.25  # 1-minute host load average per CPU, where PSI is unavailable
+LOW_LOAD = 0.75
+SLOWDOWN_LIMIT = 2.0  # compiles taking this much more wall time than CPU time means contention
+# Kill a running compile when a newer version of its project is submitted,
+# not just drop queued ones.
+SUPERSEDE_RUNNING = os.environ.get("SUPERSEDE_RUNNING", "1") == "1"
+# Idle-priority jobs (prefetch compiles): how many may queue, and run at once
+MAX_IDLE_QUEUED = int(os.environ.get("MAX_IDLE_QUEUED", "16"))
+MAX_IDLE_RUNNING = int(os.environ.get("MAX_IDLE_RUNNING", "1"))
+MAX_TRACKED_PROJECTS = 10_000
+
+
+@dataclass(eq=False)
 class Job:
     work_dir: str
     entrypoint: str
     timeout: int
     compiler: str = "pdflatex"
     halt_on_error: bool = False
+    draft: bool = False
+    include_only: tuple[str, ...] = ()
+    keep_work_dir: bool = False  # work_dir is a leased build dir, not a temp dir
+    key: str | None = None  # identical jobs share one execution (see QueueManager.join)
+    project_id: str | None = None  # newer versions of a project supersede this job
+    result_key: str | None = None  # PDF cache key the output is stored under
+    deps: DependencyGraph | None = None
     future: asyncio.Future[CompileResult] = field(default_factory=lambda: asyncio.get_event_loop().create_future())
+    waiters: int = 1
+    client_id: str | None = None
+    idle: bool = False  # runs only on spare capacity and yields to everything else
+    started: bool = False
+    superseded: bool = False
+    preempted: bool = False
+    task: asyncio.Task[None] | None = None
+    submitted_at: float = 0.0
+    started_at: float = 0.0
+    compile_seconds: float = 0.0  # wall time of the compile itself
+    predicted_cost: float = 0.0  # CPU-seconds the client was charged at dispatch
+    output_listeners: list[Callable[[str], None]] = field(default_factory=list)
+    # Called with a successful result once its PDF in the cache is final,
+    # i.e. after optimization
+    on_stored: list[Callable[[CompileResult], None]] = field(default_factory=list)
+
+    def emit_output(self, line: str) -> None:
+        for listener in self.output_listeners:
+            listener(line)
+
+    @property
+    def cost_key(self) -> str:
+        """Jobs with the same cost key are expected to take similar time."""
+        return self.project_id or self.key or self.entrypoint
+
+
+def max_workers() -> int:
+    if MAX_CONCURRENT > 0:
+        return MAX_CONCURRENT
+    by_cpu = int(capacity.available_cpus())
+    memory = capacity.total_memory()
+    by_memory = memory // MEMORY_PER_JOB if memory else by_cpu
+    return max(1, min(by_cpu, by_memory))
+
+
+def superseded_result() -> CompileResult:
+    return CompileResult(
+        success=False,
+        pdf_path=None,
+        log_tail="Superseded by a newer compilation of this project",
+        superseded=True,
+    )
+
+
+def cancelled_result() -> CompileResult:
+    return CompileResult(success=False, pdf_path=None, log_tail="Compilation was cancelled")
 
 
 class QueueManager:
-    def __init__(self) -> None:
-        self._client_jobs: dict[str, list[Job]] = {}
-        self._pending_count = 0
-        self._semaphore = asyncio.Semaphore(MAX_CONCURRENT)
-        self._executor = ProcessPoolExecutor(max_workers=MAX_CONCURRENT)
+    def __init__(self, pdf_cache: PdfCache, optimizer: PdfOptimizer) -> None:
+        self._pdf_cache = pdf_cache
+        self._optimizer = optimizer
+        self._pending = FairScheduler()
+        self._idle: deque[Job] = deque()
+        self._inflight: dict[str, Job] = {}
+        self._running: set[Job] = set()
+        self._post_processing: set[Job] = set()  # compiled, slot given back
+        # project_id -> (version, key) of the newest version seen
+        self._latest: OrderedDict[str, tuple[tuple[float, int], str]] = OrderedDict()
+        self._max_workers = max_workers()
+        self._limit = self._max_workers
+        self._active = 0
+        self._durations: OrderedDict[str, float] = OrderedDict()  # cost key -> EWMA seconds
+        self._mean_duration = DEFAULT_JOB_SECONDS
+        self._cpu_costs: OrderedDict[str, float] = OrderedDict()  # cost key -> EWMA CPU-seconds
+        self._mean_cpu_cost = DEFAULT_JOB_SECONDS
+        self._slowdown = 1.0  # EWMA of wall time / CPU time of finished compiles
+        self._observed = False  # a compile finished since the last adjustment
         self._has_work = asyncio.Event()
         self._shutdown = False
         self._dispatch_task: asyncio.Task[None] | None = None
+        self._adjust_task: asyncio.Task[None] | None = None
+        self._warmup_task: asyncio.Task[None] | None = None
+        self.ready = False  # warm-up finished
 
     async def start(self) -> None:
+        log.info("Queue starting with up to %d concurrent compiles", self._max_workers)
         self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+        self._adjust_task = asyncio.create_task(self._adjust_loop())
+        # Jobs don't wait for it; readiness (GET /ready) does
+        self._warmup_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self) -> None:
+        started = time.monotonic()
+        results = await warmup.warm_up()
+        self.ready = True
+        log.info("Ready after %.1fs of warm-up (%s)", time.monotonic() - started, results)
 
     async def stop(self) -> None:
         self._shutdown = True
         self._has_work.set()  # unblock the loop
-        if self._dispatch_task:
-            self._dispatch_task.cancel()
-            try:
-                await self._dispatch_task
-            except asyncio.CancelledError:
-                pass
-        self._executor.shutdown(wait=False)
+        for task in (self._dispatch_task, self._adjust_task, self._warmup_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        # Kill whatever is still compiling or post-processing
+        jobs = itertools.chain(self._running, self._post_processing)
+        tasks = [job.task for job in jobs if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def track(self, job: Job) -> None:
+        """Make job joinable under job.key until its future resolves."""
+        if job.key is None or self._inflight.get(job.key) is job:
+            return
+        self._inflight[job.key] = job
+
+        def untrack(_: asyncio.Future[CompileResult]) -> None:
+            if self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+
+        job.future.add_done_callback(untrack)
+
+    def join(self, key: str) -> Job | None:
+        """Attach another waiter to an in-flight job with the same key, if any.
+        Every successful join must be paired with release()."""
+        job = self._inflight.get(key)
+        if job is None or job.future.done():
+            return None
+        job.waiters += 1
+        if job.idle:
+            self._promote(job)
+        return job
+
+    def has(self, key: str) -> bool:
+        job = self._inflight.get(key)
+        return job is not None and not job.future.done()
+
+    def _promote(self, job: Job) -> None:
+        """Someone is now waiting on an idle job: give it normal priority."""
+        log.info("Promoting idle job %s", job.key)
+        job.idle = False
+        if job in self._idle:
+            self._idle.remove(job)
+            job.predicted_cost = self.predict_cost(job)
+            self._pending.push(job.client_id, job, job.predicted_cost)
+            self._has_work.set()
+
+    def release(self, job: Job) -> None:
+        """Drop one waiter. When the last waiter leaves, the job is removed from
+        the queue, or killed if it is already running."""
+        job.waiters -= 1
+        if job.waiters > 0 or job.future.done() or job.client_id is None:
+            return
+        if job.started:
+            log.info("Cancelling running job %s: no waiters left", job.key)
+            if job.task is not None:
+                job.task.cancel()
+        else:
+            self._remove_pending(job)
+        job.future.cancel()
+
+    def _remove_pending(self, job: Job) -> None:
+        if not self._pending.remove(job):
+            self._idle.remove(job)
+        if not job.keep_work_dir:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+    def announce(self, project_id: str, key: str, version: tuple[float, int]) -> None:
+        """Record key as project_id's content at version, which orders the
+        snapshots it was read from. If it is the newest known, queued jobs for
+        other keys resolve immediately as superseded, and running ones are
+        killed if SUPERSEDE_RUNNING is set. An older snapshot changes nothing;
+        its own job is then the one that is superseded."""
+        latest = self._latest.get(project_id)
+        if latest is not None and latest[0] > version:
+            return
+        self._latest[project_id] = (version, key)
+        self._latest.move_to_end(project_id)
+        while len(self._latest) > MAX_TRACKED_PROJECTS:
+            self._latest.popitem(last=False)
+
+        queued = itertools.chain(self._pending, self._idle)
+        for job in [j for j in queued if j.project_id == project_id and j.key != key]:
+            log.info("Superseding queued job %s", job.key)
+            self._remove_pending(job)
+            job.superseded = True
+            job.future.set_result(superseded_result())
+        if SUPERSEDE_RUNNING:
+            for job in self._running:
+                if job.project_id == project_id and job.key != key and not job.superseded:
+                    log.info("Superseding running job %s", job.key)
+                    job.superseded = True
+                    if job.task is not None:
+                        job.task.cancel()
+
+    def preempt_idle(self, project_id: str) -> None:
+        """Cancel idle jobs for project_id, queued or running, so a real
+        compile can have the project's build dir."""
+        for job in [j for j in self._inflight.values() if j.idle and j.project_id == project_id]:
+            log.info("Cancelling idle job %s for a compile of the same project", job.key)
+            self._cancel_idle(job)
+
+    def _cancel_idle(self, job: Job) -> None:
+        job.preempted = True
+        if job.started:
+            if job.task is not None:
+                job.task.cancel()
+            return
+        if job in self._idle:
+            self._idle.remove(job)
+        # Not queued yet: whoever is preparing it sees the future is done
+        job.future.cancel()
+
+    def is_superseded(self, project_id: str, key: str) -> bool:
+        latest = self._latest.get(project_id)
+        return latest is not None and latest[1] != key
 
     def submit(self, client_id: str, job: Job) -> None:
-        if self._pending_count >= MAX_QUEUE_SIZE:
-            raise QueueFullError()
-        if client_id not in self._client_jobs:
-            self._client_jobs[client_id] = []
-        self._client_jobs[client_id].append(job)
-        self._pending_count += 1
+        if job.project_id is not None and job.key is not None and self.is_superseded(job.project_id, job.key):
+            # A newer version arrived while this one was being prepared
+            job.superseded = True
+            job.future.set_result(superseded_result())
+            return
+        estimated_wait = self.estimated_wait()
+        if len(self._pending) >= MAX_QUEUE_SIZE or estimated_wait > job.timeout:
+            raise QueueFullError(estimated_wait)
+        self.track(job)
+        job.client_id = client_id
+        job.submitted_at = time.monotonic()
+        job.predicted_cost = self.predict_cost(job)
+        self._pending.push(client_id, job, job.predicted_cost)
+        self._has_work.set()
+
+    def submit_idle(self, client_id: str, job: Job) -> None:
+        """Queue job at idle priority: it starts only when no other job is
+        waiting, and is cancelled when one needs its slot. Idle jobs aren't
+        charged to their client, unless they're promoted by a join."""
+        if not job.idle:
+            # Promoted while it was being prepared
+            self.submit(client_id, job)
+            return
+        if job.project_id is not None and job.key is not None and self.is_superseded(job.project_id, job.key):
+            job.superseded = True
+            job.future.set_result(superseded_result())
+            return
+        if len(self._idle) >= MAX_IDLE_QUEUED:
+            oldest = self._idle.popleft()
+            log.info("Idle queue full, dropping %s", oldest.key)
+            oldest.future.cancel()
+        self.track(job)
+        job.client_id = client_id
+        job.submitted_at = time.monotonic()
+        self._idle.append(job)
         self._has_work.set()
 
     async def _dispatch_loop(self) -> None:
-        loop = asyncio.get_event_loop()
         while not self._shutdown:
             await self._has_work.wait()
             self._has_work.clear()
 
-            while self._pending_count > 0 and not self._shutdown:
-                await self._semaphore.acquire()
+            if self._pending and self._active >= self._limit:
+                self._preempt_for_pending()
 
-                # Pick a random client with pending jobs
-                clients_with_jobs = [
-                    cid for cid, jobs in self._client_jobs.items() if jobs
-                ]
-                if not clients_with_jobs:
-                    self._semaphore.release()
+            while self._active < self._limit and not self._shutdown:
+                job = self._pending.pop()
+                if job is None:
+                    job = self._pop_idle()
+                if job is None:
                     break
+                job.started = True
+                job.started_at = time.monotonic()
+                metrics.STAGE_SECONDS.observe(job.started_at - job.submitted_at, "queue_wait")
+                self._active += 1
+                self._running.add(job)
 
-                client_id = random.choice(clients_with_jobs)
-                job = self._client_jobs[client_id].pop(0)
-                if not self._client_jobs[client_id]:
-                    del self._client_jobs[client_id]
-                self._pending_count -= 1
+                job.task = asyncio.create_task(self._run_job(job))
+                job.task.add_done_callback(lambda task, job=job: self._task_done(job, task))
 
-                asyncio.create_task(self._run_job(loop, job))
+    def _pop_idle(self) -> Job | None:
+        if not self._idle or sum(1 for job in self._running if job.idle) >= MAX_IDLE_RUNNING:
+            return None
+        return self._idle.popleft()
 
-    async def _run_job(self, loop: asyncio.AbstractEventLoop, job: Job) -> None:
+    def _preempt_for_pending(self) -> None:
+        """Free a slot held by an idle job for each queued job that needs one;
+        the slots open up as the cancelled jobs finish."""
+        needed = len(self._pending) - sum(1 for job in self._running if job.preempted)
+        for job in self._running:
+            if needed <= 0:
+                break
+            if job.idle and not job.preempted:
+                log.info("Preempting idle job %s", job.key)
+                self._cancel_idle(job)
+                needed -= 1
+
+    async def _run_job(self, job: Job) -> None:
+        result: CompileResult | None = None
         try:
-            result = await loop.run_in_executor(
-                self._executor,
-                compile_latex,
-                job.work_dir,
-                job.entrypoint,
-                job.timeout,
-                job.compiler,
-                job.halt_on_error,
-            )
-            job.future.set_result(result)
+            try:
+                result = await compile_latex(
+                    job.work_dir,
+                    job.entrypoint,
+                    job.timeout,
+                    job.compiler,
+                    job.halt_on_error,
+                    on_output=job.emit_output,
+                    draft=job.draft,
+                    include_only=job.include_only,
+                    graph=job.deps,
+                )
+                job.compile_seconds = time.monotonic() - job.started_at
+                self._observe(job, job.compile_seconds, result.cpu_seconds)
+                outcome = _outcome(result)
+                if result.success and not job.superseded:
+                    # Move the PDF out of the work dir before it is removed or reused
+                    result.pdf_path = await self._pdf_cache.put_file(
+                        job.result_key or uuid.uuid4().hex, result.pdf_path
+                    )
+            except asyncio.CancelledError:
+                # Superseded, abandoned by its waiters, or shutting down; the
+                # process group is already dead.
+                result = cancelled_result()
+                outcome = "preempted" if job.preempted else "cancelled"
+            metrics.COMPILES.inc("superseded" if job.superseded else outcome)
         except Exception as e:
+            metrics.COMPILES.inc("error")
             if not job.future.done():
                 job.future.set_exception(e)
         finally:
-            self._semaphore.release()
-            self._has_work.set()  # re-check for more work
-            # Cleanup work dir
+            self._finish(job, result)
+        if result is None or job.future.done():
+            return
+        self._resolve(job, result)
+        if not result.success or job.superseded:
+            return
+        if not job.draft:
+            await self._post_process(job, result)
+        for callback in job.on_stored:
+            callback(result)
+
+    async def _post_process(self, job: Job, result: CompileResult) -> None:
+        """Replace the cached PDF with an optimized copy once the waiters have
+        the engine's. This runs outside the compile slots, limited by the
+        optimizer itself. Drafts are skipped: they're quick previews that are
+        soon replaced."""
+        self._post_processing.add(job)
+        try:
+            optimized = await self._optimizer.optimize(result.pdf_path)
+            if optimized is not None:
+                try:
+                    await self._pdf_cache.put_file(result.pdf_path.stem, optimized)
+                finally:
+                    shutil.rmtree(optimized.parent, ignore_errors=True)
+        except asyncio.CancelledError:
+            pass  # shutting down; the engine's PDF stays cached
+        finally:
+            self._post_processing.discard(job)
+
+    def _task_done(self, job: Job, task: asyncio.Task[None]) -> None:
+        # A task cancelled before its first step never enters _run_job, so
+        # none of its cleanup ran
+        if task.cancelled():
+            result = cancelled_result()
+            self._resolve(job, result)
+            self._finish(job, result)
+
+    def _resolve(self, job: Job, result: CompileResult) -> None:
+        if job.superseded:
+            result = superseded_result()
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _finish(self, job: Job, result: CompileResult | None) -> None:
+        # Settle the client's account with what the job really cost; a
+        # killed job is charged the wall time it held its slot.
+        actual = result.cpu_seconds if result is not None else 0.0
+        if not job.idle:
+            self._pending.charge(job.client_id, job.predicted_cost, actual or time.monotonic() - job.started_at)
+        self._running.discard(job)
+        self._active -= 1
+        self._has_work.set()  # re-check for more work
+        if not job.keep_work_dir:
             shutil.rmtree(job.work_dir, ignore_errors=True)
 
+    def position(self, job: Job) -> int | None:
+        """1-based place of a queued job in submission order, None once started."""
+        return self._pending.position(job)
+
+    def depths(self) -> dict[str, int]:
+        """Number of queued jobs per client."""
+        return self._pending.depths()
+
+    def predict(self, job: Job) -> float:
+        """Expected run time of job in seconds, from its project's history."""
+        return self._durations.get(job.cost_key, self._mean_duration)
+
+    def predict_cost(self, job: Job) -> float:
+        """Expected CPU-seconds of job, the unit clients are charged in."""
+        return self._cpu_costs.get(job.cost_key, self._mean_cpu_cost)
+
+    def _observe(self, job: Job, elapsed: float, cpu_seconds: float) -> None:
+        if cpu_seconds > 0.1:
+            # latexmk's passes run one at a time, so an uncontended compile
+            # is on CPU most of its wall time
+            self._slowdown += EWMA_ALPHA * (elapsed / cpu_seconds - self._slowdown)
+            self._observed = True
+        metrics.STAGE_SECONDS.observe(elapsed, "compile")
+        if cpu_seconds:
+            metrics.COMPILE_CPU_SECONDS.observe(cpu_seconds)
+        _update_ewma(self._durations, job.cost_key, elapsed)
+        self._mean_duration += EWMA_ALPHA * (elapsed - self._mean_duration)
+        cost = cpu_seconds or elapsed
+        _update_ewma(self._cpu_costs, job.cost_key, cost)
+        self._mean_cpu_cost += EWMA_ALPHA * (cost - self._mean_cpu_cost)
+
+    def estimated_wait(self) -> float:
+        """Seconds a newly submitted job would wait before starting."""
+        if self._active < self._limit and not self._pending:
+            return 0.0
+        now = time.monotonic()
+        # Idle jobs give up their slots as soon as anything else is queued
+        running = sum(
+            max(self.predict(job) - (now - job.started_at), 0.0) for job in self._running if not job.idle
+        )
+        pending = sum(self.predict(job) for job in self._pending)
+        return (running + pending) / self._limit
+
+    async def _adjust_loop(self) -> None:
+        """Additive-increase / decrease of the concurrency limit: back off when
+        the container is short of CPU or memory, grow back while there is a
+        backlog and headroom."""
+        while not self._shutdown:
+            await asyncio.sleep(ADJUST_INTERVAL)
+            if not self._observed:
+                # Nothing finished to say otherwise; let an old reading fade
+                self._slowdown += EWMA_ALPHA * (1.0 - self._slowdown)
+            self._observed = False
+            pressure = capacity.cpu_pressure()
+            if pressure is not None:
+                load, overloaded, headroom = pressure, pressure > HIGH_PRESSURE, pressure < LOW_PRESSURE
+            else:
+                load = capacity.load_per_cpu()
+                overloaded, headroom = load > HIGH_LOAD, load < LOW_LOAD
+            memory_short = capacity.available_memory() < MEMORY_PER_JOB
+            if (overloaded or self._slowdown > SLOWDOWN_LIMIT or memory_short) and self._limit > 1:
+                self._limit -= 1
+                log.info(
+                    "Concurrency limit down to %d (load=%.2f, slowdown=%.2f, memory_short=%s)",
+                    self._limit, load, self._slowdown, memory_short,
+                )
+            elif (
+                headroom
+                and self._slowdown < SLOWDOWN_LIMIT
+                and self._pending
+                and self._limit < self._max_workers
+            ):
+                self._limit += 1
+                log.info("Concurrency limit up to %d (load=%.2f)", self._limit, load)
+                self._has_work.set()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "concurrency_limit": self._limit,
+            "max_workers": self._max_workers,
+            "active": self._active,
+            "pending": len(self._pending),
+            "idle_pending": len(self._idle),
+            "post_processing": len(self._post_processing),
+            "estimated_wait": round(self.estimated_wait(), 2),
+            "mean_job_seconds": round(self._mean_duration, 2),
+            "slowdown": round(self._slowdown, 2),
+            "ready": self.ready,
+        }
+
+
+def _outcome(result: CompileResult) -> str:
+    if result.success:
+        return "success"
+    return "timed_out" if result.timed_out else "failed"
+
+
+def _update_ewma(table: OrderedDict[str, float], key: str, value: float) -> None:
+    history = table.get(key)
+    if history is None:
+        table[key] = value
+        while len(table) > MAX_TRACKED_PROJECTS:
+            table.popitem(last=False)
+    else:
+        table[key] = history + EWMA_ALPHA * (value - history)
+        table.move_to_end(key)
+
 
 class QueueFullError(Exception):
-    pass
+    def __init__(self, estimated_wait: float) -> None:
+        super().__init__(f"Estimated wait {estimated_wait:.0f}s")
+        self.estimated_wait = estimated_wait
@@ -0,0 +1,113 @@
+"""Asyncio subprocess execution for TeX tools.
+
+Each command runs in its own session so the whole tree (latexmk plus the
+engines, biber, makeindex it spawns) can be killed as one process group on
+timeout or cancellation.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import tempfile
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+OUTPUT_TAIL_LINES = 200
+STREAM_LIMIT = 1024 * 1024  # longest single output line we accept
+
+# GNU time reports the CPU used by a command and every descendant it waited
+# for (latexmk waits for its engines). Without it we fall back to wall time.
+GNU_TIME = shutil.which("time", path="/usr/bin:/bin")
+
+
+@dataclass
+class ProcessResult:
+    returncode: int
+    output: str  # last OUTPUT_TAIL_LINES lines of merged stdout/stderr
+    cpu_seconds: float  # user + system CPU of the process tree, or wall time
+
+
+async def run_process(
+    cmd: list[str],
+    cwd: Path,
+    timeout: float,
+    on_output: Callable[[str], None] | None = None,
+    env: dict[str, str] | None = None,
+) -> ProcessResult:
+    """Run cmd, streaming its output line by line to on_output.
+
+    Raises TimeoutError after `timeout` seconds. On timeout or cancellation the
+    process group is killed and reaped before the exception propagates.
+    """
+    if timeout <= 0:
+        raise TimeoutError()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    times_file = None
+    if GNU_TIME:
+        fd, times_file = tempfile.mkstemp(prefix="cputime-")
+        os.close(fd)
+        cmd = [GNU_TIME, "-q", "-f", "%U %S", "-o", times_file, *cmd]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True,
+        limit=STREAM_LIMIT,
+        env=env,
+    )
+    tail: deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    async def pump() -> None:
+        assert proc.stdout is not None
+        async for raw in proc.stdout:
+            line = raw.decode("utf-8", errors="replace").rstrip("\n")
+            tail.append(line)
+            if on_output is not None:
+                on_output(line)
+        await proc.wait()
+
+    try:
+        await asyncio.wait_for(pump(), timeout=timeout)
+        cpu_seconds = _read_cpu_seconds(times_file)
+    except BaseException:
+        # Also after the leader exited: engines or helpers it left behind are
+        # still in the group, and Linux keeps the group id while they live
+        _kill_group(proc.pid)
+        await asyncio.shield(proc.wait())
+        raise
+    finally:
+        if times_file:
+            os.unlink(times_file)
+
+    if cpu_seconds is None:
+        cpu_seconds = loop.time() - started
+    return ProcessResult(returncode=proc.returncode, output="\n".join(tail), cpu_seconds=cpu_seconds)
+
+
+def _read_cpu_seconds(times_file: str | None) -> float | None:
+    if times_file is None:
+        return None
+    try:
+        with open(times_file) as f:
+            user, system = f.read().split()[-2:]
+        return float(user) + float(system)
+    except (OSError, ValueError):
+        return None
+
+
+def _kill_group(pgid: int) -> None:
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    except PermissionError as e:
+        log.warning("Could not kill process group %d: %s", pgid, e)
@@ -0,0 +1,114 @@
+"""Deficit round robin over clients, shortest predicted job first within a client.
+
+Each client with queued work sits in a ring and earns QUANTUM seconds of credit
+per turn. It may dispatch its cheapest job once its credit covers that job's
+predicted cost. Clients are later charged the CPU-seconds the job actually
+used, so a client submitting long builds gets proportionally fewer turns than
+one submitting short ones.
+"""
+
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from typing import Any
+
+QUANTUM = 5.0  # seconds of credit granted per round
+MAX_TRACKED_CLIENTS = 10_000
+
+
+@dataclass(order=True)
+class _Entry:
+    cost: float
+    seq: int
+    job: Any = field(compare=False)
+
+
+class FairScheduler:
+    def __init__(self) -> None:
+        self._queues: dict[str, list[_Entry]] = {}  # client -> heap of queued jobs
+        self._ring: deque[str] = deque()  # clients with queued jobs, in turn order
+        self._deficits: OrderedDict[str, float] = OrderedDict()
+        self._entries: dict[int, tuple[str, _Entry]] = {}  # id(job) -> (client, entry)
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Any]:
+        return (entry.job for _, entry in self._entries.values())
+
+    def push(self, client_id: str, job: Any, cost: float) -> None:
+        entry = _Entry(cost, next(self._seq), job)
+        queue = self._queues.get(client_id)
+        if queue is None:
+            queue = self._queues[client_id] = []
+            self._ring.append(client_id)
+        heapq.heappush(queue, entry)
+        self._entries[id(job)] = (client_id, entry)
+
+    def remove(self, job: Any) -> bool:
+        found = self._entries.pop(id(job), None)
+        if found is None:
+            return False
+        client_id, entry = found
+        queue = self._queues[client_id]
+        queue.remove(entry)
+        heapq.heapify(queue)
+        if not queue:
+            self._deactivate(client_id)
+        return True
+
+    def position(self, job: Any) -> int | None:
+        """How many queued jobs were submitted before job, plus one. Dispatch
+        order also depends on cost and fairness, so this is approximate."""
+        found = self._entries.get(id(job))
+        if found is None:
+            return None
+        seq = found[1].seq
+        return 1 + sum(1 for _, entry in self._entries.values() if entry.seq < seq)
+
+    def depths(self) -> dict[str, int]:
+        return {client_id: len(queue) for client_id, queue in self._queues.items()}
+
+    def pop(self) -> Any | None:
+        """Return the next job to run, or None if nothing is queued."""
+        while self._ring:
+            client_id = self._ring[0]
+            queue = self._queues[client_id]
+            deficit = self._deficits.get(client_id, 0.0)
+            head = queue[0]
+            if deficit >= head.cost:
+                heapq.heappop(queue)
+                del self._entries[id(head.job)]
+                self._set_deficit(client_id, deficit - head.cost)
+                if not queue:
+                    self._deactivate(client_id, at_front=True)
+                return head.job
+            self._set_deficit(client_id, deficit + QUANTUM)
+            self._ring.rotate(-1)
+        return None
+
+    def charge(self, client_id: str, predicted: float, actual: float) -> None:
+        """Settle the difference between what a job was expected to cost at
+        dispatch and what it measurably used."""
+        deficit = self._deficits.get(client_id, 0.0) + predicted - actual
+        if client_id not in self._queues:
+            deficit = min(deficit, 0.0)
+        self._set_deficit(client_id, deficit)
+
+    def _deactivate(self, client_id: str, at_front: bool = False) -> None:
+        del self._queues[client_id]
+        if at_front:
+            self._ring.popleft()
+        else:
+            self._ring.remove(client_id)
+        # Idle clients don't bank credit, but keep any debt from overruns
+        self._set_deficit(client_id, min(self._deficits.get(client_id, 0.0), 0.0))
+
+    def _set_deficit(self, client_id: str, value: float) -> None:
+        self._deficits[client_id] = value
+        self._deficits.move_to_end(client_id)
+        while len(self._deficits) > MAX_TRACKED_CLIENTS:
+            self._deficits.popitem(last=False)
@@ -0,0 +1,58 @@
+"""RAM-backed scratch space for compile work dirs.
+
+Every latexmk pass rewrites .aux, .log, .toc and friends, so work dirs see a
+lot of small-file churn. With SCRATCH_DIR on a size-capped tmpfs mount, new
+throwaway work dirs are created there, and fall back to disk while it is
+short of space. Unset, work dirs stay where they always were.
+
+Persistent build dirs (build_cache) stay on disk: free space is only checked
+when a dir is created, and they keep growing between compiles.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "")  # a dedicated tmpfs mount
+SCRATCH_RESERVE_BYTES = int(os.environ.get("SCRATCH_RESERVE_BYTES", str(64 * 1024 * 1024)))
+SCRATCH_FALLBACK_DIR = Path(os.environ.get("SCRATCH_FALLBACK_DIR", tempfile.gettempdir()))
+
+_root = Path(SCRATCH_DIR) / "work" if SCRATCH_DIR else None
+
+
+def start() -> None:
+    if _root is None:
+        return
+    # Dirs left by a previous process are owned by nobody now
+    shutil.rmtree(_root, ignore_errors=True)
+    _root.mkdir(parents=True, exist_ok=True)
+    usage = shutil.disk_usage(_root)
+    log.info("Scratch space at %s: %d MB free of %d MB", _root, usage.free // 2**20, usage.total // 2**20)
+
+
+def _has_room() -> bool:
+    try:
+        return shutil.disk_usage(_root).free >= SCRATCH_RESERVE_BYTES
+    except OSError:
+        return False
+
+
+def mkdtemp(prefix: str) -> Path:
+    """A new empty dir on the scratch area, or under SCRATCH_FALLBACK_DIR when
+    the scratch area is off or nearly full."""
+    if _root is not None and _has_room():
+        try:
+            path = Path(tempfile.mkdtemp(prefix=prefix, dir=_root))
+            metrics.WORK_DIRS.inc("scratch")
+            return path
+        except OSError as e:
+            log.warning("Scratch space unavailable: %s", e)
+    SCRATCH_FALLBACK_DIR.mkdir(parents=True, exist_ok=True)
+    metrics.WORK_DIRS.inc("disk")
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=SCRATCH_FALLBACK_DIR))
@@ -0,0 +1,49 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+SERVICE_URL="${LATEX_SERVICE_URL:-http://localhost:8417}"
+AUTH="Authorization: Bearer ${LATEX_API_SECRET:?LATEX_API_SECRET must be set}"
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+OUT_DIR="$SCRIPT_DIR/output"
+FILES=(main.tex example.jpg)
+
+mkdir -p "$OUT_DIR"
+cd "$SCRIPT_DIR"
+
+# Build the manifest: one (path, sha256, size) entry per file
+echo "==> Building manifest..."
+MANIFEST=$(for f in "${FILES[@]}"; do
+  printf '{"path":"%s","sha256":"%s","size":%d}\n' "$f" "$(sha256sum "$f" | cut -d' ' -f1)" "$(stat -c %s "$f")"
+done | jq -s '{files: .}')
+
+# Ask which contents the service doesn't have yet
+MISSING=$(curl -sf -H "$AUTH" -H "Content-Type: application/json" \
+  -d "$MANIFEST" "$SERVICE_URL/manifest" | jq -r '.missing[]')
+
+# Upload only those
+for f in "${FILES[@]}"; do
+  HASH=$(sha256sum "$f" | cut -d' ' -f1)
+  if grep -qx "$HASH" <<<"$MISSING"; then
+    echo "==> Uploading $f"
+    curl -sf -H "$AUTH" -X PUT --data-binary "@$f" "$SERVICE_URL/blobs/$HASH" >/dev/null
+  else
+    echo "==> Skipping $f (already cached)"
+  fi
+done
+
+echo "==> Compiling via $SERVICE_URL/compile-manifest..."
+HTTP_CODE=$(curl -s -o "$OUT_DIR/result.pdf" -w "%{http_code}" \
+  -H "$AUTH" -H "Content-Type: application/json" \
+  -d "$(jq '. + {entrypoint: "main.tex"}' <<<"$MANIFEST")" \
+  "$SERVICE_URL/compile-manifest")
+
+if [ "$HTTP_CODE" = "200" ]; then
+  FILE_TYPE=$(file -b "$OUT_DIR/result.pdf")
+  echo "==> OK (HTTP $HTTP_CODE): $FILE_TYPE"
+  echo "    Output: $OUT_DIR/result.pdf"
+else
+  echo "==> FAILED (HTTP $HTTP_CODE)"
+  cat "$OUT_DIR/result.pdf"  # will contain error JSON
+  echo
+  exit 1
+fi
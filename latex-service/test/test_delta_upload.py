@@ -0,0 +1,37 @@
+import pytest
+
+import delta_upload
+from blob_cache import BlobCache
+from zip_safety import ZipSafetyError
+
+DIGEST = "0" * 64
+
+
+def _manifest(*paths: str) -> delta_upload.Manifest:
+    return delta_upload.Manifest(files=[{"path": path, "sha256": DIGEST, "size": 1} for path in paths])
+
+
+def test_nested_paths_are_accepted():
+    delta_upload.validate(_manifest("main.tex", "chapters/one.tex", "chapters/two.tex"))
+
+
+@pytest.mark.parametrize("paths", [("a", "a/b"), ("a/b/c", "a/b"), ("a/b", "a//b"), (".", "main.tex")])
+def test_clashing_paths_are_rejected(paths):
+    with pytest.raises(ZipSafetyError):
+        delta_upload.validate(_manifest(*paths))
+
+
+def test_path_traversal_is_rejected():
+    with pytest.raises(ZipSafetyError):
+        delta_upload.validate(_manifest("../main.tex"))
+
+
+def test_declared_sizes_must_match_the_stored_blobs(tmp_path):
+    cache = BlobCache(tmp_path)
+    cache.start()
+    blob = tmp_path / "blob"
+    blob.write_bytes(b"hello")
+    cache.put_file(blob, DIGEST)
+    delta_upload.check_sizes(delta_upload.Manifest(files=[{"path": "a.tex", "sha256": DIGEST, "size": 5}]), cache)
+    with pytest.raises(ZipSafetyError):
+        delta_upload.check_sizes(delta_upload.Manifest(files=[{"path": "a.tex", "sha256": DIGEST, "size": 0}]), cache)
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import deps
+
+
+def _project(tmp_path: Path, files: dict[str, str]) -> Path:
+    for name, content in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return tmp_path
+
+
+def _hash(work_dir: Path, entrypoint: str = "main.tex") -> str | None:
+    return deps.resolve(work_dir, entrypoint).dependency_hash
+
+
+def test_unreached_tex_file_is_ignored(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": r"\input{chapter1}", "chapter1.tex": "a", "scratch.tex": "x"})
+    before = _hash(work_dir)
+    (work_dir / "scratch.tex").write_text("y")
+    assert before is not None
+    assert _hash(work_dir) == before
+
+
+def test_braced_input_is_followed(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": r"\input{chapter1}", "chapter1.tex": "a"})
+    before = _hash(work_dir)
+    (work_dir / "chapter1.tex").write_text("b")
+    assert _hash(work_dir) != before
+
+
+def test_bare_input_is_followed(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": "\\input chapter1\\relax\n", "chapter1.tex": "a"})
+    graph = deps.resolve(work_dir, "main.tex")
+    assert "chapter1.tex" in graph.files
+    before = graph.dependency_hash
+    (work_dir / "chapter1.tex").write_text("b")
+    assert _hash(work_dir) != before
+
+
+def test_bare_input_of_macro_is_incomplete(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": "\\def\\chap{chapter1}\\input\\chap", "chapter1.tex": "a"})
+    graph = deps.resolve(work_dir, "main.tex")
+    assert not graph.complete
+    assert graph.dependency_hash is None
+
+
+def test_standalone_and_glossary_files_are_followed(tmp_path):
+    work_dir = _project(
+        tmp_path,
+        {
+            "main.tex": "\\includestandalone[width=5cm]{figure}\n\\loadglsentries{glossary}",
+            "figure.tex": "a",
+            "glossary.tex": "a",
+        },
+    )
+    assert {"figure.tex", "glossary.tex"} <= deps.resolve(work_dir, "main.tex").files
+
+
+def test_tex_file_read_by_unknown_command_counts(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": r"\readmyfile{appendix}", "appendix.tex": "a"})
+    before = _hash(work_dir)
+    (work_dir / "appendix.tex").write_text("b")
+    assert _hash(work_dir) != before
+
+
+def test_commented_out_input_is_ignored(tmp_path):
+    work_dir = _project(tmp_path, {"main.tex": "% \\input{old}\ntext", "old.tex": "a"})
+    before = _hash(work_dir)
+    (work_dir / "old.tex").write_text("b")
+    assert _hash(work_dir) == before
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from runner import run_process
+
+
+def _run(*args):
+    async def run():
+        try:
+            return await run_process(*args)
+        finally:
+            await asyncio.sleep(0.1)  # let the subprocess transport close
+
+    return asyncio.run(run())
+
+
+def _alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != "Z"
+
+
+def test_timeout_kills_children_the_leader_left_behind(tmp_path):
+    pid_file = tmp_path / "pid"
+    # The leader exits at once; the backgrounded sleep keeps the output open
+    cmd = ["sh", "-c", f"sleep 37 & echo $! > {pid_file}; echo hi"]
+    with pytest.raises(TimeoutError):
+        _run(cmd, tmp_path, 1.5)
+    pid = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while _alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not _alive(pid)
+
+
+def test_output_and_return_code(tmp_path):
+    result = _run(["sh", "-c", "echo hi; exit 3"], tmp_path, 10)
+    assert result.returncode == 3
+    assert result.output == "hi"
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,32 @@
+import io
+import zipfile
+
+import pytest
+
+from zip_safety import ZipSafetyError, validate_and_extract
+
+
+def _zip(files: dict[str, bytes]) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    buf.seek(0)
+    return buf
+
+
+def test_extracts_nested_files(tmp_path):
+    validate_and_extract(_zip({"main.tex": b"a", "chapters/one.tex": b"b"}), tmp_path)
+    assert (tmp_path / "chapters" / "one.tex").read_bytes() == b"b"
+
+
+def test_file_and_directory_with_the_same_name_are_rejected(tmp_path):
+    with pytest.raises(ZipSafetyError):
+        validate_and_extract(_zip({"a": b"file", "a/b": b"nested"}), tmp_path)
+    with pytest.raises(ZipSafetyError):
+        validate_and_extract(_zip({"c/d": b"nested", "c": b"file"}), tmp_path)
+
+
+def test_path_traversal_is_rejected(tmp_path):
+    with pytest.raises(ZipSafetyError):
+        validate_and_extract(_zip({"../evil.tex": b"x"}), tmp_path)
@@ -0,0 +1,210 @@
+"""Background upload of compiled project PDFs to Convex.
+
+A finished /compile-project result is spooled to disk (a link or copy of the
+PDF cache entry plus a small JSON record) and uploaded by a few async workers,
+so no PDF is held in memory and no executor thread waits on the network.
+
+Uploads coalesce per project: a pending upload that hasn't started yet is
+replaced by a newer result of the same project, since only the latest
+version is worth caching. The queue holds at most MAX_PENDING_UPLOADS
+projects; past that the oldest pending upload is dropped, which only costs a
+Convex cache miss later. Failed uploads are retried with backoff, here and
+nowhere below. Once the PDF is in storage its id is kept in the record, so a
+failed saveCompilation is retried without sending the PDF again.
+
+On shutdown the queue drains for up to UPLOAD_DRAIN_TIMEOUT. Whatever is
+left stays in the spool and is picked up by the next start.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import convex_fetcher
+import metrics
+
+log = logging.getLogger(__name__)
+
+UPLOAD_SPOOL_DIR = Path(os.environ.get("UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "latex-uploads")))
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "2"))
+MAX_PENDING_UPLOADS = int(os.environ.get("MAX_PENDING_UPLOADS", "256"))
+UPLOAD_ATTEMPTS = 5
+UPLOAD_RETRY_DELAY = 2.0  # seconds, doubled per attempt, with jitter
+UPLOAD_DRAIN_TIMEOUT = float(os.environ.get("UPLOAD_DRAIN_TIMEOUT", "20"))
+
+
+@dataclass
+class Upload:
+    project_id: str
+    zip_hash: str
+    pdf: Path  # the spooled copy
+    record: Path
+    storage_id: str | None = None  # set once the PDF is in Convex storage
+
+    def discard(self) -> None:
+        self.pdf.unlink(missing_ok=True)
+        self.record.unlink(missing_ok=True)
+
+
+class UploadQueue:
+    def __init__(self, root: Path = UPLOAD_SPOOL_DIR, workers: int = UPLOAD_WORKERS) -> None:
+        self._root = root
+        self._workers = workers
+        self._pending: OrderedDict[str, Upload] = OrderedDict()  # project id -> newest result
+        self._has_work = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._active = 0
+        self._tasks: list[asyncio.Task[None]] = []
+        self._spooling: set[asyncio.Task[None]] = set()
+        self._stopping = False
+        self._counters = {"uploaded": 0, "failed": 0, "coalesced": 0, "dropped": 0}
+
+    def start(self) -> None:
+        self._root.mkdir(parents=True, exist_ok=True)
+        self._recover()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    def _recover(self) -> None:
+        """Queue what a previous run left in the spool, newest per project."""
+        records = sorted(self._root.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for record in records:
+            try:
+                meta = json.loads(record.read_text())
+                upload = Upload(
+                    meta["project_id"], meta["zip_hash"], record.with_suffix(".pdf"), record, meta.get("storage_id")
+                )
+            except (OSError, ValueError, KeyError):
+                record.unlink(missing_ok=True)
+                continue
+            if upload.pdf.exists():
+                self._queue(upload)
+            else:
+                upload.discard()
+        for orphan in self._root.glob("*.pdf"):
+            if not orphan.with_suffix(".json").exists():
+                orphan.unlink(missing_ok=True)
+        if self._pending:
+            log.info("Recovered %d spooled upload(s)", len(self._pending))
+
+    def submit(self, pdf_path: Path, project_id: str, zip_hash: str) -> None:
+        """Spool a result for upload, in the background. pdf_path must not be
+        rewritten in place (PDF cache entries are replaced by rename, so a
+        hardlink is safe)."""
+        task = asyncio.create_task(self._spool(pdf_path, project_id, zip_hash))
+        self._spooling.add(task)
+        task.add_done_callback(self._spooling.discard)
+
+    async def _spool(self, pdf_path: Path, project_id: str, zip_hash: str) -> None:
+        name = hashlib.sha256(f"{project_id}\0{zip_hash}".encode()).hexdigest()[:32]
+        upload = Upload(project_id, zip_hash, self._root / f"{name}.pdf", self._root / f"{name}.json")
+        try:
+            # A copy when the spool is on another filesystem than the PDF cache
+            await asyncio.to_thread(self._write, pdf_path, upload)
+        except OSError as e:
+            log.warning("Failed to spool upload for project=%s: %s", project_id, e)
+            upload.discard()
+            return
+        if self._stopping:
+            return  # stays spooled for the next start
+        self._queue(upload)
+
+    @staticmethod
+    def _write(pdf_path: Path, upload: Upload) -> None:
+        try:
+            os.link(pdf_path, upload.pdf)
+        except FileExistsError:
+            pass  # already spooled
+        except OSError:
+            shutil.copyfile(pdf_path, upload.pdf)
+        UploadQueue._write_record(upload)
+
+    @staticmethod
+    def _write_record(upload: Upload) -> None:
+        meta = {"project_id": upload.project_id, "zip_hash": upload.zip_hash}
+        if upload.storage_id is not None:
+            meta["storage_id"] = upload.storage_id
+        upload.record.write_text(json.dumps(meta))
+
+    def _queue(self, upload: Upload) -> None:
+        previous = self._pending.pop(upload.project_id, None)
+        if previous is not None and previous.pdf != upload.pdf:
+            previous.discard()
+            self._count("coalesced")
+        self._pending[upload.project_id] = upload
+        while len(self._pending) > MAX_PENDING_UPLOADS:
+            _, oldest = self._pending.popitem(last=False)
+            log.warning("Upload queue full, dropping upload for project=%s", oldest.project_id)
+            oldest.discard()
+            self._count("dropped")
+        self._idle.clear()
+        self._has_work.set()
+
+    def _count(self, outcome: str) -> None:
+        self._counters[outcome] += 1
+        metrics.UPLOADS.inc(outcome)
+
+    async def _worker(self) -> None:
+        while True:
+            await self._has_work.wait()
+            if not self._pending:
+                self._has_work.clear()
+                continue
+            _, upload = self._pending.popitem(last=False)
+            self._active += 1
+            try:
+                await self._upload(upload)
+            finally:
+                self._active -= 1
+                if not self._pending and not self._active:
+                    self._idle.set()
+
+    async def _upload(self, upload: Upload) -> None:
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                with metrics.timed("upload"):
+                    if upload.storage_id is None:
+                        upload.storage_id = await convex_fetcher.upload_pdf(upload.pdf)
+                        await asyncio.to_thread(self._write_record, upload)
+                    await convex_fetcher.save_compilation(upload.project_id, upload.zip_hash, upload.storage_id)
+            except asyncio.CancelledError:
+                raise  # left spooled
+            except Exception as e:
+                if attempt == UPLOAD_ATTEMPTS - 1 or not convex_fetcher.is_retryable(e):
+                    log.error("Upload failed for project=%s hash=%s: %s", upload.project_id, upload.zip_hash[:16], e)
+                    self._count("failed")
+                    break
+                delay = UPLOAD_RETRY_DELAY * 2**attempt * random.uniform(0.5, 1.5)
+                log.warning("Upload for project=%s failed, retrying in %.1fs: %s", upload.project_id, delay, e)
+                await asyncio.sleep(delay)
+            else:
+                log.info("Uploaded compilation for project=%s hash=%s", upload.project_id, upload.zip_hash[:16])
+                self._count("uploaded")
+                break
+        # A newer result of this project may have reused the same spool files
+        if self._pending.get(upload.project_id) != upload:
+            upload.discard()
+
+    async def stop(self, timeout: float = UPLOAD_DRAIN_TIMEOUT) -> None:
+        """Drain what is queued, for up to timeout seconds."""
+        self._stopping = True
+        # Results still being spooled stay spooled for the next start
+        await asyncio.gather(*self._spooling, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("Upload queue not drained in %.0fs; %d left spooled", timeout, len(self._pending) + self._active)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict[str, int]:
+        return {"pending": len(self._pending), "active": self._active, **self._counters}
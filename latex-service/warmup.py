@@ -0,0 +1,58 @@
+"""Startup warm-up, so the first compiles after a deploy don't run cold.
+
+Each engine compiles a small document through latexmk, just as a job would.
+That loads kpathsea's ls-R databases and the font maps, and builds the caches
+an engine otherwise builds on first use (luaotfload's font name database,
+fontconfig's cache for xelatex). It also pulls the formats, classes, packages
+and fonts most documents need into the page cache.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+import runner
+import scratch
+
+log = logging.getLogger(__name__)
+
+WARMUP_ENGINES = tuple(e for e in os.environ.get("WARMUP_ENGINES", "pdflatex,xelatex,lualatex").split(",") if e)
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "180"))  # per engine; luaotfload's first scan is slow
+
+ENGINE_FLAGS = {"pdflatex": "-pdf", "xelatex": "-xelatex", "lualatex": "-lualatex"}
+
+DOCUMENT = r"""\documentclass{article}
+\usepackage{amsmath,amssymb}
+\usepackage{graphicx}
+\usepackage{hyperref}
+\begin{document}
+\section{Warm-up}
+Some \textbf{bold}, \emph{emphasised} and \texttt{typewriter} text, and
+$\int_0^1 x^2\,dx = \frac{1}{3}$.
+\end{document}
+"""
+
+
+async def warm_up() -> dict[str, bool]:
+    """Run the warm-up compile for each engine in turn. Returns whether each
+    succeeded; a failure only means that engine starts cold."""
+    results = {}
+    for engine in WARMUP_ENGINES:
+        work_dir = scratch.mkdtemp("warmup-")
+        started = time.perf_counter()
+        try:
+            (work_dir / "warmup.tex").write_text(DOCUMENT)
+            cmd = ["latexmk", ENGINE_FLAGS.get(engine, "-pdf"), "-interaction=nonstopmode", "-halt-on-error", "warmup.tex"]
+            result = await runner.run_process(cmd, work_dir, WARMUP_TIMEOUT)
+            results[engine] = result.returncode == 0
+            if not results[engine]:
+                log.warning("Warm-up for %s failed: %s", engine, result.output[-500:])
+        except (TimeoutError, OSError) as e:
+            results[engine] = False
+            log.warning("Warm-up for %s failed: %r", engine, e)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
+        log.info("Warm-up of %s took %.1fs", engine, time.perf_counter() - started)
+    return results
@@ -1,5 +1,8 @@
+import io
 import zipfile
+import zlib
 from pathlib import Path, PurePosixPath
+from typing import BinaryIO
 
 
 class ZipSafetyError(Exception):
@@ -10,23 +13,34 @@ MAX_COMPRESSED_SIZE = 50 * 1024 * 1024  # 50 MB
 MAX_UNCOMPRESSED_SIZE = 200 * 1024 * 1024  # 200 MB
 MAX_FILE_COUNT = 500
 MAX_COMPRESSION_RATIO = 100
+CHUNK_SIZE = 256 * 1024
 
 
-def validate_and_extract(zip_bytes: bytes, dest_dir: Path) -> None:
-    if len(zip_bytes) > MAX_COMPRESSED_SIZE:
-        raise ZipSafetyError(
-            f"Compressed size {len(zip_bytes)} exceeds limit {MAX_COMPRESSED_SIZE}"
-        )
+def check_path(name: str) -> None:
+    """Reject paths that would land outside the extraction directory."""
+    path = PurePosixPath(name)
+    if path.is_absolute():
+        raise ZipSafetyError(f"Absolute path in zip: {name}")
+    if ".." in path.parts:
+        raise ZipSafetyError(f"Path traversal in zip: {name}")
 
-    try:
-        zf = zipfile.ZipFile(zipfile.Path(root=None), "r")  # type: ignore[arg-type]
-    except Exception:
-        pass
 
-    import io
+def validate_and_extract(zip_file: BinaryIO, dest_dir: Path) -> None:
+    """Validate a zip read from a seekable file and extract it into dest_dir.
+
+    Members are decompressed in chunks. The size limits are checked against
+    the declared sizes, which also bound the output: reading a member stops at
+    its declared size, and a member whose data doesn't match fails its CRC.
+    """
+    compressed_size = zip_file.seek(0, io.SEEK_END)
+    zip_file.seek(0)
+    if compressed_size > MAX_COMPRESSED_SIZE:
+        raise ZipSafetyError(
+            f"Compressed size {compressed_size} exceeds limit {MAX_COMPRESSED_SIZE}"
+        )
 
     try:
-        zf = zipfile.ZipFile(io.BytesIO(zip_bytes), "r")
+        zf = zipfile.ZipFile(zip_file, "r")
     except zipfile.BadZipFile as e:
         raise ZipSafetyError(f"Invalid zip file: {e}")
 
@@ -44,7 +58,6 @@ def validate_and_extract(zip_bytes: bytes, dest_dir: Path) -> None:
                 f"Uncompressed size {total_uncompressed} exceeds limit {MAX_UNCOMPRESSED_SIZE}"
             )
 
-        compressed_size = len(zip_bytes)
         if compressed_size > 0 and total_uncompressed / compressed_size > MAX_COMPRESSION_RATIO:
             raise ZipSafetyError(
                 f"Compression ratio {total_uncompressed / compressed_size:.1f} "
@@ -52,16 +65,25 @@ def validate_and_extract(zip_bytes: bytes, dest_dir: Path) -> None:
             )
 
         for member in members:
-            # Check for path traversal
-            member_path = PurePosixPath(member.filename)
-            if member_path.is_absolute():
-                raise ZipSafetyError(f"Absolute path in zip: {member.filename}")
-            if ".." in member_path.parts:
-                raise ZipSafetyError(f"Path traversal in zip: {member.filename}")
+            check_path(member.filename)
 
             # Check for symlinks (external_attr upper 16 bits contain Unix mode)
             unix_mode = member.external_attr >> 16
             if unix_mode != 0 and (unix_mode & 0o120000) == 0o120000:
                 raise ZipSafetyError(f"Symlink in zip: {member.filename}")
 
-        zf.extractall(dest_dir)
+        for member in members:
+            target = dest_dir / member.filename
+            try:
+                if member.is_dir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with zf.open(member) as src, open(target, "wb") as dst:
+                    while chunk := src.read(CHUNK_SIZE):
+                        dst.write(chunk)
+            except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as e:
+                raise ZipSafetyError(f"Corrupt zip member {member.filename}: {e}")
+            except OSError as e:
+                # e.g. both "a" and "a/b" in the zip
+                raise ZipSafetyError(f"Cannot extract {member.filename}: {e.strerror}")